@@ -1,5 +1,5 @@
 import os
-from prometheus_client import Counter, Histogram, Summary, Gauge, start_http_server
+from prometheus_client import Counter, Histogram, start_http_server
 import threading
 
 # Initialize Prometheus metrics
@@ -16,9 +16,16 @@ PROCESSING_TIME = Histogram(
     buckets=(0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0)
 )
 
-INPUT_WORD_COUNT = Summary('simplify_input_words', 'Number of words in input text')
-OUTPUT_WORD_COUNT = Summary('simplify_output_words', 'Number of words in output text')
-COMPRESSION_RATIO = Gauge('simplify_compression_ratio', 'Ratio of output words to input words')
+# Histograms, unlike summaries and gauges, can be aggregated over several app instances.
+WORD_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2000, 5000)
+
+INPUT_WORD_COUNT = Histogram('simplify_input_words', 'Number of words in input text', buckets=WORD_BUCKETS)
+OUTPUT_WORD_COUNT = Histogram('simplify_output_words', 'Number of words in output text', buckets=WORD_BUCKETS)
+COMPRESSION_RATIO = Histogram(
+    'simplify_compression_ratio',
+    'Ratio of output words to input words',
+    buckets=(0.25, 0.5, 0.75, 1.0, 1.25, 1.5, 2.0, 3.0, 4.0)
+)
 
 def track_metrics(
     input_text,
@@ -68,7 +75,7 @@ def track_metrics(
     if success:
         OUTPUT_WORD_COUNT.observe(output_words)
         if input_words > 0:
-            COMPRESSION_RATIO.set(output_words / input_words)
+            COMPRESSION_RATIO.observe(output_words / input_words)
 
 def start_metrics_server(port=8000, addr='0.0.0.0'):
     """
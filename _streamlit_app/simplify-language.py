@@ -1,4 +1,3 @@
-import re
 import time
 import base64
 import io
@@ -10,7 +9,8 @@ from openai import OpenAI
 
 from docx import Document
 from docx.shared import Pt, Inches
-from zix.understandability import get_zix, get_cefr
+from utils_scoring import get_zix, get_cefr
+from utils_postprocess import clean_text, extract_tagged_result
 from metrics import track_metrics
 from utils_sample_texts import SAMPLE_TEXT_01
 from utils_prompts import (
@@ -259,25 +259,12 @@ def get_result_from_response(response):
         tag = "einfachesprache"
     else:
         tag = "leichtesprache"
-    result = re.findall(rf"<{tag}>(.*?)</{tag}>", response, re.DOTALL)
-
-    # Handle case when no matching tags are found
-    if not result:
-        print(
-            f"Warning: Response was not properly formatted between <{tag}> tags. Just returning the whole response."
-        )
-        return response.strip()
-
-    return "\n".join(result).strip()
+    return extract_tagged_result(response, tag)
 
 
 def strip_markdown(text):
-    """Strip markdown from text."""
-    # Remove markdown headers
-    text = re.sub(r"#+\s", "", text)
-    # Remove markdown italic and bold
-    text = re.sub(r"\*\*|\*|__|_", "", text)
-    return text
+    """Strip markdown headers, italic and bold from text and replace ß with ss."""
+    return clean_text(text, strip_emphasis=True)
 
 
 def enter_sample_text():
@@ -539,8 +526,6 @@ if do_simplification or do_analysis:
     text = "Dein vereinfachter Text"
     if do_analysis:
         text = "Deine Analyse"
-    # Often the models return the German letter ß. Replace it with the Swiss German equivalent ss.
-    response = response.replace("ß", "ss")
     time_processed = time.time() - start_time
 
     with placeholder_result.container():
@@ -0,0 +1,123 @@
+# Clean-up of the model output while it streams.
+# The models often return the German letter ß, markdown headings and bold text. We replace ß with the Swiss German equivalent ss, remove the markdown and remove the single leading space that is left at the start of a line.
+# Markdown markers can be split across two chunks, e.g. "*" and "*". StreamCleaner therefore holds back a trailing run of markers or a space at the start of a line until the next chunk shows how it continues. All other text is passed on right away.
+# The cleaned text is collected in a list and joined only once at the end, so the cost stays linear in the length of the output.
+#
+# This file is shared by both apps. Keep both copies identical.
+
+import re
+
+
+_BOLD = re.compile(r"\*\*")
+_EMPHASIS = re.compile(r"[*_]+")
+_HEADING_AT_START = re.compile(r"\A#{1,7}")
+_HEADING = re.compile(r"(?<=\n)#{1,7}")
+_INDENT = re.compile(r"(?<=\n) (?! )")
+_TRAILING_MARKERS = re.compile(r"[*#]+\Z")
+_SPECIAL = re.compile(r"[*#_ß\n]")
+
+
+class StreamCleaner:
+    """Clean the model output chunk by chunk and collect the result."""
+
+    def __init__(self, strip_emphasis=False):
+        # With strip_emphasis all * and _ are removed (italic and bold). Otherwise ** is replaced with a space and single markers are kept.
+        self.strip_emphasis = strip_emphasis
+        self.parts = []
+        self._markers = ""
+        self._space = ""
+        self._line_start_markup = True
+        self._line_start_indent = True
+
+    @property
+    def text(self):
+        """The cleaned text so far."""
+        if len(self.parts) > 1:
+            self.parts = ["".join(self.parts)]
+        return self.parts[0] if self.parts else ""
+
+    def feed(self, chunk_text):
+        """Clean a chunk and return the part of it that can be shown already."""
+        # Most chunks are plain words in the middle of a line and need no clean-up.
+        if not (
+            self._markers
+            or self._space
+            or self._line_start_markup
+            or self._line_start_indent
+            or _SPECIAL.search(chunk_text)
+        ):
+            return self._emit(chunk_text)
+        text = self._markers + chunk_text
+        match = _TRAILING_MARKERS.search(text)
+        if match:
+            text, self._markers = text[: match.start()], match.group()
+        else:
+            self._markers = ""
+        return self._emit(self._indent(self._markup(text), final=False))
+
+    def finish(self):
+        """Clean the held back rest at the end of the stream and return it."""
+        text = self._markup(self._markers)
+        self._markers = ""
+        return self._emit(self._indent(text, final=True))
+
+    def _emit(self, text):
+        if text:
+            self.parts.append(text)
+        return text
+
+    def _markup(self, text):
+        if not text:
+            return text
+        text = text.replace("ß", "ss")
+        if self.strip_emphasis:
+            text = _EMPHASIS.sub("", text)
+        else:
+            text = _BOLD.sub(" ", text)
+        if self._line_start_markup:
+            text = _HEADING_AT_START.sub("", text)
+        text = _HEADING.sub("", text)
+        if text:
+            self._line_start_markup = text.endswith("\n")
+        return text
+
+    def _indent(self, text, final):
+        # Remove a single space at the start of a line. Two or more spaces are kept.
+        text = self._space + text
+        self._space = ""
+        if not text:
+            return text
+        if self._line_start_indent and text[0] == " ":
+            if len(text) == 1 and not final:
+                self._space = text
+                return ""
+            if len(text) == 1 or text[1] != " ":
+                text = text[1:]
+        if not final and text.endswith("\n "):
+            text, self._space = text[:-1], " "
+        text = _INDENT.sub("", text)
+        if text:
+            self._line_start_indent = text.endswith("\n")
+        return text
+
+
+def clean_text(text, strip_emphasis=False):
+    """Clean a complete model output."""
+    cleaner = StreamCleaner(strip_emphasis=strip_emphasis)
+    cleaner.feed(text)
+    cleaner.finish()
+    return cleaner.text
+
+
+def extract_tagged_result(response, tag):
+    """Return the text between the <tag> tags of a model output, or the whole output if it has no such tags."""
+    result = re.findall(rf"<{tag}>(.*?)</{tag}>", response, re.DOTALL)
+
+    # Handle case when no matching tags are found
+    if not result:
+        print(
+            f"Warning: Response was not properly formatted between <{tag}> tags. Just returning the whole response."
+        )
+        return response.strip()
+
+    return "\n".join(result).strip()
@@ -0,0 +1,159 @@
+# Cached understandability scoring.
+# Streamlit reruns the whole script on every interaction, e.g. when the user changes the level of simplification. Without a cache, spaCy parses the same input text again on each rerun. We keep the scores in memory, keyed by a hash of the text content. The cache lives at module level and is therefore shared by all sessions of the process.
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+from zix.understandability import get_zix as _get_zix, get_cefr as _get_cefr
+
+
+DEFAULT_SCORE_CACHE_MAX_ENTRIES = 2_048
+
+# A short administrative text that exercises the whole spaCy pipeline during warm-up.
+WARMUP_TEXT = "Die Gesuchstellerin hat die Unterlagen fristgerecht eingereicht. Wir prüfen Ihr Gesuch und informieren Sie schriftlich über den Entscheid."
+
+# Minimum number of words that we collect before we score a part of a streamed text. Single short lines give unreliable scores.
+MIN_WORDS_PER_SEGMENT = 40
+
+_ready = threading.Event()
+
+
+class ScoreCache:
+    """Thread-safe in-memory cache with least-recently-used eviction."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        """Return a tuple (found, value) for a key."""
+        with self._lock:
+            if key not in self._entries:
+                return False, None
+            self._entries.move_to_end(key)
+            return True, self._entries[key]
+
+    def store(self, key, value):
+        """Store a value and evict the least recently used entry if the cache is full."""
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_zix_cache = ScoreCache(
+    int(os.getenv("SCORE_CACHE_MAX_ENTRIES", DEFAULT_SCORE_CACHE_MAX_ENTRIES))
+)
+
+
+def content_hash(text):
+    """Return a compact hash of the text content that we use as cache key."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def get_zix(text):
+    """Return the understandability score of a text. Scores of known texts come from the cache."""
+    key = content_hash(text)
+    found, score = _zix_cache.lookup(key)
+    if found:
+        return score
+    score = _get_zix(text)
+    _zix_cache.store(key, score)
+    return score
+
+
+@lru_cache(maxsize=1_024)
+def get_cefr(score):
+    """Return the approximate CEFR level for an understandability score."""
+    return _get_cefr(score)
+
+
+class IncrementalScorer:
+    """
+    Score a streamed text segment by segment while it arrives.
+
+    We collect complete lines until a segment has at least MIN_WORDS_PER_SEGMENT words and score it right away. The score of the whole text is the mean of the segment scores, weighted by their word counts. This approximates the score of the full text, and at the end of the stream only the last segment is left to score.
+    """
+
+    def __init__(self, min_words=MIN_WORDS_PER_SEGMENT):
+        self.min_words = min_words
+        self._pending = []
+        self._segment = []
+        self._segment_words = 0
+        self._weighted_sum = 0.0
+        self._words = 0
+
+    def feed(self, text):
+        """Add a chunk of streamed text. Returns True if the aggregate score changed."""
+        if "\n" not in text:
+            self._pending.append(text)
+            return False
+        head, _, tail = text.rpartition("\n")
+        self._pending.append(head)
+        lines = "".join(self._pending)
+        self._pending = [tail]
+        self._segment.append(lines)
+        self._segment_words += len(lines.split())
+        if self._segment_words < self.min_words:
+            return False
+        return self._score_segment()
+
+    def _score_segment(self):
+        segment = "\n".join(self._segment).strip()
+        words = self._segment_words
+        self._segment = []
+        self._segment_words = 0
+        if not segment:
+            return False
+        score = get_zix(segment)
+        if score is None:
+            return False
+        self._weighted_sum += score * words
+        self._words += words
+        return True
+
+    @property
+    def score(self):
+        """The aggregated score of all segments scored so far or None."""
+        if self._words == 0:
+            return None
+        return self._weighted_sum / self._words
+
+    def finish(self):
+        """Score the remaining text and return the final score."""
+        tail = "".join(self._pending)
+        self._pending = []
+        self._segment.append(tail)
+        self._segment_words += len(tail.split())
+        self._score_segment()
+        return self.score
+
+
+def warm_up(text=WARMUP_TEXT):
+    """
+    Load and warm up the scoring pipeline before the first user arrives.
+
+    The first call of get_zix loads the spaCy model and initializes its lookup tables. We trigger this once with a sample text and bypass the cache so that no sample scores end up in it.
+
+    Returns:
+        float
+            The warm-up time in seconds.
+    """
+    start_time = time.perf_counter()
+    _get_cefr(_get_zix(text))
+    _ready.set()
+    return time.perf_counter() - start_time
+
+
+def is_ready():
+    """Return True once the scoring pipeline has been warmed up."""
+    return _ready.is_set()
@@ -0,0 +1,351 @@
+# Headless HTTP API for the language simplification.
+# Other systems of the administration can simplify texts without going through the Streamlit page. The API uses the same prompts, model settings, slot limiter and post-processing as the app, but does not import Streamlit. All requests are served asynchronously on a single event loop. The model calls go through call_llm_async: waiting for a slot of the server and reading the stream happen on the event loop, so many requests can wait and stream at once without a thread each.
+#
+# Usage: uvicorn api:app --host 0.0.0.0 --port 8080
+#
+# Endpoints:
+#   POST /simplify  {"text": "...", "level": "Einfache Sprache", "stream": true}
+#                   Streams the simplified text as server-sent events. With "stream": false the complete result is returned as JSON.
+#   POST /score     {"text": "..."}
+#                   Returns the understandability score (ZIX) and the approximate CEFR level.
+#   GET  /health    Returns 200 once the scoring pipeline is warmed up, 503 before.
+#   GET  /download/{handle}
+#                   Returns the Word document of a result of the app. The app stores the result and links here.
+
+import asyncio
+import json
+import time
+from contextlib import asynccontextmanager
+
+import anyio
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from metrics import (
+    track_metrics,
+    track_warmup,
+    track_degeneration,
+    track_cancellation,
+    GenerationTracker,
+)
+from utils_llm import (
+    MODEL_MAPPING,
+    MODEL_OPTIONS,
+    DEFAULT_MODEL,
+    SYSTEM_MESSAGES,
+    MAX_TOKENS,
+    call_llm_async,
+    get_error_message,
+    probe_first_token,
+)
+from utils_cache import ResultCache
+from utils_engine import AsyncEngine
+from utils_export import DEFAULT_OUTPUT_FILENAME, DOCX_MEDIA_TYPE, get_document
+from utils_postprocess import StreamCleaner
+from utils_logging import log_simplification
+from utils_routing import BackendRouter
+from utils_budget import BudgetPlanner
+from utils_degeneration import DegenerationDetector, DegenerationError
+from utils_scoring import get_zix, get_cefr, is_ready, warm_up
+
+
+# Same limit as in the app.
+MAX_CHARS_INPUT = 10_000
+
+DEFAULT_LEVEL = "Einfache Sprache"
+
+engine = None
+router = BackendRouter(MODEL_MAPPING, probe_first_token=probe_first_token)
+planner = BudgetPlanner(router)
+result_cache = ResultCache()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """Create the generation engine and warm up the scoring pipeline before serving requests."""
+    global engine
+    # The clients of the engine must be created on the event loop that uses them.
+    engine = AsyncEngine(MODEL_MAPPING)
+    router.start()
+    track_warmup(await run_in_threadpool(warm_up))
+    yield
+    await engine.aclose()
+
+
+def error_response(message, status_code):
+    return JSONResponse({"error": message}, status_code=status_code)
+
+
+async def close_stream(stream):
+    """Close a model stream, even while the request is being cancelled. Closing it cancels the request on the server and frees the slot."""
+    with anyio.CancelScope(shield=True):
+        await stream.aclose()
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """Streaming response that closes the model stream when it ends, also if the client disconnected before the body started."""
+
+    def __init__(self, content, stream, **kwargs):
+        super().__init__(content, **kwargs)
+        self.stream = stream
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await close_stream(self.stream)
+
+
+def format_sse(data, event=None):
+    """Format a server-sent event."""
+    message = f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+    if event is not None:
+        message = f"event: {event}\n" + message
+    return message
+
+
+async def score_text(text):
+    """Score a text in a worker thread, so that spaCy does not block the event loop."""
+    score = await run_in_threadpool(get_zix, text)
+    if score is None:
+        return None, None
+    return round(float(score), 2), get_cefr(score)
+
+
+async def parse_request(request):
+    """Read and validate the JSON body of a request. Returns (body, error_response)."""
+    try:
+        body = await request.json()
+    except ValueError:
+        return None, error_response("Der Request-Body muss gültiges JSON sein.", 400)
+    if not isinstance(body, dict):
+        return None, error_response("Der Request-Body muss ein JSON-Objekt sein.", 400)
+    text = body.get("text")
+    if not isinstance(text, str) or not text.strip():
+        return None, error_response("Das Feld 'text' fehlt oder ist leer.", 400)
+    if len(text) > MAX_CHARS_INPUT:
+        return None, error_response(
+            f"Der Text ist länger als {MAX_CHARS_INPUT} Zeichen.", 413
+        )
+    return body, None
+
+
+async def simplify(request):
+    body, error = await parse_request(request)
+    if error is not None:
+        return error
+
+    text = body["text"].strip()
+    level = body.get("level", DEFAULT_LEVEL)
+    if level not in SYSTEM_MESSAGES:
+        return error_response(
+            f"Unbekannter Grad der Vereinfachung. Erlaubt sind: {', '.join(SYSTEM_MESSAGES)}.",
+            400,
+        )
+
+    # The router probes the health and latency of the backends in the background. If all of them are down or overloaded, clients learn it right away instead of after a timeout.
+    if not router.available_backends(MODEL_OPTIONS):
+        return error_response(
+            "Die KI-Server sind zurzeit nicht erreichbar oder ausgelastet.", 503
+        )
+    model_name = router.pick(MODEL_OPTIONS) or DEFAULT_MODEL
+    if not engine.has_backend(model_name):
+        return error_response(
+            f"Verbindung zum KI-Server für {model_name} nicht verfügbar.", 503
+        )
+
+    system_message = SYSTEM_MESSAGES[level]
+    # Counting the tokens calls the backend, so we do it in a worker thread.
+    max_tokens, error_message = await run_in_threadpool(
+        planner.plan, model_name, level, system_message, text, MAX_TOKENS
+    )
+    if max_tokens is None:
+        return error_response(error_message, 413)
+
+    start_time = time.time()
+    tracker = GenerationTracker(model_name, level)
+    # As in the app, the request waits for a free slot of the server and prefers the slot that holds the system message of its level.
+    success, stream = await call_llm_async(
+        engine,
+        text,
+        model_name=model_name,
+        system_message=system_message,
+        limiter=router.limiter(model_name),
+        tracker=tracker,
+        max_tokens=max_tokens,
+    )
+    if success is False:
+        router.report_failure(model_name)
+        track_metrics(
+            len(text.split()),
+            0,
+            None,
+            None,
+            level,
+            model_name,
+            time.time() - start_time,
+            False,
+        )
+        log_simplification(
+            len(text.split()),
+            0,
+            None,
+            None,
+            level,
+            model_name,
+            time.time() - start_time,
+            False,
+            source="api",
+            error=str(stream),
+        )
+        return error_response(stream, 502)
+    # The router counts the request as in flight until the stream is exhausted or closed, and a failed stream as a failure of the backend.
+    stream = router.track(model_name, stream)
+
+    cleaner = StreamCleaner()
+    detector = DegenerationDetector(len(text.split()))
+
+    async def generate():
+        """Yield the cleaned chunks of the model output."""
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content is not None:
+                    chunk_text = cleaner.feed(chunk.choices[0].delta.content)
+                    if chunk_text != "":
+                        yield chunk_text
+                        reason = detector.feed(chunk_text)
+                        if reason is not None:
+                            track_degeneration(model_name, level, reason)
+                            raise DegenerationError(reason)
+            chunk_text = cleaner.finish()
+            if chunk_text != "":
+                yield chunk_text
+        except (asyncio.CancelledError, GeneratorExit):
+            # The client disconnected. Closing the stream below cancels the request on the server.
+            track_cancellation(model_name, level, max_tokens - tracker.chunks)
+            raise
+        finally:
+            # Closing the stream cancels the request, so the server stops generating, and frees the slot.
+            await close_stream(stream)
+
+    async def finish(response, success, error=None):
+        """Score the result and record the request. A failed request is recorded with the output it got so far."""
+        score_source, _ = await score_text(text)
+        score_target, cefr_target = await score_text(response)
+        if success and response:
+            planner.record(level, len(text.split()), len(response.split()))
+        track_metrics(
+            len(text.split()),
+            len(response.split()),
+            score_source,
+            score_target,
+            level,
+            model_name,
+            time.time() - start_time,
+            success,
+        )
+        log_simplification(
+            len(text.split()),
+            len(response.split()),
+            score_source,
+            score_target,
+            level,
+            model_name,
+            time.time() - start_time,
+            success,
+            source="api",
+            error=error,
+            tracker=tracker,
+        )
+        return {
+            "text": response,
+            "model": model_name,
+            "level": level,
+            "zix": score_target,
+            "cefr": cefr_target,
+            "time_processed": round(time.time() - start_time, 3),
+        }
+
+    if not body.get("stream", True):
+        try:
+            async for _ in generate():
+                pass
+        except Exception as e:
+            await finish(cleaner.text.strip(), False, error=str(e))
+            return error_response(get_error_message(e), 502)
+        response = cleaner.text.strip()
+        return JSONResponse(await finish(response, True))
+
+    async def event_stream():
+        try:
+            async for chunk_text in generate():
+                yield format_sse({"text": chunk_text})
+        except Exception as e:
+            await finish(cleaner.text.strip(), False, error=str(e))
+            yield format_sse({"error": get_error_message(e)}, event="error")
+            return
+        response = cleaner.text.strip()
+        yield format_sse(await finish(response, True), event="done")
+
+    return ClosingStreamingResponse(
+        event_stream(),
+        stream,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def score(request):
+    body, error = await parse_request(request)
+    if error is not None:
+        return error
+    score_value, cefr = await score_text(body["text"].strip())
+    return JSONResponse({"zix": score_value, "cefr": cefr})
+
+
+async def download(request):
+    # Building the document takes a moment, so we do it in a worker thread.
+    document = await run_in_threadpool(
+        get_document, result_cache, request.path_params["handle"]
+    )
+    if document is None:
+        return error_response("Das Dokument ist nicht mehr verfügbar.", 404)
+    return Response(
+        document,
+        media_type=DOCX_MEDIA_TYPE,
+        headers={
+            "Content-Disposition": f'attachment; filename="{DEFAULT_OUTPUT_FILENAME}"'
+        },
+    )
+
+
+async def health(request):
+    if not is_ready():
+        return JSONResponse({"status": "warming up"}, status_code=503)
+    return JSONResponse(
+        {
+            "status": "ok",
+            "backends": router.healthy_backends(MODEL_OPTIONS),
+            "available": router.available_backends(MODEL_OPTIONS),
+        }
+    )
+
+
+app = Starlette(
+    routes=[
+        Route("/simplify", simplify, methods=["POST"]),
+        Route("/score", score, methods=["POST"]),
+        Route("/health", health, methods=["GET"]),
+        Route("/download/{handle}", download, methods=["GET"]),
+    ],
+    lifespan=lifespan,
+)
+
+
+if __name__ == "__main__":
+    import os
+    import uvicorn
+
+    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("API_PORT", "8080")))
@@ -1,7 +1,26 @@
 import os
-from prometheus_client import Counter, Histogram, Summary, start_http_server, REGISTRY
+import time
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    start_http_server,
+    multiprocess,
+    REGISTRY,
+)
 import threading
 
+from utils_stream import ClosingStream
+
+
+# With PROMETHEUS_MULTIPROC_DIR set, every process writes its metrics to files in this directory and a single exporter serves the aggregate of all processes (see serve.py). Without it, each process exports its own metrics.
+MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+# Histogram buckets of the word counts and the ZIX scores. Histograms, unlike summaries, can be aggregated over processes and containers.
+WORD_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2000, 5000)
+ZIX_BUCKETS = (-10, -8, -6, -5, -4, -3, -2, -1, 0, 1, 2, 4)
+
 
 def get_metric(metric_cls, name, *args, **kwargs):
     try:
@@ -28,15 +47,257 @@ PROCESSING_TIME = get_metric(
 )
 
 INPUT_WORD_COUNT = get_metric(
-    Summary, "simplify_input_words", "Number of words in input text"
+    Histogram,
+    "simplify_input_words",
+    "Number of words in input text",
+    buckets=WORD_BUCKETS,
 )
 
 OUTPUT_WORD_COUNT = get_metric(
-    Summary, "simplify_output_words", "Number of words in output text"
+    Histogram,
+    "simplify_output_words",
+    "Number of words in output text",
+    buckets=WORD_BUCKETS,
 )
 
-ZIX_INPUT_TEXT = get_metric(Summary, "zix_input_text", "Zix input text")
-ZIX_OUTPUT_TEXT = get_metric(Summary, "zix_output_text", "Zix output text")
+COMPRESSION_RATIO = get_metric(
+    Histogram,
+    "simplify_compression_ratio",
+    "Ratio of output words to input words",
+    buckets=(0.25, 0.5, 0.75, 1.0, 1.25, 1.5, 2.0, 3.0, 4.0),
+)
+
+ZIX_INPUT_TEXT = get_metric(
+    Histogram, "zix_input_text", "Zix input text", buckets=ZIX_BUCKETS
+)
+ZIX_OUTPUT_TEXT = get_metric(
+    Histogram, "zix_output_text", "Zix output text", buckets=ZIX_BUCKETS
+)
+
+CACHE_LOOKUPS = get_metric(
+    Counter,
+    "simplify_result_cache_lookups_total",
+    "Lookups in the persistent result cache",
+    ["simplification_level", "result"],
+)
+
+SCORING_READY = get_metric(
+    Gauge,
+    "simplify_scoring_ready",
+    "1 once the ZIX/spaCy scoring pipeline is loaded and warmed up, 0 before",
+    multiprocess_mode="livemax",
+)
+
+SCORING_WARMUP_TIME = get_metric(
+    Gauge,
+    "simplify_scoring_warmup_seconds",
+    "Time spent loading and warming up the ZIX/spaCy scoring pipeline at startup",
+    multiprocess_mode="livemax",
+)
+
+BACKEND_HEALTHY = get_metric(
+    Gauge,
+    "simplify_backend_healthy",
+    "1 if the Llama.cpp backend is in rotation, 0 if it is taken out",
+    ["backend"],
+    # Each process probes the backends itself. We report a backend as down as soon as one process took it out.
+    multiprocess_mode="livemin",
+)
+
+BACKEND_IN_FLIGHT = get_metric(
+    Gauge,
+    "simplify_backend_in_flight",
+    "Number of requests currently streaming from the Llama.cpp backend",
+    ["backend"],
+    multiprocess_mode="livesum",
+)
+
+BACKEND_OVERLOADED = get_metric(
+    Gauge,
+    "simplify_backend_overloaded",
+    "1 if the Llama.cpp backend answers too slowly or its queue is too long for new requests",
+    ["backend"],
+    multiprocess_mode="livemax",
+)
+
+BACKEND_PROBE_FIRST_TOKEN = get_metric(
+    Gauge,
+    "simplify_backend_probe_first_token_seconds",
+    "Time to the first token of the latest tiny probe request to a free slot of the Llama.cpp backend",
+    ["backend"],
+    multiprocess_mode="livemax",
+)
+
+BACKEND_PROBE_FIRST_TOKEN_TIME = get_metric(
+    Histogram,
+    "simplify_backend_probe_first_token_time_seconds",
+    "Time to the first token of the tiny probe requests to the Llama.cpp backend",
+    ["backend"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 15.0),
+)
+
+QUEUE_DEPTH = get_metric(
+    Gauge,
+    "simplify_queue_depth",
+    "Number of requests waiting for a free slot of the Llama.cpp backend",
+    ["backend"],
+    multiprocess_mode="livesum",
+)
+
+QUEUE_WAIT_TIME = get_metric(
+    Histogram,
+    "simplify_queue_wait_seconds",
+    "Time requests waited for a free slot of the Llama.cpp backend",
+    ["backend"],
+    buckets=(0.01, 0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0),
+)
+
+HTTP_REQUESTS = get_metric(
+    Counter,
+    "simplify_http_requests_total",
+    "HTTP requests sent to the Llama.cpp backend",
+    ["backend"],
+)
+
+HTTP_CONNECTIONS_OPENED = get_metric(
+    Counter,
+    "simplify_http_connections_opened_total",
+    "New HTTP connections opened to the Llama.cpp backend. Requests minus new connections are requests on reused keep-alive connections",
+    ["backend"],
+)
+
+HTTP_STREAMS_ACTIVE = get_metric(
+    Gauge,
+    "simplify_http_streams_active",
+    "Streams currently open on the connection pool of the Llama.cpp backend",
+    ["backend"],
+    multiprocess_mode="livesum",
+)
+
+HTTP_POOL_SIZE = get_metric(
+    Gauge,
+    "simplify_http_pool_max_connections",
+    "Maximum number of connections in the pool of the Llama.cpp backend",
+    ["backend"],
+    multiprocess_mode="livesum",
+)
+
+TIME_TO_FIRST_TOKEN = get_metric(
+    Histogram,
+    "simplify_time_to_first_token_seconds",
+    "Time from sending the request to the first generated token. Contains prompt processing but no queueing",
+    ["backend", "simplification_level"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0),
+)
+
+INTER_CHUNK_TIME = get_metric(
+    Histogram,
+    "simplify_inter_chunk_seconds",
+    "Time between two streamed chunks of generated text",
+    ["backend", "simplification_level"],
+    buckets=(0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0),
+)
+
+GENERATED_TOKENS = get_metric(
+    Histogram,
+    "simplify_generated_tokens",
+    "Number of tokens generated per request",
+    ["backend", "simplification_level"],
+    buckets=(16, 32, 64, 128, 256, 512, 1024, 2048, 4096),
+)
+
+DECODE_SPEED = get_metric(
+    Histogram,
+    "simplify_decode_tokens_per_second",
+    "Generation speed after the first token in tokens per second",
+    ["backend", "simplification_level"],
+    buckets=(5, 10, 20, 30, 40, 60, 80, 120, 200),
+)
+
+SLOT_AFFINITY = get_metric(
+    Counter,
+    "simplify_slot_affinity_total",
+    "Requests that got a slot of the Llama.cpp backend which still held the system message of their level (hit) or not (miss)",
+    ["backend", "result"],
+)
+
+PROMPT_TOKENS = get_metric(
+    Counter,
+    "simplify_prompt_tokens_total",
+    "Prompt tokens taken from the KV cache of the slot (cached) or processed by the Llama.cpp backend (evaluated)",
+    ["backend", "source"],
+)
+
+PROMPT_EVAL_TIME_SAVED = get_metric(
+    Counter,
+    "simplify_prompt_eval_seconds_saved_total",
+    "Estimated prompt processing time saved by reusing the KV cache, from the prompt speed the Llama.cpp backend reports",
+    ["backend"],
+)
+
+PLANNED_MAX_TOKENS = get_metric(
+    Histogram,
+    "simplify_planned_max_tokens",
+    "Token budget (max_tokens) planned for a request from the length of its input",
+    ["simplification_level"],
+    buckets=(128, 256, 512, 768, 1024, 1536, 2048, 4096),
+)
+
+BUDGET_REJECTIONS = get_metric(
+    Counter,
+    "simplify_budget_rejections_total",
+    "Requests rejected because the input and its expected output do not fit into the context window",
+    ["simplification_level"],
+)
+
+DEGENERATION_ABORTS = get_metric(
+    Counter,
+    "simplify_degeneration_aborts_total",
+    "Streams stopped early because the output repeated itself or grew far longer than the input",
+    ["backend", "simplification_level", "reason"],
+)
+
+CANCELLED_GENERATIONS = get_metric(
+    Counter,
+    "simplify_cancelled_generations_total",
+    "Generations cancelled because the user reran the app, closed the tab or disconnected from the API",
+    ["backend", "simplification_level"],
+)
+
+CANCELLED_TOKENS_SAVED = get_metric(
+    Counter,
+    "simplify_cancelled_tokens_saved_total",
+    "Tokens of the budget that cancelled generations did not generate. This is an upper bound of the decode work saved",
+    ["backend"],
+)
+
+JOBS_SUBMITTED = get_metric(
+    Counter,
+    "simplify_jobs_submitted_total",
+    "Generation jobs submitted to the job queue (new) or joined to a queued or running job for the same text (joined)",
+    ["result"],
+)
+
+JOBS_QUEUED = get_metric(
+    Gauge,
+    "simplify_jobs_queued",
+    "Generation jobs waiting in the job queue for a worker",
+    # All processes read the same queue.
+    multiprocess_mode="livemax",
+)
+
+JOBS_RUNNING = get_metric(
+    Gauge,
+    "simplify_jobs_running",
+    "Generation jobs currently run by the workers, including those waiting for a slot of the Llama.cpp backend",
+    multiprocess_mode="livesum",
+)
+
+JOB_REATTACHMENTS = get_metric(
+    Counter,
+    "simplify_job_reattachments_total",
+    "Sessions that reattached to their job after a reload or reconnect",
+)
 
 
 def track_metrics(
@@ -62,18 +323,208 @@ def track_metrics(
 
     if success:
         OUTPUT_WORD_COUNT.observe(output_words)
+        if input_words > 0:
+            COMPRESSION_RATIO.observe(output_words / input_words)
+
+    # The scores are missing if the model call failed.
+    if zix_input_text is not None:
+        ZIX_INPUT_TEXT.observe(zix_input_text)
+    if zix_output_text is not None:
+        ZIX_OUTPUT_TEXT.observe(zix_output_text)
+
+
+def track_cache_lookup(hit, simplification_level):
+    CACHE_LOOKUPS.labels(
+        simplification_level=simplification_level, result="hit" if hit else "miss"
+    ).inc()
+
+
+def track_warmup(time_warmup):
+    SCORING_WARMUP_TIME.set(time_warmup)
+    SCORING_READY.set(1)
+
+
+def track_backend_state(backend, healthy, in_flight, overloaded):
+    BACKEND_HEALTHY.labels(backend=backend).set(1 if healthy else 0)
+    BACKEND_IN_FLIGHT.labels(backend=backend).set(in_flight)
+    BACKEND_OVERLOADED.labels(backend=backend).set(1 if overloaded else 0)
+
+
+def track_probe_first_token(backend, first_token_seconds):
+    BACKEND_PROBE_FIRST_TOKEN.labels(backend=backend).set(first_token_seconds)
+    BACKEND_PROBE_FIRST_TOKEN_TIME.labels(backend=backend).observe(first_token_seconds)
+
+
+def track_queue_depth(backend, depth):
+    QUEUE_DEPTH.labels(backend=backend).set(depth)
+
+
+def track_queue_wait(backend, time_waited):
+    QUEUE_WAIT_TIME.labels(backend=backend).observe(time_waited)
+
+
+def track_http_request(backend):
+    HTTP_REQUESTS.labels(backend=backend).inc()
+
+
+def track_http_connection_opened(backend):
+    HTTP_CONNECTIONS_OPENED.labels(backend=backend).inc()
+
+
+def track_http_streams(backend, active):
+    HTTP_STREAMS_ACTIVE.labels(backend=backend).set(active)
+
+
+def track_http_pool_size(backend, max_connections):
+    HTTP_POOL_SIZE.labels(backend=backend).set(max_connections)
+
+
+def track_slot_affinity(backend, hit):
+    SLOT_AFFINITY.labels(backend=backend, result="hit" if hit else "miss").inc()
+
+
+def track_prompt_cache(backend, cached_tokens, evaluated_tokens, prompt_ms):
+    PROMPT_TOKENS.labels(backend=backend, source="cached").inc(cached_tokens)
+    PROMPT_TOKENS.labels(backend=backend, source="evaluated").inc(evaluated_tokens)
+    if prompt_ms and evaluated_tokens:
+        seconds_per_token = prompt_ms / evaluated_tokens / 1000
+        PROMPT_EVAL_TIME_SAVED.labels(backend=backend).inc(cached_tokens * seconds_per_token)
+
+
+def track_budget(simplification_level, max_tokens):
+    if max_tokens is None:
+        BUDGET_REJECTIONS.labels(simplification_level=simplification_level).inc()
+    else:
+        PLANNED_MAX_TOKENS.labels(simplification_level=simplification_level).observe(max_tokens)
+
+
+def track_degeneration(backend, simplification_level, reason):
+    DEGENERATION_ABORTS.labels(
+        backend=backend, simplification_level=simplification_level, reason=reason
+    ).inc()
+
+
+def track_cancellation(backend, simplification_level, tokens_saved):
+    CANCELLED_GENERATIONS.labels(
+        backend=backend, simplification_level=simplification_level
+    ).inc()
+    CANCELLED_TOKENS_SAVED.labels(backend=backend).inc(max(0, tokens_saved))
+
+
+def track_job_submitted(joined):
+    JOBS_SUBMITTED.labels(result="joined" if joined else "new").inc()
+
+
+def track_jobs(queued, running):
+    JOBS_QUEUED.set(queued)
+    JOBS_RUNNING.set(running)
+
+
+def track_job_reattachment():
+    JOB_REATTACHMENTS.inc()
+
+
+class GenerationTracker:
+    """
+    Record the timing of one streamed generation.
+
+    Call start() right before the request is sent, chunk() for every streamed chunk and finish() when the stream is complete. track() does the last two for a blocking stream.
+    Llama.cpp adds its own timings to the last chunk. If they are present, we use them for the token count and the decode speed. Otherwise we count one token per chunk.
+    """
+
+    def __init__(self, backend, simplification_level):
+        self.labels = {"backend": backend, "simplification_level": simplification_level}
+        self.start_time = None
+        self.first_chunk_time = None
+        self.last_chunk_time = None
+        self.chunks = 0
+        self.timings = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+
+    def chunk(self, chunk):
+        timings = getattr(chunk, "timings", None)
+        if timings:
+            self.timings = timings
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            return
+        now = time.perf_counter()
+        if self.first_chunk_time is None:
+            self.first_chunk_time = now
+            if self.start_time is not None:
+                TIME_TO_FIRST_TOKEN.labels(**self.labels).observe(now - self.start_time)
+        else:
+            INTER_CHUNK_TIME.labels(**self.labels).observe(now - self.last_chunk_time)
+        self.last_chunk_time = now
+        self.chunks += 1
+
+    def track(self, stream):
+        """Record the chunks of a stream while it is consumed."""
+        return ClosingStream(stream, on_chunk=self.chunk, on_end=self.finish)
+
+    def finish(self):
+        tokens = self.generated_tokens()
+        GENERATED_TOKENS.labels(**self.labels).observe(tokens)
+        tokens_per_second = self.tokens_per_second()
+        if tokens_per_second:
+            DECODE_SPEED.labels(**self.labels).observe(tokens_per_second)
+        timings = self.timings or {}
+        if "cache_n" in timings and "prompt_n" in timings:
+            track_prompt_cache(
+                self.labels["backend"],
+                timings["cache_n"],
+                timings["prompt_n"],
+                timings.get("prompt_ms"),
+            )
+
+    def generated_tokens(self):
+        return (self.timings or {}).get("predicted_n") or self.chunks
+
+    def tokens_per_second(self):
+        tokens_per_second = (self.timings or {}).get("predicted_per_second")
+        if not tokens_per_second and self.chunks > 1:
+            tokens_per_second = (self.chunks - 1) / (
+                self.last_chunk_time - self.first_chunk_time
+            )
+        return tokens_per_second
+
+    def summary(self):
+        """Return the timing of the generation as a dict for the event log."""
+        timings = self.timings or {}
+        time_to_first_token = None
+        if self.start_time is not None and self.first_chunk_time is not None:
+            time_to_first_token = round(self.first_chunk_time - self.start_time, 3)
+        tokens_per_second = self.tokens_per_second()
+        return {
+            "time_to_first_token": time_to_first_token,
+            "generated_tokens": self.generated_tokens(),
+            "tokens_per_second": round(tokens_per_second, 1) if tokens_per_second else None,
+            "prompt_tokens": timings.get("prompt_n"),
+            "cached_prompt_tokens": timings.get("cache_n"),
+        }
+
 
-    ZIX_INPUT_TEXT.observe(zix_input_text)
-    ZIX_OUTPUT_TEXT.observe(zix_output_text)
+def track_process_exit(pid):
+    """Remove the live gauges of a process that exited from the aggregate of all processes."""
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
 
 
 def start_metrics_server(port=8000, addr="0.0.0.0"):
+    registry = REGISTRY
+    if MULTIPROC_DIR:
+        # Serve the metrics of all processes, read from the files in MULTIPROC_DIR.
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
     try:
-        start_http_server(port, addr)
+        start_http_server(port, addr, registry=registry)
         print(f"Prometheus metrics server started on {addr}:{port}")
     except Exception as e:
         print(f"Failed to start metrics server: {e}")
 
 
-metrics_port = int(os.environ.get("METRICS_PORT", "8000"))
-threading.Thread(target=start_metrics_server, args=(metrics_port,), daemon=True).start()
+# In multiprocess mode, serve.py starts the only exporter.
+if not MULTIPROC_DIR:
+    metrics_port = int(os.environ.get("METRICS_PORT", "8000"))
+    threading.Thread(target=start_metrics_server, args=(metrics_port,), daemon=True).start()
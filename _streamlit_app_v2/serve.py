@@ -0,0 +1,112 @@
+# Startup script for the streaming app.
+# We load and warm up the ZIX/spaCy scoring pipeline before Streamlit accepts any traffic. Otherwise the first user after a deploy or restart waits several seconds for the model to load.
+# With APP_WORKERS > 1 we fork additional Streamlit processes after the warm-up. The model pages are then shared copy-on-write between all processes instead of being loaded once per process.
+# If PROMETHEUS_MULTIPROC_DIR is set, all processes write their metrics to that directory and this process serves their aggregate on METRICS_PORT. Otherwise each worker exports its own metrics on METRICS_PORT + its index.
+#
+# Usage: python serve.py [additional streamlit options]
+
+import gc
+import glob
+import os
+import signal
+import sys
+import time
+
+
+def clear_multiprocess_metrics():
+    """Remove the metric files of a previous run. This has to happen before prometheus_client creates the files of this run."""
+    directory = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, "*.db")):
+        os.remove(path)
+
+
+clear_multiprocess_metrics()
+
+# Importing metrics starts the Prometheus exporter, unless metrics of multiple processes are collected. The readiness gauge is 0 until the warm-up has finished.
+from metrics import (  # noqa: E402
+    MULTIPROC_DIR,
+    track_warmup,
+    track_process_exit,
+    start_metrics_server,
+)
+
+APP_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "simplify-language-streaming.py")
+APP_PORT = int(os.environ.get("APP_PORT", "8501"))
+APP_ADDRESS = os.environ.get("APP_ADDRESS", "0.0.0.0")
+APP_WORKERS = int(os.environ.get("APP_WORKERS", "1"))
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "8000"))
+EVENT_LOG_PATH = os.environ.get("EVENT_LOG_PATH", "logs/events.jsonl")
+BACKEND_PROCESS_INDEX = int(os.environ.get("BACKEND_PROCESS_INDEX", "0"))
+
+
+def warm_up_scoring():
+    """Import and warm up the scoring pipeline and export the time it took."""
+    start_time = time.perf_counter()
+    from utils_scoring import warm_up
+
+    warm_up()
+    time_warmup = time.perf_counter() - start_time
+    track_warmup(time_warmup)
+    print(f"Scoring pipeline warmed up in {time_warmup:.1f} seconds")
+
+
+def run_streamlit(port):
+    """Run the Streamlit server in this process, so that it reuses the modules we already loaded."""
+    from streamlit.web import cli as stcli
+
+    sys.argv = [
+        "streamlit",
+        "run",
+        APP_SCRIPT,
+        f"--server.port={port}",
+        f"--server.address={APP_ADDRESS}",
+        *sys.argv[1:],
+    ]
+    sys.exit(stcli.main())
+
+
+def reap_workers(workers, signum, frame):
+    """Collect the forked workers that exited, so that their gauges no longer count."""
+    for pid in list(workers):
+        try:
+            exited, _ = os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            exited = pid
+        if exited:
+            workers.remove(pid)
+            track_process_exit(pid)
+
+
+def main():
+    warm_up_scoring()
+
+    # Move everything we loaded so far into the permanent generation. The garbage collector then does not touch these objects anymore, which would otherwise copy the shared pages into each worker.
+    gc.freeze()
+
+    # The first process serves on APP_PORT, each additional worker on the next port. The load balancer in front of the app distributes the sessions.
+    workers = []
+    for worker_index in range(1, APP_WORKERS):
+        pid = os.fork()
+        if pid == 0:
+            # Metrics of a forked worker are exported on a separate port, unless the exporter of this process serves them.
+            if not MULTIPROC_DIR:
+                start_metrics_server(METRICS_PORT + worker_index)
+            # Each worker writes its own event log, because rotating a file is not safe across processes.
+            root, extension = os.path.splitext(EVENT_LOG_PATH)
+            os.environ["EVENT_LOG_PATH"] = f"{root}-{worker_index}{extension}"
+            # Each worker gets its own share of the slots of the Llama.cpp servers (see BACKEND_PROCESSES).
+            os.environ["BACKEND_PROCESS_INDEX"] = str(BACKEND_PROCESS_INDEX + worker_index)
+            run_streamlit(APP_PORT + worker_index)
+        workers.append(pid)
+
+    if MULTIPROC_DIR:
+        signal.signal(signal.SIGCHLD, lambda *args: reap_workers(workers, *args))
+        start_metrics_server(METRICS_PORT)
+    run_streamlit(APP_PORT)
+
+
+if __name__ == "__main__":
+    main()
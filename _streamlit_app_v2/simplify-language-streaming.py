@@ -9,62 +9,70 @@ st.set_page_config(
 
 import time
 import base64
-import io
-import logging
+import functools
 import numpy as np
-import os
-from datetime import datetime
-from openai import OpenAI
-from dotenv import load_dotenv
-from docx import Document
-from docx.shared import Pt, Inches
-from zix.understandability import get_zix, get_cefr
-from metrics import track_metrics
-import re
-from utils_prompts import (
-    SYSTEM_MESSAGE_VS,
-    SYSTEM_MESSAGE_ES,
-    SYSTEM_MESSAGE_LS,
-    ADDITION_GEMMA,
+import threading
+from utils_scoring import get_zix, get_cefr, IncrementalScorer
+from metrics import (
+    track_metrics,
+    track_cache_lookup,
+    track_degeneration,
+    track_cancellation,
+    track_job_reattachment,
+    GenerationTracker,
 )
-
-logging.basicConfig(
-    filename="app.log",
-    level=logging.INFO,
-    format="%(asctime)s\t%(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
+from utils_cache import ResultCache, make_cache_key
+from utils_chunking import split_into_chunks, simplify_in_parallel
+from utils_routing import BackendRouter
+from utils_budget import BudgetPlanner
+from utils_engine import BackgroundEngine
+from utils_jobs import JobQueue, JobWorkers, DONE, INCOMPLETE, FAILED, CANCELLED
+from utils_docx import simplify_document
+from utils_export import (
+    DEFAULT_OUTPUT_FILENAME,
+    DOWNLOAD_BASE_URL,
+    build_document,
+)
+from utils_rendering import ThrottledRenderer
+from utils_postprocess import StreamCleaner
+from utils_logging import log_simplification
+from utils_degeneration import (
+    DegenerationDetector,
+    DegenerationError,
+    RETRY_ON_DEGENERATION,
+    RETRY_SAMPLING,
+)
+from utils_llm import (
+    MODEL_MAPPING,
+    MODEL_OPTIONS,
+    MODEL_TEMPERATURES,
+    DEFAULT_MODEL,
+    DEFAULT_TEMPERATURE,
+    MAX_TOKENS,
+    SYSTEM_MESSAGES,
+    call_llm,
+    cancel_on_exit,
+    probe_first_token,
+    warm_prefixes,
 )
-
 
 # ---------------------------------------------------------------
 # Constants
 
-# Use a .env file to manage environment variables
-load_dotenv()
-
-# Get Llama.cpp server URLs from environment variables
-LLAMACPP_GPU0_URL = os.getenv("LLAMACPP_GPU0_URL")
-LLAMACPP_GPU1_URL = os.getenv("LLAMACPP_GPU1_URL")
-
-DEFAULT_SYSTEM_MESSAGE = SYSTEM_MESSAGE_VS
+# Models that the router may choose for a request. Each request goes to the healthy backend with the fewest requests in flight.
+ROUTABLE_MODELS = MODEL_OPTIONS
+selected_model = DEFAULT_MODEL
 
-MODEL_MAPPING = {
-    "Gemma 3": LLAMACPP_GPU0_URL,
-    "Phi 4": LLAMACPP_GPU1_URL,
-}
-MODEL_OPTIONS = list(MODEL_MAPPING.keys())
+# Sampling settings of the attempts for a request. A degenerated output is retried once with different settings.
+DEGENERATION_SAMPLINGS = [None, RETRY_SAMPLING] if RETRY_ON_DEGENERATION else [None]
 
+CANCELLED_MESSAGE = "Die Verarbeitung wurde abgebrochen."
 
-# Model-specific temperature settings
-MODEL_TEMPERATURES = {
-    "Gemma 3": 1.0,
-    "Phi 4": 0.5,
-}
+# Shown instead of the score and the download link if the model returned no text.
+EMPTY_RESPONSE_MESSAGE = "Die KI hat keinen Text zurückgegeben. Bitte versuche es erneut."
 
-DEFAULT_MODEL = "Phi 4"
-selected_model = DEFAULT_MODEL
-DEFAULT_TEMPERATURE = 0.5
-MAX_TOKENS = 2048
+# Shown while all Llama.cpp servers are down or overloaded.
+BACKENDS_UNAVAILABLE = "Die KI-Server sind zurzeit nicht erreichbar oder ausgelastet. Bitte versuche es in einer Minute noch einmal."
 
 # Height of the text areas for input and output.
 TEXT_AREA_HEIGHT = 400
@@ -74,16 +82,15 @@ TEXT_AREA_HEIGHT = 400
 # We can increase this. However, we found that users can work and validate better when we nudge to work with shorter texts.
 MAX_CHARS_INPUT = 10_000
 
+# In the long-document mode the text is split into parts that are simplified in parallel. Each part gets its own token budget, so we allow longer inputs.
+MAX_CHARS_INPUT_LONG = 30_000
+
 
 USER_WARNING = """Mit der KlartextZH-App kannst du Texte sprachlich vereinfachen. Dazu schicken wir deinen Text an einen KI-Server, den das AFI im Kanton betreibt. Du kannst daher auch vertrauliche Daten eingeben.\n\n Bitte beachte: **KI-Sprachmodelle machen Fehler.** Die App liefert lediglich einen Entwurf. **Überprüfe das Ergebnis immer.**\n\nGib uns jederzeit [Feedback](mailto:patrick.arnecke@statistik.ji.zh.ch)."""
 
 
-# Constants for the formatting of the Word document that can be downloaded.
-FONT_WORDDOC = "Arial"
-FONT_SIZE_HEADING = 12
-FONT_SIZE_PARAGRAPH = 9
-FONT_SIZE_FOOTER = 7
-DEFAULT_OUTPUT_FILENAME = "Ergebnis.docx"
+# File names of the Word documents that can be downloaded. The formatting is defined in utils_export.py.
+DOCUMENT_OUTPUT_FILENAME = "Vereinfachtes_Dokument.docx"
 ANALYSIS_FILENAME = "Analyse.docx"
 
 
@@ -91,33 +98,57 @@ ANALYSIS_FILENAME = "Analyse.docx"
 LIMIT_HARD = -2
 LIMIT_MEDIUM = 0
 
-DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
-
 
 # ---------------------------------------------------------------
 # Functions
 
 
 @st.cache_resource
-def get_llm_clients():
-    """Create connections to the Llama.cpp servers."""
-    clients = {}
+def get_engine():
+    """Start the generation engine with pooled connections to the Llama.cpp servers. All sessions share it."""
     for model_name, base_url in MODEL_MAPPING.items():
-        if base_url:
-            try:
-                clients[model_name] = OpenAI(
-                    base_url=f"{base_url}/v1",
-                    api_key="not-needed",  # API key is not required for Llama.cpp
-                )
-            except Exception as e:
-                st.error(
-                    f"Verbindung zum KI-Server für {model_name} fehlgeschlagen: {e}"
-                )
-                clients[model_name] = None
-        else:
+        if not base_url:
             st.warning(f"URL für Modell {model_name} ist nicht konfiguriert.")
-            clients[model_name] = None
-    return clients
+    try:
+        return BackgroundEngine(MODEL_MAPPING)
+    except Exception as e:
+        st.error(f"Verbindung zu den KI-Servern fehlgeschlagen: {e}")
+        raise
+
+
+@st.cache_resource
+def get_router():
+    """Start the router that probes the health and latency of the Llama.cpp servers in the background."""
+    # Each backend processes the system messages of all levels once, so that the first requests find them in the KV cache of the slots.
+    return BackendRouter(
+        MODEL_MAPPING, warm_up=warm_prefixes, probe_first_token=probe_first_token
+    ).start()
+
+
+@st.cache_resource
+def get_planner(_router):
+    """Create the token budget planner. It reads the output/input ratios of the levels from the app log once."""
+    return BudgetPlanner(_router)
+
+
+@st.cache_resource
+def get_result_cache():
+    """Open the persistent result cache that is shared by all sessions."""
+    return ResultCache()
+
+
+@st.cache_resource
+def get_jobs():
+    """Open the persistent job queue that is shared by all sessions and processes."""
+    return JobQueue()
+
+
+@st.cache_resource
+def get_job_workers(_jobs, _engine, _router, _planner, _result_cache):
+    """Start the worker threads that run the generation jobs of this process."""
+    return JobWorkers(
+        _jobs, functools.partial(run_job, _engine, _router, _planner, _result_cache)
+    ).start()
 
 
 @st.cache_resource
@@ -133,95 +164,206 @@ def create_project_info(project_info):
     st.markdown(project_info, unsafe_allow_html=True)
 
 
-def call_llm(
-    clients,
+def simplify_chunk(
+    engine,
+    router,
+    planner,
+    cancelled,
+    model_name,
+    system_message,
+    simplification_level,
     text,
-    model_name=DEFAULT_MODEL,
-    system_message=DEFAULT_SYSTEM_MESSAGE,
 ):
-    """Call a Llama.cpp server API using OpenAI SDK for text generation."""
-    client = clients.get(model_name)
-    if not client:
-        return False, f"Verbindung zum KI-Server für {model_name} nicht verfügbar."
+    """Simplify one part of a long document and return the complete, cleaned result. The generation stops early once the event cancelled is set."""
+    max_tokens, error_message = planner.plan(
+        model_name, simplification_level, system_message, text, MAX_TOKENS
+    )
+    if max_tokens is None:
+        return False, error_message
+    for sampling in DEGENERATION_SAMPLINGS:
+        if cancelled.is_set():
+            return False, CANCELLED_MESSAGE
+        tracker = GenerationTracker(model_name, simplification_level)
+        success, stream = call_llm(
+            engine=engine,
+            text=text,
+            model_name=model_name,
+            system_message=system_message,
+            limiter=router.limiter(model_name),
+            tracker=tracker,
+            max_tokens=max_tokens,
+            sampling=sampling,
+        )
+        if success is False:
+            router.report_failure(model_name)
+            return False, stream
+        stream = router.track(model_name, stream)
+        cleaner = StreamCleaner()
+        detector = DegenerationDetector(len(text.split()))
+        reason = None
+        with cancel_on_exit(stream, tracker, max_tokens):
+            for chunk in stream:
+                if cancelled.is_set():
+                    # The script run that waits for this part has ended.
+                    track_cancellation(
+                        model_name, simplification_level, max_tokens - tracker.chunks
+                    )
+                    return False, CANCELLED_MESSAGE
+                if chunk.choices and chunk.choices[0].delta.content is not None:
+                    reason = detector.feed(cleaner.feed(chunk.choices[0].delta.content))
+                    if reason is not None:
+                        break
+        if reason is None:
+            cleaner.finish()
+            return True, cleaner.text.strip()
+        track_degeneration(model_name, simplification_level, reason)
+    return False, str(DegenerationError(reason))
+
+
+def run_job(engine, router, planner, result_cache, jobs, job):
+    """
+    Run a generation job in a worker thread.
 
-    temperature = MODEL_TEMPERATURES.get(model_name, DEFAULT_TEMPERATURE)
+    The cleaned output is written to the job queue while it streams. The worker also stores the result in the result cache and logs it, so nothing is lost if the session that submitted the job is gone.
+    Once every session that submitted the text has moved on, the job is cancelled and the worker stops the generation.
+    """
+    job_id = job["id"]
+    model_name = job["model"]
+    simplification_level = job["simplification_level"]
+    text = job["text"]
+    max_tokens = job["max_tokens"]
 
-    # For Llama.cpp's OpenAI compatible endpoint, the model name in the request
-    # is often ignored as the server is loaded with a single model.
-    # We pass a dummy value like "local-model".
-    model_id = "local-model"
+    cancelled = False
 
-    try:
-        stream = client.chat.completions.create(
-            model=model_id,
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": text.strip()},
-            ],
-            temperature=temperature,
-            max_tokens=MAX_TOKENS,
-            stream=True,
-        )
-        return True, stream
+    def show_queue_position(position, estimated_wait):
+        jobs.set_waiting(job_id, position, estimated_wait)
 
-    except Exception as e:
-        if "timeout" in str(e).lower():
-            return (
-                False,
-                f"Zeitüberschreitung: Die Anfrage dauerte zu lange und hat nicht funktioniert. Bitte versuche es erneut.",
+    def write_output(output):
+        nonlocal cancelled
+        # The queue only updates running jobs. A job that was cancelled in the meantime is not written any more.
+        if not jobs.write(job_id, output):
+            cancelled = True
+
+    for sampling in DEGENERATION_SAMPLINGS:
+        tracker = GenerationTracker(model_name, simplification_level)
+        success, stream = call_llm(
+            engine=engine,
+            text=text,
+            model_name=model_name,
+            system_message=job["system_message"],
+            limiter=router.limiter(model_name),
+            on_wait=show_queue_position,
+            tracker=tracker,
+            max_tokens=max_tokens,
+            sampling=sampling,
+        )
+        if success is False:
+            router.report_failure(model_name)
+            jobs.finish(job_id, FAILED, error=str(stream))
+            log_event(
+                len(text.split()),
+                0,
+                get_zix(text),
+                None,
+                simplification_level,
+                model_name,
+                time.time() - job["created_at"],
+                success,
+                error=str(stream),
+                tracker=tracker,
             )
-        return False, str(e)
+            return
+
+        stream = router.track(model_name, stream)
+        cleaner = StreamCleaner()
+        # We stop the stream as soon as the model gets stuck in a loop.
+        detector = DegenerationDetector(len(text.split()))
+        scorer = IncrementalScorer()
+        # Writing the output for every chunk would rewrite the whole text each time. We write a few times per second, as the app renders it.
+        writer = ThrottledRenderer(write_output)
+        degeneration = None
+        error = None
+        with cancel_on_exit(stream, tracker, max_tokens):
+            try:
+                for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content is not None:
+                        chunk_text = cleaner.feed(chunk.choices[0].delta.content)
+                        if chunk_text == "":
+                            continue
+                        writer.append(chunk_text)
+                        if cancelled:
+                            break
+                        scorer.feed(chunk_text)
+                        degeneration = detector.feed(chunk_text)
+                        if degeneration is not None:
+                            track_degeneration(model_name, simplification_level, degeneration)
+                            break
+            except Exception as e:
+                error = str(e)
+        if cancelled:
+            track_cancellation(model_name, simplification_level, max_tokens - tracker.chunks)
+            return
+        if degeneration is None or sampling is DEGENERATION_SAMPLINGS[-1]:
+            break
+        if not jobs.restart(job_id):
+            return
+
+    if degeneration is None and error is None:
+        scorer.feed(cleaner.finish())
+        # Add a final newline to the end of the response to avoid Streamlit errors with duplicates widget keys.
+        response = cleaner.text + "\n"
+        status = DONE
+    else:
+        response = cleaner.text
+        status = INCOMPLETE
+    jobs.finish(job_id, status, output=response, error=error)
+
+    # A stream that looped or broke off counts as failed. Its output neither goes into the cache, where it would be replayed to other users, nor into the output/input ratios of the token budget.
+    success = status == DONE and bool(response.strip())
+    if success:
+        result_cache.put(job["key"], text, response, simplification_level, model_name)
+        planner.record(simplification_level, len(text.split()), len(response.split()))
+    score_target = scorer.finish()
+    log_event(
+        len(text.split()),
+        len(response.split()),
+        np.round(get_zix(text), 2),
+        np.round(score_target, 2) if score_target is not None else None,
+        simplification_level,
+        model_name,
+        time.time() - job["created_at"],
+        success,
+        error=error,
+        tracker=tracker,
+    )
 
 
 def create_download_link(text_input, response, selected_model, time_processed):
-    """Create a downloadable Word document and download link of the results."""
-    document = Document()
-
-    h1 = document.add_heading("Ausgangstext")
-    p1 = document.add_paragraph("\n" + text_input)
-    h2 = document.add_heading(f"Vereinfachter Text ({selected_model})")
-    p2 = document.add_paragraph(response)
-    timestamp = datetime.now().strftime(DATETIME_FORMAT)
-    footer = document.sections[0].footer
-    footer.paragraphs[
-        0
-    ].text = f"Erstellt am {timestamp} mit der KlartextZH-App des Kantons Zürich.\nModell: {selected_model}\nVerarbeitungszeit: {time_processed:.1f} Sekunden"
-
-    # Set font for all paragraphs.
-    for paragraph in document.paragraphs:
-        for run in paragraph.runs:
-            run.font.name = FONT_WORDDOC
-
-    # Set font size for all headings.
-    for paragraph in [h1, h2]:
-        for run in paragraph.runs:
-            run.font.size = Pt(FONT_SIZE_HEADING)
-
-    # Set font size for all paragraphs.
-    for paragraph in [p1, p2]:
-        for run in paragraph.runs:
-            run.font.size = Pt(FONT_SIZE_PARAGRAPH)
-
-    # Set font and font size for footer.
-    for run in footer.paragraphs[0].runs:
-        run.font.name = "Arial"
-        run.font.size = Pt(FONT_SIZE_FOOTER)
-
-    section = document.sections[0]
-    section.page_width = Inches(8.27)  # Width of A4 paper in inches
-    section.page_height = Inches(11.69)  # Height of A4 paper in inches
-
-    io_stream = io.BytesIO()
-    document.save(io_stream)
+    """Show the download link of the Word document of the results."""
+    caption = "Vereinfachten Text herunterladen"
+    if DOWNLOAD_BASE_URL:
+        # The API builds the document only when the link is opened.
+        handle = result_cache.put_export(
+            text_input, response, selected_model, time_processed
+        )
+        st.markdown(
+            f'<a href="{DOWNLOAD_BASE_URL}/download/{handle}" download="{DEFAULT_OUTPUT_FILENAME}">{caption}</a>',
+            unsafe_allow_html=True,
+        )
+        return
+    document = build_document(
+        text_input, response, selected_model, time_processed, time.time()
+    )
+    show_download_link(document, DEFAULT_OUTPUT_FILENAME, caption)
+
 
+def show_download_link(data, file_name, caption):
+    """Show a download link for a file."""
     # # A download button resets the app. So we use a link instead.
     # https://github.com/streamlit/streamlit/issues/4382#issuecomment-1223924851
     # https://discuss.streamlit.io/t/creating-a-pdf-file-generator/7613?u=volodymyr_holomb
 
-    b64 = base64.b64encode(io_stream.getvalue())
-    file_name = DEFAULT_OUTPUT_FILENAME
-    caption = "Vereinfachten Text herunterladen"
-
+    b64 = base64.b64encode(data)
     download_url = f'<a href="data:application/octet-stream;base64,{b64.decode()}" download="{file_name}">{caption}</a>'
     st.markdown(download_url, unsafe_allow_html=True)
 
@@ -235,6 +377,9 @@ def log_event(
     selected_model,
     time_processed,
     success,
+    cached=False,
+    error=None,
+    tracker=None,
 ):
     """
     Log a text simplification event with relevant metrics.
@@ -256,23 +401,31 @@ def log_event(
             The processing time in seconds required to generate the simplified text.
         success : bool
             Whether the simplification operation was successful.
+        cached : bool
+            Whether the result came from the result cache.
+        error : str or None
+            The error message of a failed model call.
+        tracker : GenerationTracker or None
+            The tracker of the generation, for the timing fields of the event.
 
     Returns:
         None
-            The function logs the information to the configured logging system.
+            The function writes the event to the structured event log.
 
     """
-    log_string = f"{datetime.now().strftime(DATETIME_FORMAT)}"
-    log_string += f"\t{len_text}"
-    log_string += f"\t{len_response}"
-    log_string += f"\t{zix_input}"
-    log_string += f"\t{zix_output}"
-    log_string += f"\t{simplification_level}"
-    log_string += f"\t{selected_model}"
-    log_string += f"\t{time_processed:.3f}"
-    log_string += f"\t{success}"
-
-    logging.info(log_string)
+    log_simplification(
+        len_text,
+        len_response,
+        zix_input,
+        zix_output,
+        simplification_level,
+        selected_model,
+        time_processed,
+        success,
+        cached=cached,
+        error=error,
+        tracker=tracker,
+    )
 
     # Track metrics for Prometheus
     track_metrics(
@@ -290,9 +443,31 @@ def log_event(
 # ---------------------------------------------------------------
 # Main App
 
-clients = get_llm_clients()
+engine = get_engine()
+router = get_router()
+planner = get_planner(router)
+result_cache = get_result_cache()
+jobs = get_jobs()
+get_job_workers(jobs, engine, router, planner, result_cache)
 project_info = get_project_info()
 
+# The URL of a session contains the ID of its last job. If the session reconnects, e.g. after a reload of the page, it attaches to that job and shows its text and result again instead of starting over.
+resumed_job = None
+if "key_jobs_checked" not in st.session_state:
+    st.session_state.key_jobs_checked = True
+    resumed_job_id = st.query_params.get("job")
+    resumed_job = jobs.get(resumed_job_id) if resumed_job_id else None
+    if resumed_job is not None:
+        track_job_reattachment()
+        st.session_state.key_textinput = resumed_job["text"]
+        st.session_state.key_level = resumed_job["simplification_level"]
+st.session_state.setdefault("key_level", "Einfache Sprache")
+
+# Backends that are up and not overloaded, as measured by the background probes of the router. Without any, the buttons are disabled, so that users do not wait for a timeout.
+available_models = [
+    name for name in router.available_backends(ROUTABLE_MODELS) if engine.has_backend(name)
+]
+
 with st.sidebar:
     st.markdown(
         "## 🙋‍♀️ KlartextZH - Sprache einfach vereinfachen", unsafe_allow_html=True
@@ -300,6 +475,20 @@ with st.sidebar:
     st.markdown(USER_WARNING, unsafe_allow_html=True)
     if st.button("Details zur App", use_container_width=True):
         create_project_info(project_info)
+    long_document_mode = st.toggle(
+        "Langes Dokument",
+        help="Teilt lange Texte in Abschnitte auf und vereinfacht diese parallel auf allen KI-Servern. Damit kannst du auch längere Texte eingeben.",
+    )
+    uploaded_document = st.file_uploader(
+        "Word-Dokument vereinfachen",
+        type=["docx"],
+        help="Vereinfacht alle Absätze eines Word-Dokuments. Überschriften und die Reihenfolge der Absätze bleiben erhalten.",
+    )
+    do_document = st.button(
+        "Dokument vereinfachen",
+        use_container_width=True,
+        disabled=uploaded_document is None or not available_models,
+    )
     # selected_model = st.radio(
     #     "Sprachmodell:",
     #     options=MODEL_OPTIONS,
@@ -310,8 +499,7 @@ with st.sidebar:
 button_cols = st.columns([2, 4])
 
 with button_cols[0]:
-    # Disable button if client connection for the selected model failed
-    simplify_disabled = clients.get(selected_model) is None
+    simplify_disabled = not available_models
     do_simplification = st.button(
         "Vereinfachen",
         use_container_width=True,
@@ -324,27 +512,83 @@ with button_cols[1]:
     simplification_level = st.radio(
         label="Grad der Vereinfachung",
         options=["Verständliche Sprache", "Einfache Sprache", "Leichte Sprache"],
-        index=1,
+        key="key_level",
         help="**«Verständliche Sprache»** überarbeitet den Text vorsichtiger und zielt auf Sprachniveau B2. **«Einfache Sprache»** folgt den Regeln für Einfache Sprache (B1 bis A2) und **«Leichte Sprache»** folgt den Regeln für Leichte Sprache (A2 bis A1).",
         horizontal=True,
     )
 
-st.markdown("---")
+if not available_models:
+    st.warning(BACKENDS_UNAVAILABLE)
 
-system_messages = {
-    "Verständliche Sprache": SYSTEM_MESSAGE_VS,
-    "Einfache Sprache": SYSTEM_MESSAGE_ES,
-    "Leichte Sprache": SYSTEM_MESSAGE_LS,
-}
+st.markdown("---")
 
-system_message = system_messages[simplification_level]
+system_message = SYSTEM_MESSAGES[simplification_level]
 # if "Gemma" in selected_model:
 #     system_message += ADDITION_GEMMA
 
+# Simplify an uploaded Word document paragraph by paragraph.
+if do_document:
+    start_time = time.time()
+    progress_bar = st.progress(0.0, text="Dein Dokument wird vereinfacht...")
+
+    def show_document_progress(done, total, words_per_second, failures):
+        progress_bar.progress(
+            done / total,
+            text=f"{done} von {total} Absätzen verarbeitet ({words_per_second:.0f} Wörter pro Sekunde)",
+        )
+
+    # Models that simplified at least one paragraph, for the event log.
+    document_models = set()
+
+    def simplify_paragraph(text):
+        model_name = router.pick(ROUTABLE_MODELS) or DEFAULT_MODEL
+        document_models.add(model_name)
+        return simplify_chunk(
+            engine,
+            router,
+            planner,
+            cancelled,
+            model_name,
+            system_message,
+            simplification_level,
+            text,
+        )
+
+    # Set when the script run ends, so that the worker threads stop their generations, too.
+    cancelled = threading.Event()
+    try:
+        document_bytes, document_failures, document_words, document_output_words = simplify_document(
+            uploaded_document, simplify_paragraph, on_progress=show_document_progress
+        )
+    finally:
+        cancelled.set()
+    time_processed = time.time() - start_time
+    # Documents are not scored. Scoring a whole document would take longer than its simplification.
+    log_event(
+        document_words,
+        document_output_words,
+        None,
+        None,
+        simplification_level,
+        " + ".join(sorted(document_models)) or DEFAULT_MODEL,
+        time_processed,
+        document_failures == 0,
+    )
+
+    if document_failures > 0:
+        st.warning(
+            f"{document_failures} Absätze konnten nicht vereinfacht werden. Sie stehen unverändert im Dokument."
+        )
+    show_download_link(
+        document_bytes, DOCUMENT_OUTPUT_FILENAME, "Vereinfachtes Dokument herunterladen"
+    )
+    st.caption(f"Verarbeitet in {time_processed:.1f} Sekunden.")
+    st.stop()
+
 source_text = st.text_area(
     "Ausgangstext, den du vereinfachen möchtest",
     height=TEXT_AREA_HEIGHT,
-    max_chars=MAX_CHARS_INPUT,
+    max_chars=MAX_CHARS_INPUT_LONG if long_document_mode else MAX_CHARS_INPUT,
     key="key_textinput",
 )
 
@@ -381,109 +625,276 @@ if len(word_count) <= 5:
 st.markdown("---")
 
 # Start processing
-if do_simplification:
+if do_simplification or resumed_job is not None:
     start_time = time.time()
 
-    with st.spinner("Text wird verarbeitet..."):
-        success, stream = call_llm(
-            clients=clients,
-            text=source_text,
-            model_name=selected_model,
-            system_message=system_message,
-        )
-
-    if success is False:
-        error_message = str(stream).replace("'", "")[
-            :200
-        ]  # Limit length and remove quotes for display
-        st.error(
-            f"Es ist ein Fehler bei der Abfrage aufgetreten: {error_message}. Bitte versuche es erneut."
-        )
-        time_processed = time.time() - start_time
-        error_message_cleaned_for_log = (
-            error_message.replace("\t", " ").replace("\n", " ").replace('"', "")
-        )
-        log_event(
-            len(source_text.split()),
-            f"Error from model call. {error_message_cleaned_for_log}",
-            score_source,
-            None,
-            simplification_level,
-            selected_model,
-            time_processed,
-            success,
-        )
-
-        st.stop()
+    if resumed_job is not None:
+        # The reattached job continues on its model.
+        use_parallel = False
+        selected_model = model_label = resumed_job["model"]
+        cached_response = None
+    else:
+        # In the long-document mode the parts of the text are spread over all available servers.
+        chunks = split_into_chunks(source_text) if long_document_mode else [source_text]
+        parallel_models = [
+            name for name in router.available_backends(ROUTABLE_MODELS) if engine.has_backend(name)
+        ]
+        use_parallel = len(chunks) > 1 and len(parallel_models) > 0
+        if use_parallel:
+            model_label = " + ".join(parallel_models)
+            cache_candidates = [model_label]
+        else:
+            # Route the request to the least loaded healthy backend. If none is healthy, we still try the default model.
+            selected_model = router.pick(ROUTABLE_MODELS) or DEFAULT_MODEL
+            model_label = selected_model
+            # A cached result of any of the allowed models will do.
+            cache_candidates = [selected_model] + [
+                name for name in ROUTABLE_MODELS if name != selected_model
+            ]
+
+        # Identical requests are answered from the result cache without calling the model.
+        cache_keys = {
+            cache_model: make_cache_key(
+                source_text,
+                simplification_level,
+                cache_model,
+                system_message,
+                MODEL_TEMPERATURES.get(cache_model, DEFAULT_TEMPERATURE),
+                MAX_TOKENS,
+            )
+            for cache_model in cache_candidates
+        }
+        cached_response = None
+        for cache_model, cache_key in cache_keys.items():
+            cached_response = result_cache.get(cache_key)
+            if cached_response is not None:
+                model_label = cache_model
+                break
+        track_cache_lookup(cached_response is not None, simplification_level)
+        if cached_response is None and not router.available_backends(ROUTABLE_MODELS):
+            # The servers went down or got overloaded after the page was drawn.
+            st.error(BACKENDS_UNAVAILABLE)
+            st.stop()
 
     placeholder = st.empty()
-    response = ""
-    with st.spinner("Ich vereinfache deinen Text..."):
-        while True:
-            try:
-                chunk = next(stream)
-                if chunk.choices[0].delta.content is not None:
-                    chunk_text = chunk.choices[0].delta.content
-                    # Often the models return the German letter ß. Replace it with the Swiss German equivalent ss.
-                    # Also remove markdown formatting **bold** and # headings.
-                    chunk_text = chunk_text.replace("ß", "ss")
-                    chunk_text = re.sub(r"\*\*", " ", chunk_text)
-                    chunk_text = re.sub(r"^#{1,7}", "", chunk_text, flags=re.MULTILINE)
-                    if chunk_text == "":
-                        continue
-                    response += chunk_text
+    placeholder_score = st.empty()
+    # We score the output while it streams, so that the final score is ready when the stream ends.
+    scorer = IncrementalScorer()
+    # Only the single stream runs as a job. Its worker logs the result.
+    job = None
+    if cached_response is not None:
+        success = True
+        response = cached_response
+        scorer.feed(response)
+        placeholder.text_area(
+            "Dein vereinfachter Text", value=response, height=TEXT_AREA_HEIGHT
+        )
+    elif use_parallel:
+        # Set when the script run ends or a part fails, so that the worker threads stop their generations, too.
+        cancelled = threading.Event()
+        backends = {
+            model_name: functools.partial(
+                simplify_chunk,
+                engine,
+                router,
+                planner,
+                cancelled,
+                model_name,
+                system_message,
+                simplification_level,
+            )
+            for model_name in parallel_models
+        }
+        response = ""
+        stream_completed = True
+        try:
+            with st.spinner(f"Ich vereinfache deinen Text in {len(chunks)} Abschnitten..."):
+                # The parts arrive in their original order. We show each part as soon as it and all parts before it are done.
+                for success, chunk_text in simplify_in_parallel(chunks, backends):
+                    if success is False:
+                        error_message = str(chunk_text).replace("'", "")[:200]
+                        st.error(
+                            f"Es ist ein Fehler bei der Abfrage aufgetreten: {error_message}. Bitte versuche es erneut."
+                        )
+                        stream_completed = False
+                        break
+                    response += chunk_text + "\n\n"
                     placeholder.text_area(
                         "Dein vereinfachter Text", value=response, height=TEXT_AREA_HEIGHT
                     )
-            except StopIteration:
-                # Finally, remove leading spaces from each line in the response. We cannot remove these during streaming, since the trailing space is not included in the chunk with the markdown markup but in the next chunk.
-                response_lines = response.split("\n")
-                response = "\n".join(
-                    line[1:] if line.startswith(" ") and not line.startswith("  ") else line for line in response_lines
+                    if scorer.feed(chunk_text + "\n\n"):
+                        placeholder_score.caption(
+                            f"Verständlichkeit bisher: etwa Sprachniveau {get_cefr(scorer.score)}"
+                        )
+        finally:
+            cancelled.set()
+        if not stream_completed:
+            # A failed part leaves an incomplete text. We neither score nor offer it for download.
+            log_event(
+                len(source_text.split()),
+                0,
+                score_source,
+                None,
+                simplification_level,
+                model_label,
+                time.time() - start_time,
+                False,
+                error=str(chunk_text),
+            )
+            st.stop()
+        # Add a final newline to the end of the response to avoid Streamlit errors with duplicates widget keys.
+        response = response.strip() + "\n"
+        placeholder.text_area(
+            "Dein vereinfachter Text", value=response, height=TEXT_AREA_HEIGHT
+        )
+        # Only complete responses go into the cache. A failed part has stopped the run above.
+        if response.strip():
+            result_cache.put(
+                cache_keys[model_label],
+                source_text,
+                response,
+                simplification_level,
+                model_label,
+            )
+    else:
+        placeholder_queue = st.empty()
+
+        def show_queue_position(position, estimated_wait):
+            placeholder_queue.info(
+                f"Die KI-Server sind gerade ausgelastet. Du bist an Position {position} der Warteschlange. Geschätzte Wartezeit: etwa {max(1, round(estimated_wait))} Sekunden."
+            )
+
+        if resumed_job is not None:
+            job_id = resumed_job["id"]
+        else:
+            with st.spinner("Text wird verarbeitet..."):
+                max_tokens, error_message = planner.plan(
+                    selected_model, simplification_level, system_message, source_text, MAX_TOKENS
                 )
-                # Add a final newline to the end of the response to avoid Streamlit errors with duplicates widget keys.
-                response = response + "\n"
-                placeholder.text_area(
-                    "Dein vereinfachter Text", value=response, height=TEXT_AREA_HEIGHT
+            if max_tokens is None:
+                st.error(error_message)
+                st.stop()
+            # The generation runs in a worker. If the same text is already being simplified, we get that job. The previous job of the session is cancelled unless another session follows it.
+            job_id = jobs.submit(
+                cache_keys[model_label],
+                source_text,
+                simplification_level,
+                selected_model,
+                system_message,
+                max_tokens,
+                replaces=st.query_params.get("job"),
+            )
+            st.query_params["job"] = job_id
+
+        # Re-rendering the text area for every chunk would send the whole text again each time. The renderer coalesces the chunks into a few frames per second.
+        def render_response(text):
+            placeholder.text_area(
+                "Dein vereinfachter Text", value=text, height=TEXT_AREA_HEIGHT
+            )
+
+        renderer = ThrottledRenderer(render_response)
+        attempt = None
+        # If Streamlit stops the script run, e.g. because the user reloaded the page or closed the tab, the job keeps running and the session can attach to it again.
+        with st.spinner("Ich vereinfache deinen Text..."):
+            for job in jobs.follow(job_id):
+                if job["attempt"] != attempt:
+                    if attempt is not None:
+                        # The worker started over, e.g. because the model repeated itself.
+                        st.info(
+                            "Die KI hat sich wiederholt. Ich versuche es noch einmal mit anderen Einstellungen..."
+                        )
+                        renderer = ThrottledRenderer(render_response)
+                        scorer = IncrementalScorer()
+                        placeholder_score.empty()
+                    attempt = job["attempt"]
+                if job["queue_position"]:
+                    show_queue_position(job["queue_position"], job["estimated_wait"])
+                else:
+                    placeholder_queue.empty()
+                if job["output"]:
+                    renderer.append(job["output"])
+                    if scorer.feed(job["output"]):
+                        placeholder_score.caption(
+                            f"Verständlichkeit bisher: etwa Sprachniveau {get_cefr(scorer.score)}"
+                        )
+        placeholder_queue.empty()
+
+        if job is None or job["status"] == FAILED:
+            error = job["error"] if job is not None else "Der Auftrag wurde nicht gefunden."
+            error_message = str(error).replace("'", "")[
+                :200
+            ]  # Limit length and remove quotes for display
+            st.error(
+                f"Es ist ein Fehler bei der Abfrage aufgetreten: {error_message}. Bitte versuche es erneut."
+            )
+            st.stop()
+        if job["status"] == CANCELLED:
+            # The session submitted another text in a second tab of the same URL in the meantime.
+            st.warning(CANCELLED_MESSAGE)
+            st.stop()
+
+        # The worker replaces the output with the final, cleaned text when the job finishes. We show and score that text instead of the parts we followed.
+        job = jobs.get(job_id)
+        success = job["status"] == DONE
+        response = job["output"]
+        if response != renderer.text:
+            scorer = IncrementalScorer()
+            scorer.feed(response)
+        render_response(response)
+        if job["status"] == INCOMPLETE:
+            if job["error"]:
+                st.error(f"Fehler beim Streamen des Textes: {job['error']}")
+            else:
+                st.warning(
+                    "Die KI hat sich wiederholt und wurde gestoppt. Der Text ist unvollständig. Bitte versuche es erneut oder kürze deinen Text."
                 )
-                break
-            except Exception as e:
-                st.error(f"Fehler beim Streamen des Textes: {str(e)}")
-                break
 
-    if response != "":
-        score_target = get_zix(response)
+    score_target = scorer.finish()
+    placeholder_score.empty()
+    time_processed = time.time() - start_time
+    if job is not None:
+        time_processed = job["finished_at"] - job["created_at"]
+
+    # A stream that broke off before its first words leaves nothing to score or to export.
+    if score_target is None or response.strip() == "":
+        st.warning(EMPTY_RESPONSE_MESSAGE)
+    else:
         score_target_rounded = int(np.round(score_target, 0) + 0)
         cefr_target = get_cefr(score_target)
 
-    if score_target < LIMIT_HARD:
-        st.markdown(
-            f"Dein vereinfachter Text ist **:red[schwer verständlich]** und entspricht etwa dem **:red[Sprachniveau {cefr_target}]**."
-        )
-    elif score_target >= LIMIT_HARD and score_target < LIMIT_MEDIUM:
-        st.markdown(
-            f"Dein Ausgangstext ist **:orange[durchschnittlich verständlich]** und entspricht etwa dem **:orange[Sprachniveau {cefr_target}]**."
-        )
-    else:
-        st.markdown(
-            f"Dein vereinfachter Text ist **:green[gut verständlich]** und entspricht etwa dem **:green[Sprachniveau {cefr_target}]**."
-        )
-        
-    time_processed = time.time() - start_time
+        if score_target < LIMIT_HARD:
+            st.markdown(
+                f"Dein vereinfachter Text ist **:red[schwer verständlich]** und entspricht etwa dem **:red[Sprachniveau {cefr_target}]**."
+            )
+        elif score_target >= LIMIT_HARD and score_target < LIMIT_MEDIUM:
+            st.markdown(
+                f"Dein Ausgangstext ist **:orange[durchschnittlich verständlich]** und entspricht etwa dem **:orange[Sprachniveau {cefr_target}]**."
+            )
+        else:
+            st.markdown(
+                f"Dein vereinfachter Text ist **:green[gut verständlich]** und entspricht etwa dem **:green[Sprachniveau {cefr_target}]**."
+            )
 
-    create_download_link(
-        st.session_state.key_textinput, response, selected_model, time_processed
-    )
+        create_download_link(
+            st.session_state.key_textinput, response, model_label, time_processed
+        )
     st.caption(f"Verarbeitet in {time_processed:.1f} Sekunden.")
 
-    log_event(
-        len(source_text.split()),
-        len(response.split()),
-        np.round(score_source, 2),
-        np.round(score_target, 2),
-        simplification_level,
-        selected_model,
-        time_processed,
-        success,
-    )
+    # The worker of a job has already recorded and logged its result.
+    if job is None:
+        if success and cached_response is None and response.strip():
+            planner.record(
+                simplification_level, len(source_text.split()), len(response.split())
+            )
+        log_event(
+            len(source_text.split()),
+            len(response.split()),
+            np.round(score_source, 2),
+            np.round(score_target, 2) if score_target is not None else None,
+            simplification_level,
+            model_label,
+            time_processed,
+            success,
+            cached=cached_response is not None,
+        )
     st.stop()
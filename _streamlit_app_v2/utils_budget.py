@@ -0,0 +1,144 @@
+# Token budget of a request.
+# Without a budget every request may generate MAX_TOKENS tokens. A generation that goes wrong then holds a slot of the server for a long time, even if the input had only 20 words. We therefore set max_tokens from the length of the input and from how much longer than the input the outputs of a level usually are. The ratios come from the word counts in the event log (and in the old tab-separated app log, if it still exists) and are updated with every finished request.
+# Inputs that do not fit into the context window of the server together with their expected output are rejected before they reach the GPU.
+
+import itertools
+import json
+import math
+import os
+import threading
+import urllib.request
+from collections import deque
+from functools import lru_cache
+
+from metrics import track_budget
+from utils_logging import EVENT_LOG_PATH, read_events
+
+
+# Output/input word ratios we assume per level until we have enough observations.
+DEFAULT_OUTPUT_RATIOS = {
+    "Verständliche Sprache": 1.3,
+    "Einfache Sprache": 1.5,
+    "Leichte Sprache": 2.0,
+}
+
+# We use this quantile of the observed ratios of a level, so that only unusually long outputs hit the budget.
+RATIO_QUANTILE = 0.95
+
+# Number of recent observations per level and the minimum number before we trust them.
+RATIO_WINDOW = 1_000
+MIN_RATIO_SAMPLES = 20
+
+# Factor on top of the expected output length and fixed number of tokens that every request gets.
+BUDGET_HEADROOM = 1.25
+MIN_OUTPUT_TOKENS = 128
+
+# Tokens the chat template adds around the system message and the user text.
+CHAT_TEMPLATE_TOKENS = 32
+
+# Rough number of characters per token for German text, if the server cannot count the tokens.
+CHARS_PER_TOKEN = 3
+
+TOKENIZE_TIMEOUT = 5
+
+# Tab-separated log of the app before the event log was introduced.
+APP_LOG_PATH = os.getenv("APP_LOG_PATH", "app.log")
+
+
+@lru_cache(maxsize=1_024)
+def tokenize(base_url, text):
+    """Count the tokens of a text with the /tokenize endpoint of a Llama.cpp server. Raises on errors, so that failures are not cached."""
+    request = urllib.request.Request(
+        f"{base_url}/tokenize",
+        data=json.dumps({"content": text}).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=TOKENIZE_TIMEOUT) as response:
+        return len(json.load(response)["tokens"])
+
+
+def read_logged_ratios(path=APP_LOG_PATH):
+    """Yield (simplification_level, output_words / input_words) for all successful requests in the tab-separated app log."""
+    if not os.path.exists(path):
+        return
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 9 or fields[-1] != "True":
+                continue
+            input_words, output_words, level = fields[-8], fields[-7], fields[-4]
+            if input_words.isdigit() and output_words.isdigit() and int(input_words) > 0:
+                yield level, int(output_words) / int(input_words)
+
+
+def read_event_ratios(path=EVENT_LOG_PATH):
+    """Yield (simplification_level, output_words / input_words) for all successful, generated requests in the event log."""
+    for event in read_events(path):
+        if not event.get("success") or event.get("cached"):
+            continue
+        input_words, output_words = event.get("input_words"), event.get("output_words")
+        if isinstance(input_words, int) and isinstance(output_words, int) and input_words > 0:
+            yield event.get("level"), output_words / input_words
+
+
+class BudgetPlanner:
+    """Plan max_tokens of a request and reject inputs that do not fit into the context."""
+
+    def __init__(self, router, log_path=APP_LOG_PATH, event_log_path=EVENT_LOG_PATH):
+        self.router = router
+        self._lock = threading.Lock()
+        self._ratios = {
+            level: deque(maxlen=RATIO_WINDOW) for level in DEFAULT_OUTPUT_RATIOS
+        }
+        # The old log comes first, so that the recent events stay in the window.
+        for level, ratio in itertools.chain(
+            read_logged_ratios(log_path), read_event_ratios(event_log_path)
+        ):
+            if level in self._ratios:
+                self._ratios[level].append(ratio)
+
+    def record(self, simplification_level, input_words, output_words):
+        """Add the word counts of a finished request to the observed ratios."""
+        if simplification_level in self._ratios and input_words > 0:
+            with self._lock:
+                self._ratios[simplification_level].append(output_words / input_words)
+
+    def output_ratio(self, simplification_level):
+        """Return the output/input ratio we plan with for a level."""
+        with self._lock:
+            ratios = sorted(self._ratios.get(simplification_level, ()))
+        if len(ratios) < MIN_RATIO_SAMPLES:
+            return DEFAULT_OUTPUT_RATIOS.get(simplification_level, max(DEFAULT_OUTPUT_RATIOS.values()))
+        return ratios[min(len(ratios) - 1, int(RATIO_QUANTILE * len(ratios)))]
+
+    def count_tokens(self, model_name, text):
+        """Count the tokens of a text on the backend of a model, or estimate them if the backend does not answer."""
+        backend = self.router.backends.get(model_name)
+        if backend is not None:
+            try:
+                return tokenize(backend.base_url, text)
+            except Exception:
+                pass
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+    def plan(self, model_name, simplification_level, system_message, text, max_tokens):
+        """Return (max_tokens, None) with a budget of at most max_tokens, or (None, error_message) if the input is too long for the context of the server."""
+        input_tokens = self.count_tokens(model_name, text)
+        prompt_tokens = (
+            input_tokens + self.count_tokens(model_name, system_message) + CHAT_TEMPLATE_TOKENS
+        )
+        expected_tokens = math.ceil(input_tokens * self.output_ratio(simplification_level))
+        budget = min(max_tokens, math.ceil(expected_tokens * BUDGET_HEADROOM) + MIN_OUTPUT_TOKENS)
+
+        context_size = self.router.context_size(model_name)
+        if context_size is not None:
+            available = context_size - prompt_tokens
+            if available < min(budget, expected_tokens):
+                track_budget(simplification_level, None)
+                return None, (
+                    "Dein Text ist zu lang für das Kontextfenster des KI-Modells. Bitte kürze ihn oder teile ihn in mehrere Abschnitte auf."
+                )
+            budget = min(budget, available)
+
+        track_budget(simplification_level, budget)
+        return budget, None
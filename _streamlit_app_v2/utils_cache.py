@@ -0,0 +1,167 @@
+# Persistent cache for simplification results.
+# Many users submit the same standard letters and templates again and again. Instead of sending these texts to the Llama.cpp servers each time, we store finished results in a small SQLite database. The database lives on disk, so the cache survives restarts and is shared by all sessions and processes that use the same file.
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+
+# Default location and size of the cache. Both can be overridden with environment variables.
+DEFAULT_CACHE_PATH = "cache/results.sqlite"
+DEFAULT_CACHE_MAX_ENTRIES = 5_000
+
+_RE_INLINE_WHITESPACE = re.compile(r"[ \t\u00a0]+")
+
+
+def normalize_text(text):
+    """Normalize the input text so that trivial differences do not lead to cache misses."""
+    text = unicodedata.normalize("NFC", text)
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    lines = [_RE_INLINE_WHITESPACE.sub(" ", line).strip() for line in text.split("\n")]
+    return "\n".join(lines).strip()
+
+
+def hash_text(text):
+    """Return a stable hash of a text, e.g. of a system message."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def make_cache_key(
+    text, simplification_level, model_name, system_message, temperature, max_tokens
+):
+    """
+    Build the cache key for a simplification request.
+
+    The key covers everything that influences the result: the normalized input text, the level of simplification, the model, the system message and the sampling settings. If we change the prompts in utils_prompts.py, the old entries are simply not found anymore and age out of the cache.
+    """
+    parts = [
+        normalize_text(text),
+        simplification_level,
+        model_name,
+        hash_text(system_message),
+        f"{temperature:.3f}",
+        str(max_tokens),
+    ]
+    return hash_text("\x1f".join(parts))
+
+
+class ResultCache:
+    """Size-bounded SQLite cache for simplification results with least-recently-used eviction."""
+
+    def __init__(self, path=None, max_entries=None):
+        self.path = path or os.getenv("RESULT_CACHE_PATH", DEFAULT_CACHE_PATH)
+        self.max_entries = max_entries or int(
+            os.getenv("RESULT_CACHE_MAX_ENTRIES", DEFAULT_CACHE_MAX_ENTRIES)
+        )
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Streamlit runs each session in its own thread. We share one connection and serialize access with a lock.
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None, timeout=10
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                source_text TEXT NOT NULL,
+                response TEXT NOT NULL,
+                simplification_level TEXT NOT NULL,
+                model TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_results_last_access ON results (last_access)"
+        )
+        # Results that can be downloaded as a Word document. The headless API builds the document when the download link is opened.
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS exports (
+                handle TEXT PRIMARY KEY,
+                source_text TEXT NOT NULL,
+                response TEXT NOT NULL,
+                model TEXT NOT NULL,
+                time_processed REAL NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_exports_created_at ON exports (created_at)"
+        )
+
+    def get(self, key):
+        """Return the cached response for a key or None if there is none."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+        return row[0]
+
+    def put(self, key, source_text, response, simplification_level, model_name):
+        """Store a response and evict the least recently used entries if the cache is full."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, source_text, response, simplification_level, model_name, now, now),
+            )
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()
+            if count > self.max_entries:
+                self._conn.execute(
+                    """
+                    DELETE FROM results WHERE key IN (
+                        SELECT key FROM results ORDER BY last_access ASC LIMIT ?
+                    )
+                    """,
+                    (count - self.max_entries,),
+                )
+
+    def put_export(self, source_text, response, model_name, time_processed):
+        """Store a result for the Word export and return its download handle. The same result always gets the same handle."""
+        handle = hash_text("\x1f".join([source_text, response, model_name]))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO exports VALUES (?, ?, ?, ?, ?, ?)",
+                (handle, source_text, response, model_name, time_processed, time.time()),
+            )
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM exports").fetchone()
+            if count > self.max_entries:
+                self._conn.execute(
+                    """
+                    DELETE FROM exports WHERE handle IN (
+                        SELECT handle FROM exports ORDER BY created_at ASC LIMIT ?
+                    )
+                    """,
+                    (count - self.max_entries,),
+                )
+        return handle
+
+    def get_export(self, handle):
+        """Return (source_text, response, model, time_processed, created_at) of an exported result or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT source_text, response, model, time_processed, created_at FROM exports WHERE handle = ?",
+                (handle,),
+            ).fetchone()
+        return tuple(row) if row is not None else None
+
+    def __len__(self):
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()
+        return count
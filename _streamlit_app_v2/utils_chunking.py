@@ -0,0 +1,70 @@
+# Parallel simplification of long documents.
+# A long text keeps a single Llama.cpp server busy for a long time while the other server sits idle. In the long-document mode we split the text at paragraph boundaries and simplify the parts on all available servers at the same time. The results are put back together in their original order.
+
+import queue
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Maximum number of characters per part. Parts are built from whole paragraphs, so a single very long paragraph can exceed this limit.
+CHUNK_MAX_CHARS = 2_500
+
+_RE_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+
+
+def split_into_chunks(text, max_chars=CHUNK_MAX_CHARS):
+    """Split a text at paragraph boundaries into parts of at most max_chars characters."""
+    paragraphs = [p.strip() for p in _RE_PARAGRAPH_BREAK.split(text) if p.strip()]
+    chunks = []
+    current = []
+    current_len = 0
+    for paragraph in paragraphs:
+        if current and current_len + len(paragraph) > max_chars:
+            chunks.append("\n\n".join(current))
+            current = []
+            current_len = 0
+        current.append(paragraph)
+        current_len += len(paragraph) + 2
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def simplify_in_parallel(chunks, backends):
+    """
+    Simplify the parts of a text on several backends at the same time.
+
+    Args:
+        chunks : list of str
+            The parts of the text in their original order.
+        backends : dict
+            Maps a backend name to a function that takes a part and returns a tuple (success, text).
+
+    Yields:
+        tuple
+            (success, text) for each part in the original order. A part is yielded as soon as it and all parts before it are finished.
+    """
+    # Each backend works on one part at a time. A free backend takes the next waiting part.
+    free_backends = queue.Queue()
+    for name in backends:
+        free_backends.put(name)
+
+    def run(chunk):
+        name = free_backends.get()
+        try:
+            return backends[name](chunk)
+        except Exception as e:
+            return False, str(e)
+        finally:
+            free_backends.put(name)
+
+    executor = ThreadPoolExecutor(
+        max_workers=len(backends), thread_name_prefix="simplify-chunk"
+    )
+    try:
+        futures = [executor.submit(run, chunk) for chunk in chunks]
+        for future in futures:
+            yield future.result()
+    finally:
+        # If the caller stops early, e.g. after an error, we drop the parts that have not started yet.
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,84 @@
+# Detection of degenerated model output.
+# Small quantized models sometimes get stuck in a loop and repeat the same sentence until they reach max_tokens. The user then watches garbage and the slot of the server stays busy. We watch the output while it streams and stop the stream as soon as it repeats itself or grows far longer than the input.
+# Leichte Sprache repeats short phrases on purpose, so we only look at long word sequences.
+
+import os
+from collections import Counter, deque
+
+
+# Length of the word sequences (n-grams) we compare.
+NGRAM_SIZE = 8
+
+# A single n-gram that occurs this often means the model repeats itself.
+MAX_NGRAM_REPEATS = 4
+
+# Share of repeated n-grams among the last REPETITION_WINDOW words above which we consider the output a loop.
+REPETITION_WINDOW = 120
+MAX_REPEATED_SHARE = 0.5
+
+# The output may be at most MAX_LENGTH_RATIO times as long as the input, plus MIN_OUTPUT_WORDS words for very short inputs.
+MAX_LENGTH_RATIO = 4
+MIN_OUTPUT_WORDS = 300
+
+# Retry a degenerated generation once with these sampling settings.
+RETRY_ON_DEGENERATION = os.getenv("RETRY_ON_DEGENERATION", "true").lower() == "true"
+RETRY_SAMPLING = {"temperature": 0.7, "frequency_penalty": 0.5, "presence_penalty": 0.3}
+
+
+class DegenerationError(Exception):
+    """Raised when a stream is stopped because its output degenerated."""
+
+    def __init__(self, reason):
+        super().__init__(f"Die Ausgabe des Modells ist unbrauchbar geworden ({reason}).")
+        self.reason = reason
+
+
+class DegenerationDetector:
+    """Watch a stream of output text for repetition loops and runaway length."""
+
+    def __init__(self, input_words):
+        self.max_words = input_words * MAX_LENGTH_RATIO + MIN_OUTPUT_WORDS
+        self.words = 0
+        self._partial = ""
+        self._recent = deque(maxlen=NGRAM_SIZE)
+        self._counts = Counter()
+        self._repeated = deque(maxlen=REPETITION_WINDOW)
+        self._repeated_count = 0
+
+    def feed(self, text):
+        """Add a chunk of output. Returns the reason ("repetition" or "length") if the output degenerated, otherwise None."""
+        text = self._partial + text
+        words = text.split()
+        # The last word may continue in the next chunk.
+        if words and not text[-1].isspace():
+            self._partial = words.pop()
+        else:
+            self._partial = ""
+        for word in words:
+            reason = self._add_word(word)
+            if reason is not None:
+                return reason
+        return None
+
+    def _add_word(self, word):
+        self.words += 1
+        if self.words > self.max_words:
+            return "length"
+        self._recent.append(word.lower())
+        if len(self._recent) < NGRAM_SIZE:
+            return None
+        ngram = tuple(self._recent)
+        self._counts[ngram] += 1
+        repeated = self._counts[ngram] > 1
+        if len(self._repeated) == self._repeated.maxlen:
+            self._repeated_count -= self._repeated[0]
+        self._repeated.append(repeated)
+        self._repeated_count += repeated
+        if self._counts[ngram] >= MAX_NGRAM_REPEATS:
+            return "repetition"
+        if (
+            len(self._repeated) == REPETITION_WINDOW
+            and self._repeated_count > MAX_REPEATED_SHARE * REPETITION_WINDOW
+        ):
+            return "repetition"
+        return None
@@ -0,0 +1,159 @@
+# Simplification of whole Word documents.
+# Staff often copy text paragraph by paragraph from Word documents into the app. Instead, they can upload the document. We read its paragraphs and tables one after another, simplify several of them at the same time and write the results in their original order into a new document. Each table cell is simplified like a paragraph and the tables are rebuilt with the same rows and columns. Headings and very short paragraphs are copied unchanged.
+#
+# Note: python-docx always loads the complete uploaded file. What we avoid is holding all paragraph texts, model calls and results at once: the paragraphs are read lazily, only a small window of them is in progress at any time, and each result goes straight into the output document. The total for the progress bar comes from a separate count that does not read any text.
+
+import io
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from docx import Document
+from docx.table import Table
+from docx.shared import Pt, Inches
+
+
+# Number of paragraphs that are simplified at the same time.
+DOCUMENT_CONCURRENCY = 4
+
+# Paragraphs with fewer words than this are copied unchanged, e.g. salutations or dates.
+MIN_WORDS_TO_SIMPLIFY = 4
+
+FONT_WORDDOC = "Arial"
+FONT_SIZE_HEADING = 12
+FONT_SIZE_PARAGRAPH = 9
+
+
+def get_heading_level(paragraph):
+    """Return the heading level of a paragraph, 0 for the title and None for normal paragraphs."""
+    style_name = paragraph.style.name if paragraph.style is not None else ""
+    if style_name == "Title":
+        return 0
+    if style_name.startswith("Heading"):
+        level = style_name.replace("Heading", "").strip()
+        return min(int(level), 9) if level.isdigit() else 1
+    return None
+
+
+def count_paragraphs(document):
+    """Return the number of paragraphs and table cells that iter_paragraphs yields for a document."""
+    total = 0
+    for block in document.iter_inner_content():
+        if isinstance(block, Table):
+            total += sum(len(row.cells) for row in block.rows)
+        else:
+            total += 1
+    return total
+
+
+def iter_paragraphs(document):
+    """
+    Yield a tuple (heading_level, text, cell) for each paragraph and each table cell of a document, in the order of the document.
+
+    heading_level is None for normal paragraphs and cells. cell is None for paragraphs and (row, column, rows, columns) for table cells.
+    """
+    for block in document.iter_inner_content():
+        if not isinstance(block, Table):
+            yield get_heading_level(block), block.text, None
+            continue
+        rows = len(block.rows)
+        columns = len(block.columns)
+        seen = set()
+        for row_index, row in enumerate(block.rows):
+            for column_index, cell in enumerate(row.cells):
+                # A merged cell appears once for every grid cell it spans. We simplify its text only once.
+                text = cell.text if id(cell._tc) not in seen else ""
+                seen.add(id(cell._tc))
+                yield None, text, (row_index, column_index, rows, columns)
+
+
+def map_in_order(function, items, max_workers=DOCUMENT_CONCURRENCY):
+    """
+    Apply a function to items in worker threads and yield the results in the original order.
+
+    At most max_workers items are in progress at any time. The next item is read only when the oldest result has been yielded, so long inputs are processed as a stream.
+    """
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="simplify-docx")
+    window = deque()
+    try:
+        for item in items:
+            window.append(executor.submit(function, item))
+            if len(window) >= max_workers:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def simplify_document(file, simplify_text, on_progress=None, max_workers=DOCUMENT_CONCURRENCY):
+    """
+    Simplify the paragraphs of a .docx file.
+
+    Args:
+        file : file-like object
+            The uploaded .docx file.
+        simplify_text : callable
+            Takes a paragraph text and returns a tuple (success, simplified_text).
+        on_progress : callable, optional
+            Called after each paragraph or table cell with the number of finished paragraphs, the total number of paragraphs, the number of input words per second so far and the number of failed paragraphs.
+
+    Returns:
+        tuple
+            (document, failures, input_words, output_words) with the simplified document as bytes, the number of paragraphs that could not be simplified and the word counts of the document before and after. The paragraphs that failed are kept unchanged.
+    """
+    document = Document(file)
+    total = count_paragraphs(document)
+
+    def process(paragraph):
+        heading_level, text, cell = paragraph
+        words = len(text.split())
+        if heading_level is not None or words < MIN_WORDS_TO_SIMPLIFY:
+            return heading_level, text, cell, words, True
+        success, result = simplify_text(text)
+        # If a paragraph fails, we keep the original text, so the document stays complete.
+        return heading_level, (result if success else text), cell, words, success
+
+    output = Document()
+    section = output.sections[0]
+    section.page_width = Inches(8.27)  # Width of A4 paper in inches
+    section.page_height = Inches(11.69)  # Height of A4 paper in inches
+
+    start_time = time.perf_counter()
+    words_done = 0
+    output_words = 0
+    failures = 0
+    table = None
+    for done, (heading_level, text, cell, words, success) in enumerate(
+        map_in_order(process, iter_paragraphs(document), max_workers=max_workers), start=1
+    ):
+        if cell is not None:
+            row_index, column_index, rows, columns = cell
+            if (row_index, column_index) == (0, 0):
+                table = output.add_table(rows=rows, cols=columns)
+                table.style = "Table Grid"
+            target = table.cell(row_index, column_index)
+            target.text = text.strip()
+            new_paragraphs = target.paragraphs
+            font_size = FONT_SIZE_PARAGRAPH
+        elif heading_level is not None:
+            new_paragraphs = [output.add_heading(text, level=heading_level)]
+            font_size = FONT_SIZE_HEADING
+        else:
+            new_paragraphs = [output.add_paragraph(text.strip())]
+            font_size = FONT_SIZE_PARAGRAPH
+        for paragraph in new_paragraphs:
+            for run in paragraph.runs:
+                run.font.name = FONT_WORDDOC
+                run.font.size = Pt(font_size)
+
+        words_done += words
+        output_words += len(text.split())
+        failures += 0 if success else 1
+        if on_progress is not None:
+            elapsed = time.perf_counter() - start_time
+            on_progress(done, total, words_done / elapsed if elapsed > 0 else 0.0, failures)
+
+    io_stream = io.BytesIO()
+    output.save(io_stream)
+    return io_stream.getvalue(), failures, words_done, output_words
@@ -0,0 +1,162 @@
+# Asynchronous generation engine with pooled HTTP connections.
+# Every backend gets one AsyncOpenAI client with its own connection pool. Connections are kept alive and reused between requests, so a request does not pay for a new TCP connection.
+# The Streamlit script threads go through call_llm, which needs blocking streams. BackgroundEngine therefore runs the engine on one event loop in a background thread and hands the chunks over to the calling threads. All network reads happen on that single loop.
+# The headless API runs an AsyncEngine directly on its own event loop and reads the streams there (call_llm_async).
+
+import asyncio
+import queue
+import threading
+
+import httpx
+from openai import AsyncOpenAI
+
+from metrics import (
+    track_http_connection_opened,
+    track_http_request,
+    track_http_streams,
+    track_http_pool_size,
+)
+from utils_stream import ClosingStream
+
+
+# Limits of the connection pool per backend.
+MAX_CONNECTIONS = 32
+MAX_KEEPALIVE_CONNECTIONS = 16
+KEEPALIVE_EXPIRY = 60
+
+# Timeouts in seconds. The read timeout applies between two chunks of a stream.
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 60
+
+_STREAM_END = object()
+
+
+class AsyncEngine:
+    """Pooled asynchronous clients for all configured backends."""
+
+    def __init__(
+        self,
+        backends,
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.clients = {}
+        self.active_streams = {}
+        for name, base_url in backends.items():
+            if base_url:
+                self.clients[name] = self._create_client(name, base_url)
+                self.active_streams[name] = 0
+                track_http_pool_size(name, max_connections)
+
+    def _create_client(self, name, base_url):
+        async def trace(event_name, info):
+            # httpcore reports this event only when it opens a new connection. Reused connections skip it.
+            if event_name == "connection.connect_tcp.complete":
+                track_http_connection_opened(name)
+
+        async def on_request(request):
+            request.extensions["trace"] = trace
+            track_http_request(name)
+
+        http_client = httpx.AsyncClient(
+            limits=self.limits,
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            event_hooks={"request": [on_request]},
+        )
+        return AsyncOpenAI(
+            base_url=f"{base_url}/v1",
+            api_key="not-needed",  # API key is not required for Llama.cpp
+            http_client=http_client,
+        )
+
+    def has_backend(self, name):
+        return name in self.clients
+
+    async def create_stream(self, name, params):
+        """Start a streaming chat completion on a backend and return the async stream."""
+        return await self.clients[name].chat.completions.create(**params)
+
+    def iterate(self, name, stream):
+        """Return an async iterator over a stream that counts it as active until it ends or is closed. Closing it closes the stream."""
+        self.active_streams[name] += 1
+        track_http_streams(name, self.active_streams[name])
+
+        def end(failed):
+            self.active_streams[name] -= 1
+            track_http_streams(name, self.active_streams[name])
+
+        return ClosingStream(stream, on_close=end)
+
+    async def aclose(self):
+        for client in self.clients.values():
+            await client.close()
+
+
+class BackgroundEngine:
+    """Run an AsyncEngine on an event loop in a background thread and offer blocking streams for the Streamlit script threads."""
+
+    def __init__(self, backends, **limits):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="generation-engine", daemon=True
+        )
+        self._thread.start()
+        self.engine = self._call(self._create_engine(backends, limits))
+
+    async def _create_engine(self, backends, limits):
+        # The clients must be created on the loop that uses them.
+        return AsyncEngine(backends, **limits)
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def has_backend(self, name):
+        return self.engine.has_backend(name)
+
+    def stream(self, name, params):
+        """
+        Start a streaming chat completion and return a blocking iterator over its chunks.
+
+        Errors while connecting are raised here, errors during the stream are raised by the iterator. Closing the iterator cancels the request on the engine loop.
+        """
+        chunks = queue.Queue()
+
+        async def pump():
+            try:
+                stream = await self.engine.create_stream(name, params)
+            except Exception as e:
+                chunks.put(e)
+                return
+            chunks.put(_STREAM_END)  # Signals that the request was accepted.
+            chunk_stream = self.engine.iterate(name, stream)
+            try:
+                async for chunk in chunk_stream:
+                    chunks.put(chunk)
+            except Exception as e:
+                chunks.put(e)
+                return
+            finally:
+                await chunk_stream.aclose()
+            chunks.put(_STREAM_END)
+
+        task = asyncio.run_coroutine_threadsafe(pump(), self._loop)
+        started = chunks.get()
+        if isinstance(started, Exception):
+            raise started
+        # Cancelling the task closes the stream on the engine loop, also if the iterator is closed before its first chunk.
+        return ClosingStream(self._read(chunks), on_close=lambda failed: task.cancel())
+
+    def _read(self, chunks):
+        while True:
+            item = chunks.get()
+            if item is _STREAM_END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
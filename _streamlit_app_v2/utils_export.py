@@ -0,0 +1,91 @@
+# Word export of simplification results.
+# Most users never download the Word document of a result. The app therefore only stores a handle to the result and shows a link to the headless API. The API builds the document when the link is opened and keeps recently built documents in memory.
+# All documents start from a template whose styles already carry our fonts and the A4 page size, so we do not have to format the text run by run.
+#
+# Without DOWNLOAD_BASE_URL the app builds the document right away and embeds it in the page, as before.
+
+import io
+import os
+from datetime import datetime
+from functools import lru_cache
+
+from docx import Document
+from docx.enum.style import WD_STYLE_TYPE
+from docx.oxml.ns import qn
+from docx.shared import Pt, Inches
+
+
+# URL under which the browser reaches the headless API, e.g. "/api" behind the reverse proxy.
+DOWNLOAD_BASE_URL = os.getenv("DOWNLOAD_BASE_URL", "").rstrip("/")
+
+# Number of built documents the API keeps in memory.
+EXPORT_CACHE_SIZE = 64
+
+DEFAULT_OUTPUT_FILENAME = "Ergebnis.docx"
+DOCX_MEDIA_TYPE = (
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+)
+
+FONT_WORDDOC = "Arial"
+FONT_SIZE_HEADING = 12
+FONT_SIZE_PARAGRAPH = 9
+FONT_SIZE_FOOTER = 7
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _set_font(style, size):
+    style.font.name = FONT_WORDDOC
+    style.font.size = Pt(size)
+    # The default headings use the theme fonts, which take precedence over the font name.
+    fonts = style.element.rPr.rFonts
+    for attribute in ("w:asciiTheme", "w:hAnsiTheme", "w:eastAsiaTheme", "w:cstheme"):
+        fonts.attrib.pop(qn(attribute), None)
+
+
+@lru_cache(maxsize=1)
+def get_template():
+    """Build the styled, empty template document once and return it as bytes."""
+    document = Document()
+    _set_font(document.styles["Normal"], FONT_SIZE_PARAGRAPH)
+    _set_font(document.styles["Heading 1"], FONT_SIZE_HEADING)
+    footer_style = document.styles.add_style("Klartext Footer", WD_STYLE_TYPE.PARAGRAPH)
+    _set_font(footer_style, FONT_SIZE_FOOTER)
+
+    section = document.sections[0]
+    section.page_width = Inches(8.27)  # Width of A4 paper in inches
+    section.page_height = Inches(11.69)  # Height of A4 paper in inches
+
+    io_stream = io.BytesIO()
+    document.save(io_stream)
+    return io_stream.getvalue()
+
+
+def build_document(source_text, response, model_name, time_processed, created_at):
+    """Build the Word document of a result and return it as bytes."""
+    document = Document(io.BytesIO(get_template()))
+    document.add_heading("Ausgangstext", level=1)
+    document.add_paragraph("\n" + source_text)
+    document.add_heading(f"Vereinfachter Text ({model_name})", level=1)
+    document.add_paragraph(response)
+
+    timestamp = datetime.fromtimestamp(created_at).strftime(DATETIME_FORMAT)
+    footer = document.sections[0].footer.paragraphs[0]
+    footer.text = f"Erstellt am {timestamp} mit der KlartextZH-App des Kantons Zürich.\nModell: {model_name}\nVerarbeitungszeit: {time_processed:.1f} Sekunden"
+    footer.style = document.styles["Klartext Footer"]
+
+    io_stream = io.BytesIO()
+    document.save(io_stream)
+    return io_stream.getvalue()
+
+
+# Only documents that were built are kept. A handle that is not found yet, e.g. because the app has not committed it, is looked up again on the next request.
+_build_cached_document = lru_cache(maxsize=EXPORT_CACHE_SIZE)(build_document)
+
+
+def get_document(result_cache, handle):
+    """Return the Word document of an exported result as bytes or None if the handle is unknown. Built documents are kept in memory."""
+    export = result_cache.get_export(handle)
+    if export is None:
+        return None
+    return _build_cached_document(*export)
@@ -0,0 +1,354 @@
+# Persistent job queue for the generations of the app.
+# A generation used to run inside the Streamlit script run of the user. A page reload, a dropped websocket or a restart of the container lost the result, and users submitted the same text again, which doubled the load on the GPUs. Now the script run only submits a job and follows its output. A pool of worker threads runs the generations, independent of the sessions.
+# The jobs and their output live in a SQLite database next to the result cache. The output is written while it streams, so any session and any process that uses the same file can follow a job by its ID. A session that reconnects attaches to its running job instead of starting over.
+# When a session submits a new text, e.g. with another level, it gives up its previous job. A job that no session follows any more is cancelled, so the server does not keep generating for nobody. A job that other sessions joined keeps running for them.
+# Every process with a worker pool keeps the jobs it runs alive with a heartbeat. If a process dies, its jobs stop beating and a worker of the next process that comes up takes them over and starts them again.
+# This module must not import Streamlit.
+
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+from metrics import track_job_submitted, track_jobs
+
+
+# Default location of the job database. It can be overridden with an environment variable.
+DEFAULT_JOBS_PATH = "cache/jobs.sqlite"
+
+# Number of worker threads per process. The slot limiters of the backends decide how many of them generate at once, the others wait for a slot. We keep more workers than slots, so that the waiting jobs learn their position in the queue of the limiter.
+DEFAULT_JOB_WORKERS = 16
+
+# Finished jobs are deleted after this many seconds. Long enough to reload the page and get the result back, short enough not to keep confidential texts for long.
+JOB_RETENTION_SECONDS = 3600
+
+# Seconds between two heartbeats of the running jobs, and seconds without a heartbeat after which a running job counts as abandoned.
+HEARTBEAT_INTERVAL = 5
+STALE_AFTER = 30
+
+# Seconds between two reads of the job while a session follows it.
+FOLLOW_INTERVAL = 0.1
+
+QUEUED = "queued"
+RUNNING = "running"
+# The generation finished.
+DONE = "done"
+# The generation stopped early, e.g. because the model repeated itself or the stream broke off. The output so far is kept.
+INCOMPLETE = "incomplete"
+FAILED = "failed"
+# All sessions that submitted the text moved on before it was done.
+CANCELLED = "cancelled"
+
+ACTIVE_STATES = (QUEUED, RUNNING)
+
+_COLUMNS = [
+    "id",
+    "key",
+    "status",
+    "text",
+    "simplification_level",
+    "model",
+    "system_message",
+    "max_tokens",
+    "output",
+    "attempt",
+    "queue_position",
+    "estimated_wait",
+    "error",
+    "created_at",
+    "started_at",
+    "finished_at",
+    "heartbeat",
+    "subscribers",
+]
+
+
+def _job(row):
+    return dict(zip(_COLUMNS, row)) if row is not None else None
+
+
+class JobQueue:
+    """SQLite-backed queue of generation jobs with their streamed output."""
+
+    def __init__(self, path=None):
+        self.path = path or os.getenv("JOBS_PATH", DEFAULT_JOBS_PATH)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # The worker threads and the script threads of all sessions share one connection. We serialize access with a lock.
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None, timeout=10
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                key TEXT NOT NULL,
+                status TEXT NOT NULL,
+                text TEXT NOT NULL,
+                simplification_level TEXT NOT NULL,
+                model TEXT NOT NULL,
+                system_message TEXT NOT NULL,
+                max_tokens INTEGER NOT NULL,
+                output TEXT NOT NULL DEFAULT '',
+                attempt INTEGER NOT NULL DEFAULT 0,
+                queue_position INTEGER,
+                estimated_wait REAL,
+                error TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                heartbeat REAL,
+                subscribers INTEGER NOT NULL DEFAULT 1
+            )
+            """
+        )
+        # Jobs databases created before the subscribers were counted lack the column.
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+        if "subscribers" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN subscribers INTEGER NOT NULL DEFAULT 1")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_key ON jobs (key)")
+        # Released for every job submitted in this process, so that an idle worker picks it up right away.
+        self.submitted = threading.Semaphore(0)
+
+    def submit(self, key, text, simplification_level, model_name, system_message, max_tokens, replaces=None):
+        """
+        Queue a generation and return the ID of its job.
+
+        If a job for the same cache key is still queued or running, e.g. because the user reloaded the page and submitted the text again, we return that job instead of generating the text twice.
+        replaces is the ID of the previous job of the session. The session gives it up, and it is cancelled unless another session still follows it.
+        """
+        # The ID is the only thing needed to read the text and its result, so it must not be guessable.
+        job_id = secrets.token_urlsafe(16)
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT id FROM jobs WHERE key = ? AND status IN (?, ?) ORDER BY created_at LIMIT 1",
+                    (key, *ACTIVE_STATES),
+                ).fetchone()
+                joined = row is not None
+                if joined and row[0] == replaces:
+                    # The session submitted the same text again and keeps following its job.
+                    job_id = replaces
+                    replaces = None
+                elif joined:
+                    job_id = row[0]
+                    self._conn.execute(
+                        "UPDATE jobs SET subscribers = subscribers + 1 WHERE id = ?", (job_id,)
+                    )
+                else:
+                    self._conn.execute(
+                        """
+                        INSERT INTO jobs (id, key, status, text, simplification_level, model, system_message, max_tokens, created_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        """,
+                        (job_id, key, QUEUED, text, simplification_level, model_name, system_message, max_tokens, now),
+                    )
+                if replaces is not None:
+                    self._unsubscribe(replaces, now)
+                self._conn.execute(
+                    "DELETE FROM jobs WHERE finished_at < ?", (now - JOB_RETENTION_SECONDS,)
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        track_job_submitted(joined)
+        if not joined:
+            self.submitted.release()
+        return job_id
+
+    def _unsubscribe(self, job_id, now):
+        # Must be called inside a transaction.
+        self._conn.execute(
+            "UPDATE jobs SET subscribers = subscribers - 1 WHERE id = ? AND status IN (?, ?)",
+            (job_id, *ACTIVE_STATES),
+        )
+        # The worker notices the cancellation when it writes the next output and stops the generation.
+        self._conn.execute(
+            """
+            UPDATE jobs SET status = ?, queue_position = NULL, estimated_wait = NULL, finished_at = ?
+            WHERE id = ? AND status IN (?, ?) AND subscribers <= 0
+            """,
+            (CANCELLED, now, job_id, *ACTIVE_STATES),
+        )
+
+    def claim(self):
+        """Take the oldest queued job, or a running job whose process stopped beating, and return it. Return None if there is none."""
+        now = time.time()
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock of the database, so no other process can claim the same job.
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    """
+                    SELECT id FROM jobs
+                    WHERE status = ? OR (status = ? AND heartbeat < ?)
+                    ORDER BY created_at LIMIT 1
+                    """,
+                    (QUEUED, RUNNING, now - STALE_AFTER),
+                ).fetchone()
+                job = None
+                if row is not None:
+                    # An abandoned job starts again from the beginning, as a new attempt for the sessions that follow it.
+                    self._conn.execute(
+                        """
+                        UPDATE jobs SET attempt = attempt + (status = ?), status = ?, output = '', queue_position = NULL, estimated_wait = NULL, started_at = ?, heartbeat = ?
+                        WHERE id = ?
+                        """,
+                        (RUNNING, RUNNING, now, now, row[0]),
+                    )
+                    job = _job(self._conn.execute("SELECT * FROM jobs WHERE id = ?", (row[0],)).fetchone())
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return job
+
+    def get(self, job_id, offset=0):
+        """Return a job, with only the output after the first offset characters, or None if there is no such job."""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(_COLUMNS[:8])}, substr(output, ? + 1), {', '.join(_COLUMNS[9:])} FROM jobs WHERE id = ?",
+                (offset, job_id),
+            ).fetchone()
+        return _job(row)
+
+    def _update(self, job_id, assignments, values):
+        # Only a running job is updated. A finished job keeps its result.
+        with self._lock:
+            cursor = self._conn.execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ? AND status = ?",
+                (*values, job_id, RUNNING),
+            )
+        return cursor.rowcount > 0
+
+    def write(self, job_id, output):
+        """Store the output of a running job so far."""
+        return self._update(
+            job_id,
+            "output = ?, queue_position = NULL, estimated_wait = NULL, heartbeat = ?",
+            (output, time.time()),
+        )
+
+    def set_waiting(self, job_id, position, estimated_wait):
+        """Store the position of a job in the queue of the limiter and its estimated waiting time."""
+        return self._update(
+            job_id,
+            "queue_position = ?, estimated_wait = ?, heartbeat = ?",
+            (position, estimated_wait, time.time()),
+        )
+
+    def restart(self, job_id):
+        """Discard the output of a running job for another attempt, e.g. with other sampling settings."""
+        return self._update(job_id, "output = '', attempt = attempt + 1", ())
+
+    def beat(self, job_ids):
+        """Mark running jobs as alive."""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE jobs SET heartbeat = ? WHERE id = ? AND status = ?",
+                [(now, job_id, RUNNING) for job_id in job_ids],
+            )
+
+    def finish(self, job_id, status, output=None, error=None):
+        """Set the final status of a running job and optionally its final output."""
+        assignments = "status = ?, error = ?, queue_position = NULL, estimated_wait = NULL, finished_at = ?"
+        values = (status, error, time.time())
+        if output is not None:
+            assignments += ", output = ?"
+            values += (output,)
+        return self._update(job_id, assignments, values)
+
+    def follow(self, job_id, interval=FOLLOW_INTERVAL):
+        """
+        Read a job until it has finished.
+
+        Yields the job whenever it changed. Its output contains only the text added since the previous update. A new attempt starts with the complete output again.
+        """
+        offset = 0
+        attempt = None
+        last = None
+        while True:
+            job = self.get(job_id, offset)
+            if job is None:
+                return
+            if job["attempt"] != attempt:
+                if attempt is not None:
+                    job = self.get(job_id)
+                attempt = job["attempt"]
+                offset = 0
+            state = (job["status"], job["attempt"], job["queue_position"], job["output"])
+            if state != last:
+                last = state
+                offset += len(job["output"])
+                yield job
+            if job["status"] not in ACTIVE_STATES:
+                return
+            time.sleep(interval)
+
+    def count(self, status):
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()
+        return count
+
+
+class JobWorkers:
+    """Pool of threads that run the jobs of a queue."""
+
+    def __init__(self, jobs, run, workers=None, heartbeat_interval=HEARTBEAT_INTERVAL):
+        """
+        Args:
+            jobs : JobQueue
+                The queue to take the jobs from.
+            run : callable
+                Called with the queue and a claimed job. It streams the output with jobs.write and sets the final status with jobs.finish.
+            workers : int, optional
+                Number of worker threads.
+        """
+        self.jobs = jobs
+        self.run = run
+        self.workers = workers or int(os.getenv("JOB_WORKERS", DEFAULT_JOB_WORKERS))
+        self.heartbeat_interval = heartbeat_interval
+        self.running = set()
+        self._lock = threading.Lock()
+
+    def start(self):
+        for index in range(self.workers):
+            threading.Thread(target=self._work, name=f"job-worker-{index}", daemon=True).start()
+        threading.Thread(target=self._beat, name="job-heartbeat", daemon=True).start()
+        return self
+
+    def _work(self):
+        while True:
+            job = self.jobs.claim()
+            if job is None:
+                # Jobs of other processes and abandoned jobs are found by polling.
+                self.jobs.submitted.acquire(timeout=self.heartbeat_interval)
+                continue
+            with self._lock:
+                self.running.add(job["id"])
+            try:
+                self.run(self.jobs, job)
+            except Exception as e:
+                self.jobs.finish(job["id"], FAILED, error=str(e))
+            finally:
+                with self._lock:
+                    self.running.discard(job["id"])
+
+    def _beat(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self._lock:
+                job_ids = list(self.running)
+            if job_ids:
+                self.jobs.beat(job_ids)
+            track_jobs(self.jobs.count(QUEUED), len(job_ids))
@@ -0,0 +1,237 @@
+# Per-backend concurrency limiter.
+# A Llama.cpp server processes only as many requests at once as it has slots. Further requests queue invisibly inside the server until they hit the client timeout. We therefore queue them on our side, in order of arrival, and can tell the waiting users their position and an estimated waiting time.
+# Threads wait with acquire, the requests of the API on its event loop wait with acquire_async. Both queue in the same order.
+# Each request also gets a concrete slot of the server. A slot keeps the prompt of its last request in its KV cache. We therefore give a request the free slot that last processed the same prompt prefix (the system message of its level). The server then only has to process the text of the user.
+
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+
+from metrics import track_queue_depth, track_queue_wait, track_slot_affinity
+from utils_stream import ClosingStream
+
+
+# Number of slots we assume until the server tells us its real slot count.
+DEFAULT_SLOTS = 1
+
+# Initial estimate of how long a request occupies a slot, in seconds. We update it with every finished request.
+DEFAULT_SLOT_SECONDS = 5.0
+
+# Weight of the latest request in the running average of the slot occupation time.
+SLOT_SECONDS_SMOOTHING = 0.2
+
+# Maximum time a request waits in the queue before we give up.
+MAX_QUEUE_SECONDS = 120
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class SlotLimiter:
+    """First-come, first-served semaphore that reports queue positions."""
+
+    def __init__(self, name, slots=DEFAULT_SLOTS):
+        self.name = name
+        self.slots = slots
+        # Id of the first server slot this limiter hands out. Processes that share a server use different slots.
+        self.first_slot = 0
+        self.active = 0
+        # Prompt prefix that each slot processed last and when it was released.
+        self.prefixes = {}
+        self._busy = set()
+        self._last_used = {}
+        self.slot_seconds = DEFAULT_SLOT_SECONDS
+        self._waiting = deque()
+        self._condition = threading.Condition()
+        # Futures of the requests that wait on an event loop, with their loop.
+        self._async_waiters = []
+
+    @property
+    def waiting(self):
+        return len(self._waiting)
+
+    def resize(self, slots, first_slot=0):
+        """Set the number of slots and the id of the first one, e.g. after reading the slot count from the server."""
+        with self._condition:
+            self.slots = max(1, int(slots))
+            self.first_slot = first_slot
+            self._notify_all()
+
+    def _notify_all(self):
+        # Must be called with the condition held. Wakes the waiting threads and the waiting requests on event loops.
+        self._condition.notify_all()
+        for loop, waiter in self._async_waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+        self._async_waiters.clear()
+
+    def forget_prefixes(self):
+        """Forget which prefixes the slots hold, e.g. after the server was restarted."""
+        with self._condition:
+            self.prefixes.clear()
+
+    def estimated_wait(self, position):
+        """Estimate the waiting time in seconds for a request at the given queue position."""
+        return math.ceil(position / self.slots) * self.slot_seconds
+
+    def _choose_slot(self, prefix):
+        free = [
+            slot
+            for slot in range(self.first_slot, self.first_slot + self.slots)
+            if slot not in self._busy
+        ]
+        if prefix is not None:
+            for slot in free:
+                if self.prefixes.get(slot) == prefix:
+                    return slot, True
+        # Prefer a slot that holds no prefix yet, then the one that was idle longest.
+        slot = min(
+            free, key=lambda s: (s in self.prefixes, self._last_used.get(s, 0.0))
+        )
+        return slot, False
+
+    def acquire(self, on_wait=None, timeout=MAX_QUEUE_SECONDS, prefix=None):
+        """
+        Wait for a free slot.
+
+        Args:
+            on_wait : callable, optional
+                Called with the queue position (starting at 1) and the estimated waiting time in seconds whenever the position changes.
+            timeout : float
+                Maximum waiting time in seconds.
+            prefix : str, optional
+                Prompt prefix of the request. If a free slot processed the same prefix last, we return that slot.
+
+        Returns:
+            int or None
+                The id of the acquired slot, None on timeout.
+        """
+        ticket = object()
+        start_time = time.perf_counter()
+        deadline = start_time + timeout
+        last_position = None
+        with self._condition:
+            self._waiting.append(ticket)
+            track_queue_depth(self.name, len(self._waiting))
+            try:
+                while not (self._waiting[0] is ticket and self.active < self.slots):
+                    position = self._waiting.index(ticket) + 1
+                    if on_wait is not None and position != last_position:
+                        last_position = position
+                        estimated_wait = self.estimated_wait(position)
+                        # The callback updates the UI. We do not block the other requests meanwhile.
+                        self._condition.release()
+                        try:
+                            on_wait(position, estimated_wait)
+                        finally:
+                            self._condition.acquire()
+                        continue
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        return None
+                    self._condition.wait(timeout=min(remaining, 1.0))
+                return self._take(prefix)
+            finally:
+                self._leave(ticket, start_time)
+
+    async def acquire_async(self, on_wait=None, timeout=MAX_QUEUE_SECONDS, prefix=None):
+        """Wait for a free slot like acquire, but on the running event loop instead of blocking a thread."""
+        loop = asyncio.get_running_loop()
+        ticket = object()
+        start_time = time.perf_counter()
+        deadline = start_time + timeout
+        last_position = None
+        with self._condition:
+            self._waiting.append(ticket)
+            track_queue_depth(self.name, len(self._waiting))
+        try:
+            while True:
+                with self._condition:
+                    if self._waiting[0] is ticket and self.active < self.slots:
+                        return self._take(prefix)
+                    position = self._waiting.index(ticket) + 1
+                    # Registered while the condition is held, so that a release right after it still wakes us.
+                    waiter = loop.create_future()
+                    self._async_waiters.append((loop, waiter))
+                if on_wait is not None and position != last_position:
+                    last_position = position
+                    on_wait(position, self.estimated_wait(position))
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return None
+                try:
+                    await asyncio.wait_for(waiter, timeout=min(remaining, 1.0))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._condition:
+                self._leave(ticket, start_time)
+
+    def _take(self, prefix):
+        # Must be called with the condition held.
+        slot, hit = self._choose_slot(prefix)
+        self._busy.add(slot)
+        self.active += 1
+        if prefix is not None:
+            self.prefixes[slot] = prefix
+            track_slot_affinity(self.name, hit)
+        return slot
+
+    def _leave(self, ticket, start_time):
+        # Must be called with the condition held.
+        self._waiting.remove(ticket)
+        track_queue_depth(self.name, len(self._waiting))
+        track_queue_wait(self.name, time.perf_counter() - start_time)
+        self._notify_all()
+
+    def try_acquire(self, prefix=None):
+        """
+        Take a free slot without waiting, e.g. for a probe request. The queue metrics do not count it.
+
+        Args:
+            prefix : str, optional
+                Prompt prefix for a slot that holds none yet.
+
+        Returns:
+            tuple
+                The id of the slot and the prefix the request must use, or (None, None) if no slot is free or other requests wait. The prefix is the one the slot already holds, so that the request does not replace it in the KV cache.
+        """
+        with self._condition:
+            if self._waiting or self.active >= self.slots:
+                return None, None
+            slot, _ = self._choose_slot(None)
+            self._busy.add(slot)
+            self.active += 1
+            if prefix is not None:
+                self.prefixes.setdefault(slot, prefix)
+            return slot, self.prefixes.get(slot)
+
+    def expected_wait(self):
+        """Estimate how long a new request would wait for a slot, in seconds."""
+        with self._condition:
+            if not self._waiting and self.active < self.slots:
+                return 0.0
+            return self.estimated_wait(len(self._waiting) + 1)
+
+    def release(self, slot, slot_seconds=None):
+        """Free a slot and update the estimate of the slot occupation time."""
+        with self._condition:
+            self._busy.discard(slot)
+            self._last_used[slot] = time.perf_counter()
+            self.active -= 1
+            if slot_seconds is not None:
+                self.slot_seconds += SLOT_SECONDS_SMOOTHING * (
+                    slot_seconds - self.slot_seconds
+                )
+            self._notify_all()
+
+    def hold(self, slot, stream):
+        """Keep the slot while the stream is consumed and release it when the stream ends or is closed."""
+        start_time = time.perf_counter()
+        return ClosingStream(
+            stream,
+            on_close=lambda failed: self.release(slot, time.perf_counter() - start_time),
+        )
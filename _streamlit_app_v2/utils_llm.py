@@ -0,0 +1,264 @@
+# Shared model configuration and LLM calls.
+# The Streamlit app and the headless API both use these functions, so this module must not import Streamlit.
+
+import json
+import os
+import time
+import urllib.request
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from metrics import track_cancellation
+from utils_prompts import (
+    SYSTEM_MESSAGE_VS,
+    SYSTEM_MESSAGE_ES,
+    SYSTEM_MESSAGE_LS,
+)
+
+
+# Use a .env file to manage environment variables
+load_dotenv()
+
+# Get Llama.cpp server URLs from environment variables
+LLAMACPP_GPU0_URL = os.getenv("LLAMACPP_GPU0_URL")
+LLAMACPP_GPU1_URL = os.getenv("LLAMACPP_GPU1_URL")
+
+DEFAULT_SYSTEM_MESSAGE = SYSTEM_MESSAGE_VS
+
+SYSTEM_MESSAGES = {
+    "Verständliche Sprache": SYSTEM_MESSAGE_VS,
+    "Einfache Sprache": SYSTEM_MESSAGE_ES,
+    "Leichte Sprache": SYSTEM_MESSAGE_LS,
+}
+
+MODEL_MAPPING = {
+    "Gemma 3": LLAMACPP_GPU0_URL,
+    "Phi 4": LLAMACPP_GPU1_URL,
+}
+MODEL_OPTIONS = list(MODEL_MAPPING.keys())
+
+
+# Model-specific temperature settings
+MODEL_TEMPERATURES = {
+    "Gemma 3": 1.0,
+    "Phi 4": 0.5,
+}
+
+DEFAULT_MODEL = "Phi 4"
+DEFAULT_TEMPERATURE = 0.5
+MAX_TOKENS = 2048
+
+# Shown when a request waited too long for a free slot.
+QUEUE_TIMEOUT_MESSAGE = "Der KI-Server ist zurzeit stark ausgelastet. Bitte versuche es in ein paar Minuten erneut."
+
+# Timeout in seconds for processing one system message when we warm up the slots of a server.
+PREFIX_WARMUP_TIMEOUT = 60
+
+# Level whose system message the latency probe sends to a slot that holds no prompt prefix yet, and the timeout of the probe in seconds.
+PROBE_LEVEL = "Einfache Sprache"
+FIRST_TOKEN_PROBE_TIMEOUT = 15
+
+
+def get_completion_params(
+    text, model_name, system_message, slot=None, max_tokens=MAX_TOKENS, sampling=None
+):
+    """Build the parameters of a streaming chat completion request. If a slot is given, the request runs on that slot of the server. sampling overrides the default sampling settings, e.g. the temperature."""
+    temperature = MODEL_TEMPERATURES.get(model_name, DEFAULT_TEMPERATURE)
+
+    # For Llama.cpp's OpenAI compatible endpoint, the model name in the request
+    # is often ignored as the server is loaded with a single model.
+    # We pass a dummy value like "local-model".
+    model_id = "local-model"
+
+    params = dict(
+        model=model_id,
+        messages=[
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": text.strip()},
+        ],
+        temperature=temperature,
+        max_tokens=max_tokens,
+        stream=True,
+        # Llama.cpp specific: reuse the KV cache of the slot for the common prefix of the prompt.
+        extra_body=dict(cache_prompt=True, **({"id_slot": slot} if slot is not None else {})),
+    )
+    if sampling:
+        params.update(sampling)
+    return params
+
+
+def get_error_message(error):
+    """Turn an exception from a model call into a message for the user."""
+    if "timeout" in str(error).lower():
+        return f"Zeitüberschreitung: Die Anfrage dauerte zu lange und hat nicht funktioniert. Bitte versuche es erneut."
+    return str(error)
+
+
+def call_llm(
+    engine,
+    text,
+    model_name=DEFAULT_MODEL,
+    system_message=DEFAULT_SYSTEM_MESSAGE,
+    limiter=None,
+    on_wait=None,
+    tracker=None,
+    max_tokens=MAX_TOKENS,
+    sampling=None,
+):
+    """
+    Call a Llama.cpp server API through the generation engine for text generation.
+
+    If a limiter is given, we first wait for a free slot of the server. The slot is held until the returned stream is exhausted. on_wait is called with the queue position and the estimated waiting time while the request waits.
+    If a GenerationTracker is given, it records the time to the first token and the generation speed of the stream. The time spent in the queue is not included.
+    """
+    if not engine.has_backend(model_name):
+        return False, f"Verbindung zum KI-Server für {model_name} nicht verfügbar."
+
+    slot = None
+    if limiter is not None:
+        # Requests of the same level share the system message. The limiter prefers a slot that still holds it in its cache.
+        slot = limiter.acquire(on_wait=on_wait, prefix=system_message)
+        if slot is None:
+            return False, QUEUE_TIMEOUT_MESSAGE
+
+    try:
+        if tracker is not None:
+            tracker.start()
+        params = get_completion_params(
+            text, model_name, system_message, slot, max_tokens, sampling
+        )
+        stream = engine.stream(model_name, params)
+        if tracker is not None:
+            stream = tracker.track(stream)
+        if limiter is not None:
+            stream = limiter.hold(slot, stream)
+        return True, stream
+
+    except Exception as e:
+        if limiter is not None:
+            limiter.release(slot)
+        return False, get_error_message(e)
+
+
+async def call_llm_async(
+    engine,
+    text,
+    model_name=DEFAULT_MODEL,
+    system_message=DEFAULT_SYSTEM_MESSAGE,
+    limiter=None,
+    on_wait=None,
+    tracker=None,
+    max_tokens=MAX_TOKENS,
+    sampling=None,
+):
+    """
+    Call a Llama.cpp server like call_llm, but on the running event loop with an AsyncEngine.
+
+    Waiting for a slot and reading the stream do not block a thread, so a single event loop serves many requests at once. Returns (success, stream) with an async stream, or (False, error message). Close the stream with aclose.
+    """
+    if not engine.has_backend(model_name):
+        return False, f"Verbindung zum KI-Server für {model_name} nicht verfügbar."
+
+    slot = None
+    if limiter is not None:
+        slot = await limiter.acquire_async(on_wait=on_wait, prefix=system_message)
+        if slot is None:
+            return False, QUEUE_TIMEOUT_MESSAGE
+
+    try:
+        if tracker is not None:
+            tracker.start()
+        params = get_completion_params(
+            text, model_name, system_message, slot, max_tokens, sampling
+        )
+        stream = engine.iterate(model_name, await engine.create_stream(model_name, params))
+        if tracker is not None:
+            stream = tracker.track(stream)
+        if limiter is not None:
+            stream = limiter.hold(slot, stream)
+        return True, stream
+
+    except Exception as e:
+        if limiter is not None:
+            limiter.release(slot)
+        return False, get_error_message(e)
+    except BaseException:
+        # The client disconnected while we connected to the server.
+        if limiter is not None:
+            limiter.release(slot)
+        raise
+
+
+@contextmanager
+def cancel_on_exit(stream, tracker, max_tokens):
+    """
+    Close a stream when the code that consumes it is left, and count it as cancelled if that happens early.
+
+    Streamlit stops a script run on a rerun or when the user closes the tab by raising an exception that derives from BaseException. The stream would otherwise stay open until it is garbage collected and the server would keep generating for nobody. Closing it cancels the request and frees the slot right away.
+    """
+    try:
+        yield stream
+    except BaseException as e:
+        if not isinstance(e, Exception):
+            labels = tracker.labels
+            track_cancellation(
+                labels["backend"], labels["simplification_level"], max_tokens - tracker.chunks
+            )
+        raise
+    finally:
+        stream.close()
+
+
+def send_tiny_prompt(backend, system_message, slot, timeout):
+    """Send a short text with a system message to a slot of a backend, generate a single token and wait for the answer."""
+    params = get_completion_params("Hallo", backend.name, system_message, slot)
+    body = {key: value for key, value in params.items() if key != "extra_body"}
+    body.update(params["extra_body"], stream=False, max_tokens=1)
+    request = urllib.request.Request(
+        f"{backend.base_url}/v1/chat/completions",
+        data=json.dumps(body).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        response.read()
+
+
+def warm_prefixes(backend):
+    """
+    Process the system message of every level once on the slots of a backend.
+
+    The limiter spreads the levels over different slots as long as there are enough. The first requests of each level then find their prefix in the KV cache. Returns True if all prefixes were processed.
+    """
+    limiter = backend.limiter
+    limiter.forget_prefixes()
+    for system_message in SYSTEM_MESSAGES.values():
+        slot = limiter.acquire(timeout=PREFIX_WARMUP_TIMEOUT, prefix=system_message)
+        if slot is None:
+            return False
+        try:
+            send_tiny_prompt(backend, system_message, slot, PREFIX_WARMUP_TIMEOUT)
+        except Exception as e:
+            print(f"Warm-up of the prompt prefixes on {backend.name} failed: {e}")
+            limiter.forget_prefixes()
+            return False
+        finally:
+            limiter.release(slot)
+    return True
+
+
+def probe_first_token(backend):
+    """
+    Measure the time to the first token of a tiny request on a free slot of a backend.
+
+    The request reuses the system message that the slot holds, like a user request whose prefix is in the KV cache. Returns the time in seconds, or None if no slot is free. Then the queue of the limiter tells how busy the backend is. Raises if the request fails.
+    """
+    limiter = backend.limiter
+    slot, system_message = limiter.try_acquire(prefix=SYSTEM_MESSAGES[PROBE_LEVEL])
+    if slot is None:
+        return None
+    start_time = time.perf_counter()
+    try:
+        send_tiny_prompt(backend, system_message, slot, FIRST_TOKEN_PROBE_TIMEOUT)
+    finally:
+        limiter.release(slot)
+    # With a single generated token, the complete answer takes as long as the first token.
+    return time.perf_counter() - start_time
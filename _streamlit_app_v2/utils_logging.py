@@ -0,0 +1,176 @@
+# Structured event log.
+# Every simplification request is logged as one JSON object per line (JSON Lines). The record is handed to a queue and written to disk by a background thread, so a slow disk never blocks a request.
+# The log file is rotated when it reaches EVENT_LOG_MAX_BYTES. Rotated files are compressed with gzip (events.jsonl.1.gz, events.jsonl.2.gz, ...).
+# Rotating a file is not safe across processes, so every process needs its own EVENT_LOG_PATH. serve.py takes care of this for forked workers.
+
+import atexit
+import gzip
+import json
+import logging
+import math
+import os
+import queue
+import shutil
+import threading
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+
+EVENT_LOG_PATH = os.getenv("EVENT_LOG_PATH", "logs/events.jsonl")
+
+# Size at which the log is rotated and number of rotated files we keep.
+EVENT_LOG_MAX_BYTES = int(os.getenv("EVENT_LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+EVENT_LOG_BACKUP_COUNT = int(os.getenv("EVENT_LOG_BACKUP_COUNT", "20"))
+
+EVENT_LOGGER_NAME = "klartext.events"
+
+_lock = threading.Lock()
+_listener = None
+
+
+def _to_json(value):
+    # Numpy scalars, e.g. the rounded ZIX scores.
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Format a record whose message is a dict as a compact JSON object."""
+
+    def format(self, record):
+        return json.dumps(
+            record.msg, ensure_ascii=False, separators=(",", ":"), default=_to_json
+        )
+
+
+def _compress(source, dest):
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+class CompressingRotatingFileHandler(RotatingFileHandler):
+    """Rotating file handler that compresses rotated files with gzip."""
+
+    def __init__(self, filename, max_bytes, backup_count):
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        super().__init__(
+            filename,
+            maxBytes=max_bytes,
+            backupCount=backup_count,
+            encoding="utf-8",
+            delay=True,
+        )
+        self.namer = lambda name: name + ".gz"
+        self.rotator = _compress
+
+
+def get_event_logger(path=EVENT_LOG_PATH):
+    """Return the event logger. The background writer is started on first use."""
+    global _listener
+    logger = logging.getLogger(EVENT_LOGGER_NAME)
+    with _lock:
+        if _listener is None:
+            records = queue.Queue(-1)
+            queue_handler = QueueHandler(records)
+            # The record is serialized in the calling thread, the writer only appends the line.
+            queue_handler.setFormatter(JsonLinesFormatter())
+            logger.addHandler(queue_handler)
+            logger.setLevel(logging.INFO)
+            # Events do not go to the root logger and its handlers.
+            logger.propagate = False
+
+            file_handler = CompressingRotatingFileHandler(
+                path, EVENT_LOG_MAX_BYTES, EVENT_LOG_BACKUP_COUNT
+            )
+            _listener = QueueListener(records, file_handler)
+            _listener.start()
+            # Write the queued records before the process exits.
+            atexit.register(_listener.stop)
+    return logger
+
+
+def _finite(value):
+    # NaN is not valid JSON.
+    if value is None or not math.isfinite(value):
+        return None
+    return round(float(value), 2)
+
+
+def log_simplification(
+    input_words,
+    output_words,
+    zix_input,
+    zix_output,
+    simplification_level,
+    model,
+    time_processed,
+    success,
+    source="app",
+    cached=False,
+    error=None,
+    tracker=None,
+):
+    """
+    Write the event record of a simplification request.
+
+    Args:
+        input_words : int
+            The word count of the original input text.
+        output_words : int
+            The word count of the simplified output text.
+        zix_input, zix_output : float or None
+            Understandability scores of the input and the output.
+        simplification_level : str
+            The requested level of simplification.
+        model : str
+            The model name used for simplification.
+        time_processed : float
+            The processing time in seconds.
+        success : bool
+            Whether the simplification was successful.
+        source : str
+            "app" or "api".
+        cached : bool
+            Whether the result came from the result cache.
+        error : str or None
+            The error message of a failed request.
+        tracker : GenerationTracker or None
+            Adds the timing of the generation to the record.
+
+    Returns:
+        None
+    """
+    record = {
+        "ts": datetime.now().isoformat(timespec="milliseconds"),
+        "source": source,
+        "input_words": input_words,
+        "output_words": output_words,
+        "zix_input": _finite(zix_input),
+        "zix_output": _finite(zix_output),
+        "level": simplification_level,
+        "model": model,
+        "time_processed": round(time_processed, 3),
+        "success": bool(success),
+        "cached": cached,
+        "error": error,
+    }
+    if tracker is not None:
+        record.update(tracker.summary())
+    get_event_logger().info(record)
+
+
+def read_events(path=EVENT_LOG_PATH):
+    """Yield the records of an event log. Lines that are not valid JSON, e.g. the last line after a crash, are skipped."""
+    if not os.path.exists(path):
+        return
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
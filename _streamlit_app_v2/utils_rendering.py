@@ -0,0 +1,64 @@
+# Coalesced rendering of streamed text.
+# A Streamlit text area can only be replaced as a whole. If we render it for every chunk, a long answer sends the full text hundreds of times over the websocket, and the bytes sent grow quadratically with the length of the answer. We collect the chunks and render at most at a fixed frame rate instead. As the text grows, we also stretch the time between frames so that we send at most RENDER_BYTES_PER_SECOND. The bytes sent then grow linearly with the generation time.
+
+import time
+
+
+# Minimum time in seconds between two renders, i.e. at most 10 frames per second.
+RENDER_INTERVAL = 0.1
+
+# Upper limit of characters sent per second while streaming. A text of 10,000 characters is rendered every half second.
+RENDER_BYTES_PER_SECOND = 20_000
+
+
+class ThrottledRenderer:
+    """Collect streamed chunks and render the text at most once per interval."""
+
+    def __init__(
+        self,
+        render,
+        interval=RENDER_INTERVAL,
+        bytes_per_second=RENDER_BYTES_PER_SECOND,
+        clock=time.monotonic,
+    ):
+        self.render = render
+        self.interval = interval
+        self.bytes_per_second = bytes_per_second
+        self.clock = clock
+        self.renders = 0
+        self.bytes_rendered = 0
+        self._parts = []
+        self._length = 0
+        self._dirty = False
+        self._last_render = None
+
+    @property
+    def text(self):
+        """The complete text received so far."""
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    def append(self, chunk_text):
+        """Add a chunk and render if the last frame is old enough."""
+        self._parts.append(chunk_text)
+        self._length += len(chunk_text)
+        self._dirty = True
+        now = self.clock()
+        if self._last_render is None or now - self._last_render >= self.next_interval():
+            self.flush(now)
+
+    def next_interval(self):
+        """Time between two frames for the current length of the text."""
+        return max(self.interval, self._length / self.bytes_per_second)
+
+    def flush(self, now=None):
+        """Render the pending text right away, e.g. at the end of the stream."""
+        if not self._dirty:
+            return
+        text = self.text
+        self.render(text)
+        self.renders += 1
+        self.bytes_rendered += len(text.encode("utf-8"))
+        self._dirty = False
+        self._last_render = self.clock() if now is None else now
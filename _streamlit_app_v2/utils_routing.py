@@ -0,0 +1,309 @@
+# Health-aware routing over the Llama.cpp backends.
+# A background thread probes the /health endpoint of each backend. Requests go to the healthy backend with the fewest requests in flight. A backend that fails is taken out of rotation and returns as soon as a probe succeeds again.
+# The probe also sends a tiny request to a free slot and measures the time to its first token. A backend that answers too slowly, or whose queue is longer than a request may wait, counts as overloaded. Requests avoid it, and the app disables its buttons while all backends are down or overloaded, so users learn it right away instead of after a timeout.
+
+import json
+import os
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import track_backend_state, track_probe_first_token
+from utils_limiter import MAX_QUEUE_SECONDS, SlotLimiter
+from utils_stream import ClosingStream
+
+
+# Seconds between two health probes and timeout of a single probe.
+PROBE_INTERVAL = 10
+PROBE_TIMEOUT = 2
+
+# Number of consecutive failed requests after which we take a backend out of rotation.
+MAX_REQUEST_FAILURES = 2
+
+# Time to the first token of a probe request above which a backend counts as overloaded, in seconds.
+MAX_PROBE_FIRST_TOKEN_SECONDS = 10
+
+# Number of processes that send requests to the same Llama.cpp servers, e.g. all Streamlit workers and the API, and the index of this process among them. Each process only knows its own requests, so each limiter gets its own share of the slots of a server.
+BACKEND_PROCESSES = int(os.getenv("BACKEND_PROCESSES", "1"))
+BACKEND_PROCESS_INDEX = int(os.getenv("BACKEND_PROCESS_INDEX", "0"))
+
+
+class Backend:
+    """State of a single Llama.cpp backend."""
+
+    def __init__(self, name, base_url):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.healthy = True
+        self.in_flight = 0
+        self.requests_total = 0
+        self.request_failures = 0
+        self.last_probe = None
+        # Time to the first token of the latest probe request in seconds. It is not measured while all slots are busy.
+        self.first_token_seconds = None
+        # Context window of a slot in tokens, read from the server.
+        self.context_size = None
+        # True once the prompt prefixes are warmed up on the slots of the server, and while a warm-up runs.
+        self.warmed = False
+        self.warming = False
+        # Requests beyond the slot count of the server wait here instead of inside the server.
+        self.limiter = SlotLimiter(name)
+
+
+class BackendRouter:
+    """Route requests to the least loaded healthy backend."""
+
+    def __init__(
+        self,
+        backends,
+        probe_interval=PROBE_INTERVAL,
+        probe_timeout=PROBE_TIMEOUT,
+        warm_up=None,
+        probe_first_token=None,
+        processes=BACKEND_PROCESSES,
+        process_index=BACKEND_PROCESS_INDEX,
+    ):
+        self.backends = {
+            name: Backend(name, base_url) for name, base_url in backends.items() if base_url
+        }
+        # Called with a Backend when it becomes healthy or its slot count changes. Returns True if the warm-up succeeded.
+        self.warm_up = warm_up
+        # Called with a healthy Backend on every probe. Returns the time to the first token of a tiny request or None if no slot was free, and raises if the request failed.
+        self.probe_first_token = probe_first_token
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.processes = max(1, processes)
+        self.process_index = process_index % self.processes
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Start probing the backends in a background thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._probe_forever, name="backend-prober", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def _probe_forever(self):
+        while True:
+            self.probe_all()
+            time.sleep(self.probe_interval)
+
+    def probe(self, backend):
+        """Return True if the backend answers its /health endpoint with status 200."""
+        try:
+            with urllib.request.urlopen(
+                f"{backend.base_url}/health", timeout=self.probe_timeout
+            ) as response:
+                return response.status == 200
+        except Exception:
+            # Llama.cpp answers with 503 while it loads the model. urllib raises for that as well.
+            return False
+
+    def get_props(self, backend):
+        """Read the /props endpoint of the server or return an empty dict."""
+        try:
+            with urllib.request.urlopen(
+                f"{backend.base_url}/props", timeout=self.probe_timeout
+            ) as response:
+                return json.load(response)
+        except Exception:
+            return {}
+
+    def get_slot_count(self, backend, props):
+        """Read the number of parallel slots from the /props of the server, or from /slots as a fallback."""
+        if props.get("total_slots"):
+            return int(props["total_slots"])
+        try:
+            with urllib.request.urlopen(
+                f"{backend.base_url}/slots", timeout=self.probe_timeout
+            ) as response:
+                return len(json.load(response)) or None
+        except Exception:
+            return None
+
+    def probe_all(self):
+        """Probe all backends once and update their state."""
+        backends = list(self.backends.values())
+        if not backends:
+            return
+        # The backends are probed at the same time, so that a slow backend does not delay the probes of the others.
+        with ThreadPoolExecutor(max_workers=len(backends)) as executor:
+            list(executor.map(self._probe_backend, backends))
+
+    def _probe_backend(self, backend):
+        healthy = self.probe(backend)
+        if healthy:
+            props = self.get_props(backend)
+            context_size = props.get("default_generation_settings", {}).get("n_ctx")
+            if context_size:
+                backend.context_size = int(context_size)
+            slots = self.get_slot_count(backend, props)
+            if slots and self.resize(backend, slots):
+                backend.warmed = False
+            if self.warm_up is not None and not backend.warmed and not backend.warming:
+                # The warm-up can take a minute. It runs in its own thread, so the probes of all backends go on meanwhile.
+                backend.warming = True
+                threading.Thread(
+                    target=self._warm_up,
+                    args=(backend,),
+                    name=f"warm-up-{backend.name}",
+                    daemon=True,
+                ).start()
+            if self.probe_first_token is not None:
+                try:
+                    first_token_seconds = self.probe_first_token(backend)
+                except Exception as e:
+                    # The server answers /health, but cannot generate, e.g. because it hangs.
+                    print(f"Probe request to {backend.name} failed: {e}")
+                    healthy = False
+                else:
+                    if first_token_seconds is not None:
+                        backend.first_token_seconds = first_token_seconds
+                        track_probe_first_token(backend.name, first_token_seconds)
+        else:
+            # A restarted server has lost its KV cache.
+            backend.warmed = False
+        with self._lock:
+            backend.last_probe = time.time()
+            backend.healthy = healthy
+            if healthy:
+                backend.request_failures = 0
+        self._export(backend)
+
+    def resize(self, backend, total_slots):
+        """Give the limiter of a backend the share of the server slots of this process. Return True if it changed."""
+        share = total_slots // self.processes
+        if share == 0:
+            # More processes than slots: every process keeps one slot and the server queues the rest.
+            share, first_slot = 1, self.process_index % total_slots
+        else:
+            first_slot = self.process_index * share
+        if (share, first_slot) == (backend.limiter.slots, backend.limiter.first_slot):
+            return False
+        backend.limiter.resize(share, first_slot)
+        return True
+
+    def _warm_up(self, backend):
+        """Warm up a backend and mark it as warmed if that worked. Otherwise the next probe tries again."""
+        try:
+            backend.warmed = bool(self.warm_up(backend))
+        except Exception as e:
+            print(f"Warm-up of {backend.name} failed: {e}")
+        finally:
+            backend.warming = False
+
+    def is_overloaded(self, backend):
+        """Return True if a new request to the backend would get its first token too late or time out in the queue."""
+        if (
+            backend.first_token_seconds is not None
+            and backend.first_token_seconds > MAX_PROBE_FIRST_TOKEN_SECONDS
+        ):
+            return True
+        return backend.limiter.expected_wait() > MAX_QUEUE_SECONDS
+
+    def available_backends(self, allowed=None):
+        """Return the names of the healthy backends that are not overloaded, optionally limited to the allowed ones."""
+        with self._lock:
+            backends = [
+                backend
+                for name, backend in self.backends.items()
+                if backend.healthy and (allowed is None or name in allowed)
+            ]
+        return [backend.name for backend in backends if not self.is_overloaded(backend)]
+
+    def healthy_backends(self, allowed=None):
+        """Return the names of all healthy backends, optionally limited to the allowed ones."""
+        with self._lock:
+            return [
+                name
+                for name, backend in self.backends.items()
+                if backend.healthy and (allowed is None or name in allowed)
+            ]
+
+    def pick(self, allowed=None):
+        """Return the name of the healthy backend with the fewest requests in flight or None. Overloaded backends are only picked if all healthy backends are overloaded."""
+        with self._lock:
+            candidates = [
+                backend
+                for name, backend in self.backends.items()
+                if backend.healthy and (allowed is None or name in allowed)
+            ]
+            if not candidates:
+                return None
+            # Requests that wait for a slot count as in flight, too. On a tie the backend that served fewer requests so far wins. So both backends share the load even when traffic is low.
+            backend = min(
+                candidates,
+                key=lambda b: (
+                    self.is_overloaded(b),
+                    b.in_flight + b.limiter.waiting,
+                    b.requests_total,
+                ),
+            )
+            return backend.name
+
+    def context_size(self, name):
+        """Return the context window of a slot of a backend in tokens or None if unknown."""
+        backend = self.backends.get(name)
+        return backend.context_size if backend is not None else None
+
+    def limiter(self, name):
+        """Return the slot limiter of a backend or None for unknown backends."""
+        backend = self.backends.get(name)
+        return backend.limiter if backend is not None else None
+
+    def begin(self, name):
+        """Count a request to a backend as in flight."""
+        backend = self.backends.get(name)
+        if backend is None:
+            return
+        with self._lock:
+            backend.in_flight += 1
+            backend.requests_total += 1
+        self._export(backend)
+
+    def end(self, name, failed=False):
+        """Count a request to a backend as finished."""
+        backend = self.backends.get(name)
+        if backend is None:
+            return
+        with self._lock:
+            backend.in_flight -= 1
+        if failed:
+            self.report_failure(name)
+        else:
+            self.report_success(name)
+        self._export(backend)
+
+    def track(self, name, stream):
+        """Count a request as in flight until its stream is exhausted or closed."""
+        if name not in self.backends:
+            return stream
+        self.begin(name)
+        return ClosingStream(stream, on_close=lambda failed: self.end(name, failed=failed))
+
+    def report_success(self, name):
+        """Reset the failure count of a backend after a successful request."""
+        backend = self.backends.get(name)
+        if backend is not None:
+            with self._lock:
+                backend.request_failures = 0
+
+    def report_failure(self, name):
+        """Count a failed request. After MAX_REQUEST_FAILURES failures in a row the backend leaves the rotation."""
+        backend = self.backends.get(name)
+        if backend is None:
+            return
+        with self._lock:
+            backend.request_failures += 1
+            if backend.request_failures >= MAX_REQUEST_FAILURES:
+                backend.healthy = False
+        self._export(backend)
+
+    def _export(self, backend):
+        track_backend_state(
+            backend.name, backend.healthy, backend.in_flight, self.is_overloaded(backend)
+        )
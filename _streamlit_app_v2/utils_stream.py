@@ -0,0 +1,117 @@
+# Streams with a reliable clean-up.
+# The slot limiter, the router and the engine wrap the chunk stream of a request to free the slot, end the in-flight count and cancel the request when the stream ends. A generator function cannot do this reliably: if it is closed before its first chunk was read, e.g. because a client disconnected before the response started, its finally block never runs. ClosingStream runs the clean-up exactly once, whether the stream was exhausted, raised, or was closed before or during the iteration.
+# ClosingStream wraps blocking streams (for, close) as well as the async streams of the API (async for, aclose).
+
+import inspect
+
+
+class ClosingStream:
+    """Iterator over a stream that runs its clean-up exactly once."""
+
+    def __init__(self, stream, on_chunk=None, on_end=None, on_close=None):
+        """
+        Args:
+            stream : iterable or async iterable
+                The stream to wrap. It is closed as well if it has a close method.
+            on_chunk : callable, optional
+                Called with every chunk.
+            on_end : callable, optional
+                Called when the stream is exhausted.
+            on_close : callable, optional
+                Called with True if the stream raised an exception, False otherwise, when it ends or is closed.
+        """
+        self.stream = stream
+        self._iterator = None
+        self.on_chunk = on_chunk
+        self.on_end = on_end
+        self.on_close = on_close
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._closed:
+            raise StopIteration
+        if self._iterator is None:
+            self._iterator = iter(self.stream)
+        try:
+            chunk = next(self._iterator)
+        except StopIteration:
+            try:
+                if self.on_end is not None:
+                    self.on_end()
+            finally:
+                self._close(failed=False)
+            raise
+        except BaseException as e:
+            # Streamlit stops a script run with an exception that does not derive from Exception. That is not a failure of the backend.
+            self._close(failed=isinstance(e, Exception))
+            raise
+        if self.on_chunk is not None:
+            self.on_chunk(chunk)
+        return chunk
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._closed:
+            raise StopAsyncIteration
+        if self._iterator is None:
+            self._iterator = self.stream.__aiter__()
+        try:
+            chunk = await self._iterator.__anext__()
+        except StopAsyncIteration:
+            try:
+                if self.on_end is not None:
+                    self.on_end()
+            finally:
+                await self._aclose(failed=False)
+            raise
+        except BaseException as e:
+            # A client that disconnects cancels the task with CancelledError. That is not a failure of the backend either.
+            await self._aclose(failed=isinstance(e, Exception))
+            raise
+        if self.on_chunk is not None:
+            self.on_chunk(chunk)
+        return chunk
+
+    def close(self):
+        self._close(failed=False)
+
+    async def aclose(self):
+        await self._aclose(failed=False)
+
+    def _close(self, failed):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            close = getattr(self.stream, "close", None)
+            if close is not None:
+                result = close()
+                if inspect.iscoroutine(result):
+                    # An async stream cannot be awaited here, e.g. when it is garbage collected. Use aclose for async streams.
+                    result.close()
+        finally:
+            if self.on_close is not None:
+                self.on_close(failed)
+
+    async def _aclose(self, failed):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            close = getattr(self.stream, "aclose", None) or getattr(self.stream, "close", None)
+            if close is not None:
+                result = close()
+                if inspect.isawaitable(result):
+                    await result
+        finally:
+            if self.on_close is not None:
+                self.on_close(failed)
+
+    def __del__(self):
+        # A stream that is dropped without being closed still frees its resources.
+        self.close()
@@ -0,0 +1,76 @@
+# Benchmark: throughput of the streaming post-processing.
+# Compares the former clean-up (str.replace and two re.sub per chunk, response += chunk and a final split of the whole response) with StreamCleaner. Both get the same model-like output split into token-sized chunks.
+#
+# Usage: python benchmarks/bench_postprocess.py [--repeat 5]
+
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "_streamlit_app_v2"))
+
+from utils_postprocess import StreamCleaner  # noqa: E402
+
+
+PARAGRAPH = "## Neue Regeln\n**Wichtig:** Die Gemeinde schliesst die Strasse ab Montag. Bitte benutzen Sie den Umweg über die Grossstrasse. Weitere Informationen erhalten Sie beim Bauamt.\n\n"
+
+
+def make_chunks(words):
+    """Split a model-like output with about the given number of words into chunks of 3 to 5 characters."""
+    text = PARAGRAPH * max(1, words // len(PARAGRAPH.split()))
+    chunks = []
+    position = 0
+    while position < len(text):
+        size = 3 + position % 3
+        chunks.append(text[position : position + size])
+        position += size
+    return chunks
+
+
+def previous(chunks):
+    """The clean-up as it was done before StreamCleaner."""
+    response = ""
+    for chunk_text in chunks:
+        chunk_text = chunk_text.replace("ß", "ss")
+        chunk_text = re.sub(r"\*\*", " ", chunk_text)
+        chunk_text = re.sub(r"^#{1,7}", "", chunk_text, flags=re.MULTILINE)
+        response += chunk_text
+    response_lines = response.split("\n")
+    return "\n".join(
+        line[1:] if line.startswith(" ") and not line.startswith("  ") else line
+        for line in response_lines
+    )
+
+
+def streaming(chunks):
+    cleaner = StreamCleaner()
+    for chunk_text in chunks:
+        cleaner.feed(chunk_text)
+    cleaner.finish()
+    return cleaner.text
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'words':>6} {'chunks':>7} {'mode':>10} {'ms':>8} {'MB/s':>7}")
+    for words in (500, 1500, 5000):
+        chunks = make_chunks(words)
+        size = sum(len(chunk_text.encode("utf-8")) for chunk_text in chunks)
+        for mode, function in (("previous", previous), ("streaming", streaming)):
+            seconds = min(timeit.repeat(lambda: function(chunks), number=1, repeat=args.repeat))
+            print(f"{words:>6} {len(chunks):>7} {mode:>10} {seconds * 1000:>8.2f} {size / seconds / 1e6:>7.1f}")
+
+    # The previous clean-up misses markers that are split across two chunks.
+    chunks = make_chunks(1500)
+    for mode, function in (("previous", previous), ("streaming", streaming)):
+        output = function(chunks)
+        print(f"{mode}: {output.count('*')} * and {output.count(chr(10) + '#')} headings left in the output")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# Benchmark: bytes sent to the browser per streamed response.
+# Simulates a model that streams a 1,500-word answer with about 1.3 tokens per word at a fixed token rate. It compares re-rendering the text area for every chunk with the throttled renderer of the app. Streamlit sends the complete value of a text area with every update, so we count the UTF-8 bytes of each rendered value.
+#
+# Usage: python benchmarks/bench_rendering.py [--words 1500] [--tokens-per-second 30]
+
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "_streamlit_app_v2"))
+
+from utils_rendering import RENDER_BYTES_PER_SECOND, RENDER_INTERVAL, ThrottledRenderer  # noqa: E402
+
+
+WORDS = "Die Gemeinde informiert alle Einwohnerinnen und Einwohner über die neuen Öffnungszeiten der Verwaltung sowie über wichtige Änderungen bei den Gebühren".split()
+
+
+def make_chunks(words, seed=1):
+    """Split a generated text into token-sized chunks, like a streaming model would."""
+    rng = random.Random(seed)
+    chunks = []
+    for i in range(words):
+        word = rng.choice(WORDS)
+        text = (" " if i else "") + word + ("\n\n" if i % 60 == 59 else "")
+        # Long words arrive as two tokens.
+        if len(word) > 8:
+            chunks.extend([text[: len(text) // 2], text[len(text) // 2 :]])
+        else:
+            chunks.append(text)
+    return chunks
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def per_chunk(chunks):
+    """Render the full response for every chunk, as the app did before."""
+    response = ""
+    renders = 0
+    sent = 0
+    for chunk_text in chunks:
+        response += chunk_text
+        renders += 1
+        sent += len(response.encode("utf-8"))
+    return renders, sent
+
+
+def throttled(chunks, tokens_per_second, interval, bytes_per_second):
+    """Render with the ThrottledRenderer at the simulated token rate."""
+    clock = SimulatedClock()
+    renderer = ThrottledRenderer(
+        lambda text: None, interval=interval, bytes_per_second=bytes_per_second, clock=clock
+    )
+    for chunk_text in chunks:
+        clock.now += 1 / tokens_per_second
+        renderer.append(chunk_text)
+    renderer.flush()
+    return renderer.renders, renderer.bytes_rendered
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--words", type=int, default=1500)
+    parser.add_argument("--tokens-per-second", type=float, default=30.0)
+    parser.add_argument("--interval", type=float, default=RENDER_INTERVAL)
+    parser.add_argument("--bytes-per-second", type=float, default=RENDER_BYTES_PER_SECOND)
+    args = parser.parse_args()
+
+    print(f"{'words':>6} {'chunks':>7} {'mode':>10} {'renders':>8} {'bytes sent':>12} {'bytes/word':>11}")
+    for words in sorted({args.words // 4, args.words // 2, args.words, args.words * 2}):
+        chunks = make_chunks(words)
+        for mode, (renders, sent) in (
+            ("per chunk", per_chunk(chunks)),
+            ("throttled", throttled(
+                chunks, args.tokens_per_second, args.interval, args.bytes_per_second
+            )),
+        ):
+            print(f"{words:>6} {len(chunks):>7} {mode:>10} {renders:>8} {sent:>12,} {sent / words:>11,.0f}")
+
+
+if __name__ == "__main__":
+    main()
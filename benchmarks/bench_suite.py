@@ -0,0 +1,299 @@
+# Benchmark suite: CPU work around each request, with regression gates.
+# Measures the scoring (get_zix, get_cefr), the clean-up of the streamed output, strip_markdown and get_result_from_response of the prototype app, the build of the Word export and the event log over German administrative texts of 50 to 10,000 characters.
+# The results are stored relative to a fixed pure-Python calibration workload that is timed right before and after each case. A baseline recorded on one machine can then be checked on a similar one, and changes of the CPU speed during a run (e.g. on shared CI machines) cancel out. A case regresses if it got slower than its baseline by more than the tolerance.
+# Cases whose dependencies are not installed (e.g. zix for the scoring) are skipped, and the check fails because they were not checked. A case without a baseline entry fails the check, too, so the baseline must be saved on a machine with all dependencies, e.g. in the Docker image of the app.
+#
+# Usage:
+#   python benchmarks/bench_suite.py                  # measure and compare with the baseline
+#   python benchmarks/bench_suite.py --check          # exit with status 1 if a case regressed
+#   python benchmarks/bench_suite.py --save           # store the results as the new baseline
+#   python benchmarks/bench_suite.py --filter clean   # only cases whose name contains "clean"
+
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "_streamlit_app_v2"))
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# Allowed slowdown against the baseline before a case counts as a regression.
+DEFAULT_TOLERANCE = 0.25
+
+# Cases that take less than FAST_CASE_SECONDS per call are disturbed more by the CPU caches and other processes. They get at least FAST_CASE_TOLERANCE.
+FAST_CASE_SECONDS = 100e-6
+FAST_CASE_TOLERANCE = 0.5
+
+# A suspected regression is measured again up to this many times, and the fastest measurement counts.
+REMEASUREMENTS = 2
+
+# Each case runs for at least MIN_ROUND_TIME seconds per round. We keep the fastest of ROUNDS rounds, which is the least disturbed by other processes. The calibration before and after each case runs fewer rounds.
+MIN_ROUND_TIME = 0.2
+ROUNDS = 7
+CALIBRATION_ROUNDS = 3
+
+TEXT_SIZES = (50, 500, 2_000, 10_000)
+
+# Tag around the result in the output of the prototype app for "Einfache Sprache".
+RESULT_TAG = "einfachesprache"
+
+# Size of the chunks of a streamed model output in characters, about one token.
+CHUNK_SIZE = 4
+
+SENTENCES = [
+    "Die Gesuchstellerin hat die Unterlagen fristgerecht beim zuständigen Amt eingereicht.",
+    "Gestützt auf § 12 Abs. 2 des Gesetzes wird die Bewilligung unter Vorbehalt erteilt.",
+    "Gegen diese Verfügung kann innert 30 Tagen schriftlich Rekurs erhoben werden.",
+    "Die Gemeinde informiert die Bevölkerung über die geplanten Bauarbeiten an der Kantonsstrasse.",
+    "Die Steuererklärung ist bis zum 31. März mit allen Belegen einzureichen.",
+    "Bei Fragen wenden Sie sich bitte an die Einwohnerkontrolle Ihrer Wohngemeinde.",
+    "Die Kosten des Verfahrens werden der unterliegenden Partei auferlegt.",
+    "Die Ausrichtung der Beiträge setzt voraus, dass die Voraussetzungen während der ganzen Dauer erfüllt sind.",
+]
+
+OUTPUT_PARAGRAPH = "## Was ist neu?\n**Wichtig:** Die Gemeinde baut ab Montag an der Strasse. Bitte benutzen Sie den Umweg über die Grossstrasse. Haben Sie Fragen? Rufen Sie das Bauamt an.\n\n"
+
+
+def make_text(size, seed=0):
+    """Return a German administrative text of about size characters."""
+    rng = random.Random(seed)
+    parts = []
+    length = 0
+    while length < size:
+        sentence = rng.choice(SENTENCES)
+        parts.append(sentence)
+        length += len(sentence) + 1
+    return " ".join(parts)[:size].rsplit(" ", 1)[0]
+
+
+def make_output(size):
+    """Return a model-like output with markdown of about size characters."""
+    return (OUTPUT_PARAGRAPH * (size // len(OUTPUT_PARAGRAPH) + 1))[:size]
+
+
+def measure(func, setup=None, rounds=ROUNDS):
+    """Return the fastest time per call of func in seconds. setup is called before each call and not timed."""
+    best = float("inf")
+    # As timeit, we measure without garbage collection, which would otherwise run at random points.
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(rounds):
+            calls = 0
+            elapsed = 0.0
+            while elapsed < MIN_ROUND_TIME:
+                if setup is not None:
+                    setup()
+                start = time.perf_counter()
+                func()
+                elapsed += time.perf_counter() - start
+                calls += 1
+            best = min(best, elapsed / calls)
+    finally:
+        gc.enable()
+    return best
+
+
+_rng = random.Random(0)
+_NUMBERS = [_rng.random() for _ in range(10_000)]
+_WORDS = [str(number) for number in _NUMBERS[:2_000]]
+
+
+def calibrate():
+    """Time a fixed pure-Python workload that stands for the current speed of the machine."""
+    return measure(lambda: (sorted(_NUMBERS), " ".join(_WORDS).split()), rounds=CALIBRATION_ROUNDS)
+
+
+def measure_relative(func, setup=None):
+    """Return the time per call of func relative to the calibration workload around it."""
+    before = calibrate()
+    seconds = measure(func, setup)
+    after = calibrate()
+    # The faster calibration is the less disturbed one.
+    return seconds / min(before, after)
+
+
+# ---------------------------------------------------------------
+# Cases
+# Each function returns a list of (name, func, setup) and may raise ImportError if a dependency is missing.
+
+
+def scoring_cases():
+    import utils_scoring
+    from utils_scoring import get_cefr, get_zix
+
+    cases = []
+    for size in TEXT_SIZES:
+        text = make_text(size)
+        # Without the cache, as for a new input text.
+        cases.append((f"get_zix/{size}", lambda text=text: get_zix(text), utils_scoring._zix_cache._entries.clear))
+        cases.append((f"get_zix_cached/{size}", lambda text=text: get_zix(text), None))
+    cases.append(("get_cefr", lambda: get_cefr.__wrapped__(-2.5), None))
+    return cases
+
+
+def cleanup_cases():
+    from utils_postprocess import StreamCleaner, clean_text, extract_tagged_result
+
+    def stream(chunks):
+        cleaner = StreamCleaner()
+        for chunk in chunks:
+            cleaner.feed(chunk)
+        cleaner.finish()
+        return cleaner.text
+
+    cases = []
+    for size in TEXT_SIZES:
+        output = make_output(size)
+        chunks = [output[i : i + CHUNK_SIZE] for i in range(0, len(output), CHUNK_SIZE)]
+        cases.append((f"clean_stream/{size}", lambda chunks=chunks: stream(chunks), None))
+        # strip_markdown of the prototype app cleans the complete output at once.
+        cases.append((f"strip_markdown/{size}", lambda output=output: clean_text(output, strip_emphasis=True), None))
+        # get_result_from_response of the prototype app takes the result from between the tags of its level.
+        tagged = f"<{RESULT_TAG}>{output}</{RESULT_TAG}>"
+        cases.append(
+            (f"get_result_from_response/{size}", lambda tagged=tagged: extract_tagged_result(tagged, RESULT_TAG), None)
+        )
+    return cases
+
+
+def export_cases():
+    from utils_export import build_document, get_template
+
+    get_template()
+    cases = []
+    for size in TEXT_SIZES:
+        source, response = make_text(size), make_output(size)
+        cases.append(
+            (
+                f"build_document/{size}",
+                lambda source=source, response=response: build_document(source, response, "Phi 4", 4.2, time.time()),
+                None,
+            )
+        )
+    return cases
+
+
+def logging_cases():
+    # The event log of the benchmark goes to a temporary directory.
+    os.environ["EVENT_LOG_PATH"] = os.path.join(tempfile.mkdtemp(), "events.jsonl")
+    import utils_logging
+    from utils_logging import log_simplification
+
+    def log_event():
+        log_simplification(182, 241, -3.41, 0.87, "Einfache Sprache", "Phi 4", 9.842, True)
+
+    def wait_for_writer():
+        # The background writer would otherwise compete with the timed calls for the interpreter.
+        if utils_logging._listener is not None:
+            utils_logging._listener.queue.join()
+
+    return [("log_event", log_event, wait_for_writer)]
+
+
+CASES = [scoring_cases, cleanup_cases, export_cases, logging_cases]
+
+
+# ---------------------------------------------------------------
+# Baseline
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)["relative"]
+
+
+def save_baseline(path, calibration, relative):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"calibration_seconds": calibration, "relative": relative}, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def get_tolerance(name, baseline, calibration, tolerance):
+    """Return the allowed slowdown of a case, wider for cases that take only microseconds."""
+    if baseline[name] * calibration < FAST_CASE_SECONDS:
+        return max(tolerance, FAST_CASE_TOLERANCE)
+    return tolerance
+
+
+def format_time(seconds):
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.1f} µs"
+    return f"{seconds * 1e3:.2f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark suite with regression gates.")
+    parser.add_argument("--check", action="store_true", help="Exit with status 1 if a case regressed")
+    parser.add_argument("--save", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Allowed slowdown, e.g. 0.25 for 25%%")
+    parser.add_argument("--filter", default="", help="Only run cases whose name contains this text")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    args = parser.parse_args()
+
+    baseline = load_baseline(args.baseline)
+    calibration = calibrate()
+    print(f"Calibration: {calibration * 1e3:.2f} ms")
+    print(f"{'case':<34}{'time/op':>12}{'baseline':>12}{'change':>9}")
+
+    results = {}
+    regressions = []
+    missing = []
+    skipped = []
+    for make_cases in CASES:
+        try:
+            cases = make_cases()
+        except ImportError as e:
+            print(f"{make_cases.__name__:<34}skipped ({e})")
+            skipped.append(make_cases.__name__)
+            continue
+        for name, func, setup in cases:
+            if args.filter not in name:
+                continue
+            relative = measure_relative(func, setup)
+            if name in baseline:
+                tolerance = get_tolerance(name, baseline, calibration, args.tolerance)
+                # Measure a suspected regression again, so that a single disturbance does not fail the check.
+                for _ in range(REMEASUREMENTS):
+                    if relative / baseline[name] - 1 <= tolerance:
+                        break
+                    relative = min(relative, measure_relative(func, setup))
+            results[name] = relative
+            # Times are shown at the speed of the calibration at the start.
+            line = f"{name:<34}{format_time(relative * calibration):>12}"
+            if name in baseline:
+                change = relative / baseline[name] - 1
+                line += f"{format_time(baseline[name] * calibration):>12}{change:>+9.0%}"
+                if change > tolerance:
+                    line += "  REGRESSION"
+                    regressions.append(name)
+            else:
+                line += f"{'-':>12}  NO BASELINE"
+                missing.append(name)
+            print(line, flush=True)
+
+    if args.save:
+        # Cases that were not run keep their baseline.
+        save_baseline(args.baseline, calibration, {**baseline, **results})
+        print(f"Baseline saved to {args.baseline}")
+        return
+    if missing:
+        print(f"{len(missing)} cases have no baseline, save one with --save: {', '.join(missing)}")
+    if regressions:
+        print(f"{len(regressions)} cases regressed beyond their tolerance: {', '.join(regressions)}")
+    if skipped:
+        print(f"Not checked because of missing dependencies: {', '.join(skipped)}")
+    if args.check and (regressions or missing or skipped):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+# Load generator for the streaming app.
+# Virtual users send simplification requests in a closed loop: each user sends a request, waits for the complete answer, thinks for a moment and sends the next one. The number of users is increased stage by stage, so the report shows at which load the time to the first token starts to grow.
+# The input lengths and levels are drawn from the logs of the app (see tools/log_analytics.py). Without logs we use a log-normal distribution with the median (36 words) and mean (66 words) of the prototype app.
+#
+# Targets:
+#   llm  Calls call_llm of the app with the router, slot limiter and generation engine of the app, as the app does for a single text.
+#   ui   Runs the Streamlit script with streamlit.testing (AppTest) for each request, from the text input to the finished result. This includes the scoring and the result cache.
+#
+# With --mock N the generator starts N mock Llama.cpp servers (loadtest/mock_llamacpp.py) and points the app at them, so the test runs offline on a CPU-only machine.
+#
+# Usage:
+#   python loadtest/load_generator.py --mock 2 --users 1 2 4 8 16 --duration 60
+#   python loadtest/load_generator.py --target ui --mock 2 --users 1 2 4 --log app.log logs/
+# Further options, e.g. --slots or --decode-speed, are passed on to the mock servers.
+
+import argparse
+import gzip
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+APP_DIR = os.path.join(ROOT, "_streamlit_app_v2")
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mock_llamacpp  # noqa: E402
+
+
+# Distribution of the input lengths in words and of the levels without logs.
+DEFAULT_MEDIAN_WORDS = 36
+DEFAULT_MEAN_WORDS = 66
+DEFAULT_LEVELS = {"Einfache Sprache": 0.87, "Leichte Sprache": 0.13}
+
+# Inputs are limited to 10,000 characters in the app.
+MAX_INPUT_WORDS = 1_300
+
+MOCK_BASE_PORT = 8090
+MOCK_STARTUP_TIMEOUT = 10
+
+PERCENTILES = (50, 95, 99)
+
+SENTENCE_WORDS = (
+    "Die Gemeinde informiert die Bevölkerung über die geplanten Bauarbeiten an der "
+    "Kantonsstrasse. Gesuche um Bewilligung sind innert dreissig Tagen schriftlich "
+    "beim zuständigen Amt einzureichen. Die Verfügung tritt mit ihrer Publikation "
+    "in Kraft und kann mit Rekurs angefochten werden. Für Auskünfte steht Ihnen das "
+    "Steueramt während der ordentlichen Öffnungszeiten zur Verfügung."
+).split()
+
+
+class Workload:
+    """Input lengths and levels to draw the requests from."""
+
+    def __init__(self, log_paths=None, seed=None):
+        self.random = random.Random(seed)
+        self.samples = []
+        if log_paths:
+            # The parser of the log analytics reads all log formats of the app.
+            from log_analytics import find_logs, parse_line
+
+            for path in find_logs(log_paths):
+                opener = gzip.open if path.endswith(".gz") else open
+                with opener(path, "rt", encoding="utf-8", errors="replace") as f:
+                    for line in f:
+                        record = parse_line(line)
+                        if record and record.get("kind") == "simplification" and record.get("input_words"):
+                            self.samples.append((record["input_words"], record["level"]))
+
+    def sample(self):
+        """Return (number of words, level) of the next request."""
+        if self.samples:
+            words, level = self.random.choice(self.samples)
+        else:
+            sigma = math.sqrt(2 * math.log(DEFAULT_MEAN_WORDS / DEFAULT_MEDIAN_WORDS))
+            words = round(self.random.lognormvariate(math.log(DEFAULT_MEDIAN_WORDS), sigma))
+            level = self.random.choices(list(DEFAULT_LEVELS), list(DEFAULT_LEVELS.values()))[0]
+        return max(6, min(MAX_INPUT_WORDS, words)), level
+
+    def text(self, words):
+        start = self.random.randrange(len(SENTENCE_WORDS))
+        return " ".join(SENTENCE_WORDS[(start + i) % len(SENTENCE_WORDS)] for i in range(words))
+
+
+class Results:
+    """Thread-safe collection of the measured requests of a stage."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.first_token_times = []
+        self.tokens = 0
+        self.errors = 0
+
+    def add(self, latency, first_token_time=None, tokens=0):
+        with self._lock:
+            self.latencies.append(latency)
+            if first_token_time is not None:
+                self.first_token_times.append(first_token_time)
+            self.tokens += tokens
+
+    def add_error(self):
+        with self._lock:
+            self.errors += 1
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1)]
+
+
+# ---------------------------------------------------------------
+# Targets
+
+
+class LlmTarget:
+    """Send requests through call_llm with the router and engine of the app."""
+
+    def __init__(self):
+        from metrics import GenerationTracker
+        from utils_engine import BackgroundEngine
+        from utils_llm import (
+            MODEL_MAPPING,
+            SYSTEM_MESSAGES,
+            call_llm,
+            probe_first_token,
+            warm_prefixes,
+        )
+        from utils_routing import BackendRouter
+
+        self.GenerationTracker = GenerationTracker
+        self.SYSTEM_MESSAGES = SYSTEM_MESSAGES
+        self.call_llm = call_llm
+        self.engine = BackgroundEngine(MODEL_MAPPING)
+        # Like in the app, the probe requests of the router use slots of the servers, too.
+        self.router = BackendRouter(
+            MODEL_MAPPING, warm_up=warm_prefixes, probe_first_token=probe_first_token
+        )
+        self.router.start()
+        self.models = list(self.router.backends)
+
+    def request(self, text, level, results):
+        model_name = self.router.pick(self.models) or self.models[0]
+        tracker = self.GenerationTracker(model_name, level)
+        start = time.perf_counter()
+        success, stream = self.call_llm(
+            engine=self.engine,
+            text=text,
+            model_name=model_name,
+            system_message=self.SYSTEM_MESSAGES[level],
+            limiter=self.router.limiter(model_name),
+            tracker=tracker,
+        )
+        if not success:
+            self.router.report_failure(model_name)
+            results.add_error()
+            return
+        first_token_time = None
+        try:
+            for chunk in self.router.track(model_name, stream):
+                if first_token_time is None and chunk.choices and chunk.choices[0].delta.content:
+                    # As the user sees it: including the wait for a free slot.
+                    first_token_time = time.perf_counter() - start
+        except Exception:
+            results.add_error()
+            return
+        results.add(time.perf_counter() - start, first_token_time, tracker.generated_tokens())
+
+
+class UiTarget:
+    """Run the Streamlit script for each request."""
+
+    def __init__(self, timeout):
+        from streamlit.testing.v1 import AppTest
+
+        self.AppTest = AppTest
+        self.timeout = timeout
+        # The script reads files relative to its directory.
+        os.chdir(APP_DIR)
+
+    def request(self, text, level, results):
+        app = self.AppTest.from_file("simplify-language-streaming.py", default_timeout=self.timeout)
+        app.run()
+        app.text_area(key="key_textinput").input(text)
+        app.radio[0].set_value(level)
+        button = next(button for button in app.button if button.label == "Vereinfachen")
+        start = time.perf_counter()
+        try:
+            button.click().run()
+        except Exception:
+            results.add_error()
+            return
+        if app.exception or app.error:
+            results.add_error()
+            return
+        results.add(time.perf_counter() - start)
+
+
+# ---------------------------------------------------------------
+# Running the stages
+
+
+def run_stage(target, workload, users, duration, think_time):
+    """Run a number of virtual users for duration seconds and return the results."""
+    results = Results()
+    stop_time = time.monotonic() + duration
+
+    def user(seed):
+        rng = random.Random(seed)
+        # Spread the first requests over one think time, so that the users do not start in lockstep.
+        time.sleep(rng.uniform(0, think_time))
+        while time.monotonic() < stop_time:
+            words, level = workload.sample()
+            target.request(workload.text(words), level, results)
+            time.sleep(rng.expovariate(1 / think_time) if think_time > 0 else 0)
+
+    threads = [threading.Thread(target=user, args=(index,), daemon=True) for index in range(users)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.monotonic() - start
+
+
+def format_row(users, results, elapsed):
+    requests = len(results.latencies) + results.errors
+    row = [
+        f"{users:>5}",
+        f"{requests:>8}",
+        f"{results.errors / requests if requests else 0:>7.1%}",
+        f"{len(results.latencies) / elapsed:>6.2f}",
+        f"{results.tokens / elapsed:>7.0f}",
+    ]
+    row += [f"{percentile(results.first_token_times, p):>6.2f}" for p in PERCENTILES]
+    row += [f"{percentile(results.latencies, p):>6.2f}" for p in PERCENTILES]
+    return "  ".join(row)
+
+
+HEADER = "  ".join(
+    [
+        "users",
+        "requests",
+        " errors",
+        " req/s",
+        "tokens/s",
+        *(f"ttft{p:>2}" for p in PERCENTILES),
+        *(f" lat{p:>2}" for p in PERCENTILES),
+    ]
+)
+
+
+def start_mock_servers(count, mock_args):
+    """Start mock Llama.cpp servers in subprocesses and point the app at them."""
+    processes = []
+    for index in range(count):
+        port = MOCK_BASE_PORT + index
+        processes.append(
+            subprocess.Popen(
+                [sys.executable, mock_llamacpp.__file__, "--port", str(port), *mock_args]
+            )
+        )
+        # The app knows two backends, one per GPU.
+        os.environ[f"LLAMACPP_GPU{index}_URL"] = f"http://127.0.0.1:{port}"
+    for index in range(count):
+        wait_until_healthy(f"http://127.0.0.1:{MOCK_BASE_PORT + index}")
+    return processes
+
+
+def wait_until_healthy(base_url):
+    deadline = time.monotonic() + MOCK_STARTUP_TIMEOUT
+    while True:
+        try:
+            with urllib.request.urlopen(f"{base_url}/health", timeout=1):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the streaming app.")
+    parser.add_argument("--target", choices=["llm", "ui"], default="llm")
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="Number of virtual users per stage")
+    parser.add_argument("--duration", type=float, default=60, help="Duration of a stage in seconds")
+    parser.add_argument("--think-time", type=float, default=2.0, help="Mean pause of a user between two requests in seconds")
+    parser.add_argument("--log", nargs="+", help="Logs of the app to draw the input lengths and levels from")
+    parser.add_argument("--mock", type=int, choices=[1, 2], help="Start this many mock Llama.cpp servers")
+    parser.add_argument("--timeout", type=float, default=300, help="Timeout of a UI request in seconds")
+    parser.add_argument("--seed", type=int, default=None)
+    args, mock_args = parser.parse_known_args()
+
+    processes = start_mock_servers(args.mock, mock_args) if args.mock else []
+    # The app modules read the backend URLs when they are imported.
+    sys.path.insert(0, APP_DIR)
+    try:
+        workload = Workload(args.log, seed=args.seed)
+        print(f"Workload: {len(workload.samples) or 'default'} samples of input lengths")
+        target = LlmTarget() if args.target == "llm" else UiTarget(args.timeout)
+        print("TTFT and latency in seconds, TTFT includes the wait for a free slot.")
+        print(HEADER)
+        for users in args.users:
+            results, elapsed = run_stage(target, workload, users, args.duration, args.think_time)
+            print(format_row(users, results, elapsed), flush=True)
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+# Mock Llama.cpp server for load tests.
+# Offers the parts of the Llama.cpp HTTP API the app uses: the OpenAI compatible chat completions (streaming and not), /health, /props, /slots and /tokenize. Instead of running a model it waits for a configurable prompt processing time and then streams random German words at a configurable speed. It runs on any CPU-only machine without network access.
+# Like Llama.cpp, the server has a fixed number of slots. Requests beyond that wait inside the server, a request with id_slot waits for that slot. Each slot remembers the system message it processed last, so that requests with the same system message only pay for their own text (cache_prompt).
+#
+# Usage: python loadtest/mock_llamacpp.py --port 8090 --slots 4 --decode-speed 30 --prompt-speed 800 --error-rate 0.01
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+
+# Characters per token of German text, as in the token budget of the app.
+CHARS_PER_TOKEN = 3
+
+WORDS = (
+    "die der das und Gemeinde Kanton Zürich Antrag Gesuch Frist Sie können müssen "
+    "bitte melden Amt Bewilligung Steuer Beitrag Termin Formular einreichen bis zum "
+    "Montag wichtig neu Regel Information erhalten prüfen Entscheid Person Familie"
+).split()
+
+
+class SlotPool:
+    """Slots of the mock server. A request waits for a free slot or for the slot it asked for."""
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.free = set(range(slots))
+        self.prefixes = {}
+        self._last_used = {slot: 0.0 for slot in range(slots)}
+        self._condition = asyncio.Condition()
+
+    @property
+    def active(self):
+        return self.slots - len(self.free)
+
+    async def acquire(self, slot=None):
+        if slot is not None and not 0 <= slot < self.slots:
+            slot = None
+        async with self._condition:
+            if slot is None:
+                await self._condition.wait_for(lambda: self.free)
+                slot = min(self.free, key=self._last_used.get)
+            else:
+                await self._condition.wait_for(lambda: slot in self.free)
+            self.free.remove(slot)
+        return slot
+
+    async def release(self, slot):
+        async with self._condition:
+            self.free.add(slot)
+            self._last_used[slot] = time.monotonic()
+            self._condition.notify_all()
+
+
+class MockServer:
+    """Simulated Llama.cpp server with the given speed, slots and error rate."""
+
+    def __init__(
+        self,
+        slots=4,
+        context_size=8192,
+        prompt_delay=0.05,
+        prompt_speed=800.0,
+        decode_speed=30.0,
+        batch_penalty=0.1,
+        output_ratio=1.5,
+        error_rate=0.0,
+        seed=None,
+    ):
+        self.pool = SlotPool(slots)
+        self.context_size = context_size
+        self.prompt_delay = prompt_delay
+        self.prompt_speed = prompt_speed
+        self.decode_speed = decode_speed
+        self.batch_penalty = batch_penalty
+        self.output_ratio = output_ratio
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests_total = 0
+
+    def count_tokens(self, text):
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+    def token_delay(self):
+        # Every further busy slot slows down the decoding of all slots a bit, as batching on a GPU does.
+        return (1 + self.batch_penalty * max(0, self.pool.active - 1)) / self.decode_speed
+
+    async def process_prompt(self, slot, messages, cache_prompt):
+        """Wait for the prompt processing and return the token counts of the prompt."""
+        system_message = next((m["content"] for m in messages if m["role"] == "system"), "")
+        prompt_tokens = sum(self.count_tokens(m["content"]) for m in messages)
+        cached_tokens = 0
+        if cache_prompt and self.pool.prefixes.get(slot) == system_message:
+            cached_tokens = self.count_tokens(system_message)
+        self.pool.prefixes[slot] = system_message
+        evaluated = prompt_tokens - cached_tokens
+        start = time.perf_counter()
+        await asyncio.sleep(self.prompt_delay + evaluated / self.prompt_speed)
+        return evaluated, cached_tokens, (time.perf_counter() - start) * 1000
+
+    def output_tokens(self, messages, max_tokens):
+        user_text = next((m["content"] for m in messages if m["role"] == "user"), "")
+        expected = self.count_tokens(user_text) * self.output_ratio
+        return max(1, min(max_tokens, round(expected * self.random.uniform(0.7, 1.3))))
+
+    def chunk(self, delta, finish_reason=None, **extra):
+        return {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": "mock",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            **extra,
+        }
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        self.requests_total += 1
+        if self.random.random() < self.error_rate:
+            return JSONResponse(
+                {"error": {"code": 500, "message": "Simulated server error", "type": "server_error"}},
+                status_code=500,
+            )
+        messages = body.get("messages", [])
+        max_tokens = int(body.get("max_tokens") or 2048)
+        slot = await self.pool.acquire(body.get("id_slot"))
+        try:
+            prompt_n, cache_n, prompt_ms = await self.process_prompt(
+                slot, messages, body.get("cache_prompt", False)
+            )
+        except BaseException:
+            await self.pool.release(slot)
+            raise
+        tokens = self.output_tokens(messages, max_tokens)
+
+        if not body.get("stream"):
+            try:
+                await asyncio.sleep(tokens * self.token_delay())
+            finally:
+                await self.pool.release(slot)
+            text = " ".join(self.random.choice(WORDS) for _ in range(tokens))
+            return JSONResponse(
+                {
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": "mock",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": text},
+                            "finish_reason": "length" if tokens == max_tokens else "stop",
+                        }
+                    ],
+                    "usage": {"prompt_tokens": prompt_n + cache_n, "completion_tokens": tokens},
+                }
+            )
+
+        async def generate():
+            # The slot is released when the stream ends or the client disconnects.
+            try:
+                start = time.perf_counter()
+                for index in range(tokens):
+                    word = self.random.choice(WORDS)
+                    content = word if index == 0 else " " + word
+                    yield f"data: {json.dumps(self.chunk({'content': content}))}\n\n"
+                    await asyncio.sleep(self.token_delay())
+                decode_seconds = time.perf_counter() - start
+                timings = {
+                    "cache_n": cache_n,
+                    "prompt_n": prompt_n,
+                    "prompt_ms": prompt_ms,
+                    "predicted_n": tokens,
+                    "predicted_ms": decode_seconds * 1000,
+                    "predicted_per_second": tokens / decode_seconds,
+                }
+                finish_reason = "length" if tokens == max_tokens else "stop"
+                yield f"data: {json.dumps(self.chunk({}, finish_reason, timings=timings))}\n\n"
+                yield "data: [DONE]\n\n"
+            finally:
+                await self.pool.release(slot)
+
+        return StreamingResponse(generate(), media_type="text/event-stream")
+
+    async def health(self, request):
+        return JSONResponse({"status": "ok"})
+
+    async def props(self, request):
+        return JSONResponse(
+            {
+                "total_slots": self.pool.slots,
+                "default_generation_settings": {"n_ctx": self.context_size},
+            }
+        )
+
+    async def slots(self, request):
+        return JSONResponse(
+            [
+                {"id": slot, "is_processing": slot not in self.pool.free}
+                for slot in range(self.pool.slots)
+            ]
+        )
+
+    async def tokenize(self, request):
+        body = await request.json()
+        return JSONResponse({"tokens": list(range(self.count_tokens(body.get("content", ""))))})
+
+    def app(self):
+        return Starlette(
+            routes=[
+                Route("/v1/chat/completions", self.chat_completions, methods=["POST"]),
+                Route("/health", self.health),
+                Route("/props", self.props),
+                Route("/slots", self.slots),
+                Route("/tokenize", self.tokenize, methods=["POST"]),
+            ]
+        )
+
+
+def add_arguments(parser):
+    """Add the options of the mock server to an argument parser."""
+    parser.add_argument("--slots", type=int, default=4, help="Parallel slots of the server")
+    parser.add_argument("--context-size", type=int, default=8192, help="Context window of a slot in tokens")
+    parser.add_argument("--prompt-delay", type=float, default=0.05, help="Fixed prompt processing time in seconds")
+    parser.add_argument("--prompt-speed", type=float, default=800.0, help="Prompt processing speed in tokens per second")
+    parser.add_argument("--decode-speed", type=float, default=30.0, help="Generation speed of a single slot in tokens per second")
+    parser.add_argument("--batch-penalty", type=float, default=0.1, help="Slowdown of the generation per additional busy slot")
+    parser.add_argument("--output-ratio", type=float, default=1.5, help="Output tokens per input token")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests that fail with status 500")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def create_server(args):
+    return MockServer(
+        slots=args.slots,
+        context_size=args.context_size,
+        prompt_delay=args.prompt_delay,
+        prompt_speed=args.prompt_speed,
+        decode_speed=args.decode_speed,
+        batch_penalty=args.batch_penalty,
+        output_ratio=args.output_ratio,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Llama.cpp server for load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_server(args).app(), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+# Log analytics: usage statistics from the app logs.
+# The logs are converted into a columnar store of compressed Parquet files. Aggregate queries then read only the columns they need and answer in well under a second, even over years of logs.
+# Ingesting is incremental. For every log file we remember how far we have read, keyed by its first line. A file that is rotated or compressed under a new name is therefore continued where we stopped, and only new lines are converted.
+#
+# Supported formats:
+#   - tab-separated log of the prototype app (_streamlit_app, with the do_analysis and do_simplification columns)
+#   - tab-separated app.log of the streaming app before the event log
+#   - JSON Lines event log of the streaming app and the API, also rotated .gz files
+#
+# Usage:
+#   python tools/log_analytics.py ingest app.log logs/
+#   python tools/log_analytics.py summary
+#   python tools/log_analytics.py daily --period W --since 2024-01-01
+#   python tools/log_analytics.py latency --by model
+#   python tools/log_analytics.py zix
+#   python tools/log_analytics.py compact
+
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+from datetime import datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+DEFAULT_STORE = "logs/analytics"
+STATE_FILE = "_state.json"
+COMPRESSION = "zstd"
+
+# Log files we pick up when a directory is given.
+LOG_PATTERNS = ("*.log", "*.jsonl", "*.jsonl.*.gz")
+
+SCHEMA = pa.schema(
+    [
+        ("ts", pa.timestamp("ms")),
+        ("source", pa.string()),
+        ("kind", pa.string()),
+        ("input_words", pa.int32()),
+        ("output_words", pa.int32()),
+        ("zix_input", pa.float32()),
+        ("zix_output", pa.float32()),
+        ("level", pa.string()),
+        ("model", pa.string()),
+        ("time_processed", pa.float32()),
+        ("success", pa.bool_()),
+        ("cached", pa.bool_()),
+        ("error", pa.string()),
+        ("time_to_first_token", pa.float32()),
+        ("generated_tokens", pa.int32()),
+        ("tokens_per_second", pa.float32()),
+        ("prompt_tokens", pa.int32()),
+        ("cached_prompt_tokens", pa.int32()),
+    ]
+)
+
+_TIMESTAMP = re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}")
+_BOOLEANS = ("True", "False")
+
+# Prefix of the error rows of the streaming app, which logged the error message instead of the output word count.
+_ERROR_PREFIX = "Error from model call. "
+
+PERCENTILES = [0.5, 0.9, 0.99]
+
+# Periods of the daily query and their pandas frequencies.
+PERIODS = {"D": "D", "W": "W", "M": "MS"}
+
+
+# ---------------------------------------------------------------
+# Parsing
+
+
+def _int(value):
+    return int(value) if value.isdigit() else None
+
+
+def _float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def parse_tsv_line(line):
+    """Parse a line of a tab-separated log of the prototype or the streaming app. Returns a record dict or None."""
+    fields = line.rstrip("\n").split("\t")
+    if len(fields) < 9 or fields[-1] not in _BOOLEANS:
+        return None
+    # Depending on the logging configuration the timestamp of log_event is preceded by a level or a second timestamp.
+    timestamps = _TIMESTAMP.findall(fields[-9])
+    if not timestamps:
+        return None
+    record = {
+        "ts": datetime.strptime(timestamps[-1], "%Y-%m-%d %H:%M:%S"),
+        "input_words": _int(fields[-8]),
+        "output_words": _int(fields[-7]),
+        "level": fields[-4],
+        "model": fields[-3],
+        "time_processed": _float(fields[-2]),
+        "success": fields[-1] == "True",
+    }
+    if fields[-6] in _BOOLEANS and fields[-5] in _BOOLEANS:
+        # Prototype app: do_analysis and do_simplification instead of the scores.
+        record["source"] = "v1"
+        analysis_only = fields[-6] == "True" and fields[-5] == "False"
+        record["kind"] = "analysis" if analysis_only else "simplification"
+    else:
+        record["source"] = "v2"
+        record["kind"] = "simplification"
+        record["zix_input"] = _float(fields[-6])
+        record["zix_output"] = _float(fields[-5])
+        if fields[-7].startswith(_ERROR_PREFIX):
+            record["error"] = fields[-7][len(_ERROR_PREFIX) :]
+    return record
+
+
+def parse_event(line):
+    """Parse a line of the JSON Lines event log. Returns a record dict or None."""
+    try:
+        event = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(event, dict) or "ts" not in event:
+        return None
+    record = {name: event.get(name) for name in SCHEMA.names}
+    record["ts"] = datetime.fromisoformat(event["ts"])
+    record["kind"] = "simplification"
+    return record
+
+
+def parse_line(line):
+    if line.startswith("{"):
+        return parse_event(line)
+    return parse_tsv_line(line)
+
+
+# ---------------------------------------------------------------
+# Ingesting
+
+
+def find_logs(paths):
+    """Expand directories and glob patterns into a sorted list of log files."""
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for pattern in LOG_PATTERNS:
+                files.update(glob.glob(os.path.join(path, pattern)))
+        else:
+            files.update(glob.glob(path))
+    return sorted(files)
+
+
+def _open(path):
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+
+def fingerprint(path):
+    """Identify a log file by its first line, which stays the same when the file is rotated or compressed. Returns None while the first line is still being written."""
+    with _open(path) as f:
+        first_line = f.readline()
+    if not first_line.endswith(b"\n"):
+        return None
+    return hashlib.sha1(first_line).hexdigest()
+
+
+def read_new_lines(path, offset):
+    """Return the complete lines of a log file after offset and the new offset. The offset counts uncompressed bytes."""
+    with _open(path) as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b"\n") + 1
+    lines = data[:end].decode("utf-8", errors="replace").splitlines()
+    return lines, offset + end
+
+
+def load_state(store):
+    path = os.path.join(store, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_state(store, state):
+    path = os.path.join(store, STATE_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def ingest(paths, store):
+    """Convert the new lines of the given log files into a new Parquet file of the store. Returns the number of new records."""
+    os.makedirs(store, exist_ok=True)
+    state = load_state(store)
+    records = []
+    for path in find_logs(paths):
+        key = fingerprint(path)
+        if key is None:
+            continue
+        lines, offset = read_new_lines(path, state.get(key, 0))
+        for line in lines:
+            record = parse_line(line)
+            if record is not None:
+                records.append(record)
+        state[key] = offset
+
+    if records:
+        table = pa.Table.from_pylist(records, schema=SCHEMA)
+        name = f"part-{datetime.now():%Y%m%dT%H%M%S%f}.parquet"
+        pq.write_table(table, os.path.join(store, name), compression=COMPRESSION)
+    # The state is saved after the data, so that an interrupted run reads the same lines again instead of losing them.
+    save_state(store, state)
+    return len(records)
+
+
+def compact(store):
+    """Merge all Parquet files of the store into one, sorted by time."""
+    parts = sorted(glob.glob(os.path.join(store, "part-*.parquet")))
+    if len(parts) < 2:
+        return len(parts)
+    table = pq.read_table(parts, schema=SCHEMA).sort_by("ts")
+    name = f"part-{datetime.now():%Y%m%dT%H%M%S%f}.parquet"
+    pq.write_table(table, os.path.join(store, name), compression=COMPRESSION)
+    for part in parts:
+        os.remove(part)
+    return len(parts)
+
+
+# ---------------------------------------------------------------
+# Queries
+
+
+def load(store, columns, since=None, until=None):
+    """Read the given columns of the store into a DataFrame, optionally limited to a time range."""
+    parts = sorted(glob.glob(os.path.join(store, "part-*.parquet")))
+    if not parts:
+        sys.exit(f"No data in {store}. Run the ingest command first.")
+    filters = []
+    if since:
+        filters.append(("ts", ">=", pd.Timestamp(since)))
+    if until:
+        filters.append(("ts", "<", pd.Timestamp(until)))
+    table = pq.read_table(
+        parts, schema=SCHEMA, columns=["ts", *columns], filters=filters or None
+    )
+    return table.to_pandas()
+
+
+def simplifications(df):
+    """Only generated simplifications: no analyses, failures or cache hits."""
+    mask = (df["kind"] == "simplification") & df["success"]
+    if "cached" in df:
+        mask &= df["cached"] != True  # noqa: E712
+    return df[mask]
+
+
+def query_summary(store, since=None, until=None):
+    df = load(store, ["kind", "level", "success", "time_processed", "input_words"], since, until)
+    days = max(1, (df["ts"].max().normalize() - df["ts"].min().normalize()).days + 1)
+    texts = df[df["kind"] == "simplification"]
+    done = simplifications(df)
+    rows = [
+        ("period", f"{df['ts'].min():%Y-%m-%d} to {df['ts'].max():%Y-%m-%d}"),
+        ("requests", len(df)),
+        ("share of simplifications", f"{len(texts) / len(df):.0%}"),
+        ("simplifications per day", f"{len(texts) / days:.1f}"),
+        ("simplifications per week", f"{len(texts) / days * 7:.0f}"),
+        ("simplifications per month", f"{len(texts) / days * 365.25 / 12:.0f}"),
+        ("failed requests", f"{1 - df['success'].mean():.1%}"),
+        ("median processing time (s)", f"{done['time_processed'].median():.1f}"),
+        ("mean processing time (s)", f"{done['time_processed'].mean():.1f}"),
+        ("median input words", f"{df['input_words'].median():.0f}"),
+    ]
+    for level, share in texts["level"].value_counts(normalize=True).items():
+        rows.append((f"share of {level}", f"{share:.0%}"))
+    return pd.DataFrame(rows, columns=["metric", "value"]).set_index("metric")
+
+
+def query_daily(store, period="D", since=None, until=None):
+    df = load(store, ["kind", "success", "time_processed"], since, until)
+    df = df[df["kind"] == "simplification"]
+    df = df.assign(failed=~df["success"])
+    grouped = df.set_index("ts").resample(PERIODS[period])
+    return pd.DataFrame(
+        {
+            "texts": grouped["success"].size(),
+            "failed": grouped["failed"].sum(),
+            "median_seconds": grouped["time_processed"].median().round(2),
+        }
+    )
+
+
+def query_latency(store, by=("model",), since=None, until=None):
+    columns = ["kind", "success", "cached", "time_processed", "time_to_first_token", *by]
+    df = simplifications(load(store, list(dict.fromkeys(columns)), since, until))
+    grouped = df.groupby(list(by), dropna=False)
+    result = grouped["time_processed"].quantile(PERCENTILES).unstack()
+    result.columns = [f"p{int(q * 100)}_seconds" for q in PERCENTILES]
+    result.insert(0, "count", grouped.size())
+    result["p50_first_token"] = grouped["time_to_first_token"].median()
+    return result.round(2)
+
+
+def query_zix(store, since=None, until=None):
+    df = simplifications(
+        load(store, ["kind", "success", "cached", "level", "model", "zix_input", "zix_output"], since, until)
+    )
+    df = df.dropna(subset=["zix_input", "zix_output"])
+    df = df.assign(zix_delta=df["zix_output"] - df["zix_input"])
+    grouped = df.groupby(["level", "model"])
+    return pd.DataFrame(
+        {
+            "count": grouped.size(),
+            "zix_input": grouped["zix_input"].mean(),
+            "zix_output": grouped["zix_output"].mean(),
+            "zix_delta_mean": grouped["zix_delta"].mean(),
+            "zix_delta_median": grouped["zix_delta"].median(),
+        }
+    ).round(2)
+
+
+# ---------------------------------------------------------------
+# Command line
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Usage statistics from the app logs.")
+    parser.add_argument("--store", default=DEFAULT_STORE, help="Directory of the Parquet store")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = commands.add_parser("ingest", help="Convert new log lines into the store")
+    ingest_parser.add_argument("paths", nargs="+", help="Log files, directories or glob patterns")
+    commands.add_parser("compact", help="Merge the Parquet files of the store")
+
+    queries = {
+        "summary": "Usage statistics as in the README",
+        "daily": "Number of texts, failures and median processing time per period",
+        "latency": "Percentiles of the processing time of generated simplifications",
+        "zix": "ZIX scores before and after the simplification by level and model",
+    }
+    for name, help_text in queries.items():
+        query_parser = commands.add_parser(name, help=help_text)
+        query_parser.add_argument("--since", help="First day, e.g. 2024-01-01")
+        query_parser.add_argument("--until", help="Day after the last day")
+        if name == "daily":
+            query_parser.add_argument("--period", default="D", choices=PERIODS, help="Day, week or month")
+        if name == "latency":
+            query_parser.add_argument("--by", nargs="+", default=["model"], choices=["model", "level", "source"])
+
+    args = parser.parse_args()
+    if args.command == "ingest":
+        print(f"{ingest(args.paths, args.store)} new records ingested into {args.store}")
+        return
+    if args.command == "compact":
+        print(f"{compact(args.store)} files merged")
+        return
+
+    pd.set_option("display.width", 200)
+    pd.set_option("display.max_rows", 500)
+    if args.command == "summary":
+        result = query_summary(args.store, args.since, args.until)
+    elif args.command == "daily":
+        result = query_daily(args.store, args.period, args.since, args.until)
+    elif args.command == "latency":
+        result = query_latency(args.store, args.by, args.since, args.until)
+    else:
+        result = query_zix(args.store, args.since, args.until)
+    print(result.to_string())
+
+
+if __name__ == "__main__":
+    main()